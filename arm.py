@@ -1,6 +1,13 @@
+import os
 import sys
+import bisect
 from collections import namedtuple
 
+import profiling
+import pointers
+import sections
+from indexes import CallInfo, UnwoundFrames
+
 import capstone
 
 def get_arm_tags(elf):
@@ -47,7 +54,6 @@ def insn_repr(insn):
       res.append("Unknown op")
   return res
 
-CallInfo = namedtuple('CallInfo', ['mnemonic', 'call_addr', 'callee_addr'])
 def analyze_call(insn):
   """ Analyze an instruction and return a CallInfo if it is a call. """
 
@@ -72,7 +78,268 @@ def analyze_call(insn):
 
   return CallInfo(mnemonic=insn.mnemonic, call_addr=insn.address, callee_addr=callee_addr)
 
+class MappingSymbols:
+  """
+  Index of the ARM mapping symbols in a section. These mark the start
+  of a run of ARM code ($a), Thumb code ($t) or data ($d, e.g. literal
+  pools), which runs until the next mapping symbol or the end of the
+  section. See "Mapping symbols" in the ARM ELF specification:
+  https://developer.arm.com/docs/ihi0044/latest
+  """
+  kinds = ('a', 't', 'd')
+
+  def __init__(self, addrs, kinds, end):
+    # Sorted run start addresses and the kind of each run
+    self.addrs = addrs
+    self.kinds = kinds
+    # End of the section (i.e. of the last run)
+    self.end = end
+
+  @classmethod
+  def from_elf(cls, elf, section_name = '.text'):
+    section_index = None
+    section_end = 0
+    for i, section in enumerate(elf.iter_sections()):
+      if section.name == section_name:
+        section_index = i
+        section_end = section['sh_addr'] + section['sh_size']
+
+    runs = {}
+    symtab = elf.get_section_by_name('.symtab')
+    if section_index is not None and symtab is not None:
+      for sym in symtab.iter_symbols():
+        # Mapping symbols are named $a, $t or $d, optionally followed by
+        # a period and any other characters (e.g. $d.1)
+        name = sym.name
+        if (len(name) < 2 or name[0] != '$' or name[1] not in cls.kinds or
+            (len(name) > 2 and name[2] != '.')):
+          continue
+        if sym['st_shndx'] != section_index:
+          continue
+        runs[sym['st_value']] = name[1]
+
+    addrs = sorted(runs)
+    return cls(addrs, [runs[addr] for addr in addrs], section_end)
+
+  def __len__(self):
+    return len(self.addrs)
+
+  def regions(self, start, end):
+    """
+    Yields (start, end, kind) tuples that split up the given address
+    range according to the mapping symbols. kind is 'a', 't' or 'd', or
+    None for a part not covered by any mapping symbol.
+    """
+    i = bisect.bisect_right(self.addrs, start) - 1
+    while start < end:
+      if i + 1 < len(self.addrs):
+        region_end = min(end, self.addrs[i + 1])
+      else:
+        region_end = end
+      kind = self.kinds[i] if i >= 0 else None
+      if region_end > start:
+        yield (start, region_end, kind)
+      start = region_end
+      i += 1
+
+  def data_regions(self):
+    """
+    Return a sorted list of (start, end) tuples for all data runs.
+    """
+    result = []
+    for i, kind in enumerate(self.kinds):
+      if kind != 'd':
+        continue
+      if i + 1 < len(self.addrs):
+        end = self.addrs[i + 1]
+      else:
+        end = self.end
+      if result and result[-1][1] == self.addrs[i]:
+        result[-1] = (result[-1][0], end)
+      elif end > self.addrs[i]:
+        result.append((self.addrs[i], end))
+    return result
+
+# DWARF register numbers for the ARM registers used by unwinding
+DWARF_REG_SP = 13
+DWARF_REG_LR = 14
+
+# Unwind rule for a range of instructions: The CFA (canonical frame
+# address, i.e. the value of sp at the call into the function) is
+# cfa_reg + cfa_offset (cfa_reg is None when this cannot be expressed),
+# and offsets maps register numbers to the CFA-relative address where
+# the caller's value of that register was saved.
+CFIRow = namedtuple('CFIRow', ['pc', 'cfa_reg', 'cfa_offset', 'offsets'])
+
+def call_frame_entries(elf):
+  """
+  Return the CIEs and FDEs from .debug_frame or, if that is missing,
+  from .eh_frame in the given elf file.
+  """
+  # has_dwarf_info does not look for .debug_frame, which is also
+  # emitted for builds without any other debug info
+  if not elf.has_dwarf_info() and not elf.get_section_by_name('.debug_frame'):
+    return []
+  dwarf_info = elf.get_dwarf_info()
+  if dwarf_info.has_CFI():
+    return dwarf_info.CFI_entries()
+  elif dwarf_info.has_EH_CFI():
+    return dwarf_info.EH_CFI_entries()
+  return []
+
+class CFIIndex:
+  """
+  Index of the call frame information (from .debug_frame, or .eh_frame
+  if there is none) of an elf file, to quickly find the unwind rules for
+  a given address. Each FDE (describing a single function) is stored as
+  an address range with a list of CFIRows, sorted by address.
+  """
+  def __init__(self, starts, ends, rows):
+    # Sorted FDE start addresses, and the end address and rows of each
+    self.starts = starts
+    self.ends = ends
+    self.rows = rows
+
+  @classmethod
+  def from_elf(cls, elf):
+    from elftools.dwarf.callframe import FDE, RegisterRule
+
+    fdes = []
+    for entry in call_frame_entries(elf):
+      if not isinstance(entry, FDE):
+        continue
+      # Clear lower bit, which is used to select between ARM/thumb mode
+      start = entry['initial_location'] & ~0x1
+      rows = []
+      for row in entry.get_decoded().table:
+        cfa = row['cfa']
+        offsets = {reg: rule.arg for reg, rule in row.items()
+                   if isinstance(reg, int) and rule.type == RegisterRule.OFFSET}
+        if cfa.expr is not None:
+          rows.append(CFIRow(row['pc'] & ~0x1, None, 0, offsets))
+        else:
+          rows.append(CFIRow(row['pc'] & ~0x1, cfa.reg, cfa.offset, offsets))
+      fdes.append((start, start + entry['address_range'], rows))
+      profiling.count('cfi_rows', len(rows))
+
+    fdes.sort(key=lambda fde: fde[0])
+    return cls([fde[0] for fde in fdes], [fde[1] for fde in fdes], [fde[2] for fde in fdes])
+
+  def __len__(self):
+    return len(self.starts)
+
+  def fde_rows(self, addr):
+    """ Return the rows of the FDE containing addr, or None. """
+    i = bisect.bisect_right(self.starts, addr) - 1
+    if i < 0 or addr >= self.ends[i]:
+      return None
+    return self.rows[i]
+
+  def lookup(self, addr):
+    """ Return the CFIRow that applies at addr, or None. """
+    rows = self.fde_rows(addr)
+    if not rows:
+      return None
+    # Rows are few per function, so a linear search is fine
+    result = None
+    for row in rows:
+      if row.pc > addr:
+        break
+      result = row
+    return result
+
+  def saved_lr_row(self, addr):
+    """
+    Return the first CFIRow of the function containing addr that saves
+    lr on the stack, or None. Since saved registers stay at the same
+    offset from the CFA, this gives the frame layout during any call
+    the function makes.
+    """
+    for row in self.fde_rows(addr) or ():
+      if DWARF_REG_LR in row.offsets and row.cfa_reg is not None:
+        return row
+    return None
+
+def maybe_branch(mnemonic, op_str):
+  """
+  Return whether an instruction might be classified as a jump or call
+  by capstone. This errs on the side of caution (e.g. includes all
+  instructions that touch pc), since only instructions that pass this
+  check are decoded in detail and passed to analyze_call.
+  """
+  return mnemonic.startswith(('b', 'cb', 'tb')) or 'pc' in op_str
+
+# Below this many functions, disassembly is not done in parallel, since
+# starting the worker processes would take longer than it saves.
+parallel_min_functions = 2000
+
+# Disassembly context of a forked worker process: a (data, text_start,
+# handles) tuple set up by init_worker. This is only used in worker
+# processes, so threads analyzing different elf files never share it.
+worker_context = None
+
+def create_handles(base_mode):
+  """
+  Create capstone handles for the given mode: For each of thumb and ARM
+  mode, one without details to quickly run through all instructions and
+  one with details to analyze possible calls. Returns a dictionary
+  mapping thumb (True or False) to a (lite, detail) tuple.
+  """
+  handles = {}
+  for thumb in (False, True):
+    if thumb:
+      mode = base_mode & ~capstone.CS_MODE_ARM | capstone.CS_MODE_THUMB
+    else:
+      mode = base_mode & ~capstone.CS_MODE_THUMB | capstone.CS_MODE_ARM
+    lite = capstone.Cs(capstone.CS_ARCH_ARM, mode)
+    detail = capstone.Cs(capstone.CS_ARCH_ARM, mode)
+    detail.detail = True
+    handles[thumb] = (lite, detail)
+  return handles
+
+def init_worker(base_mode, data, text_start):
+  """ Set up the disassembly context of a worker process. """
+  global worker_context
+  worker_context = (data, text_start, create_handles(base_mode))
+
+def worker_find_callsites(functions):
+  """ find_functions_callsites for a worker process. """
+  data, text_start, handles = worker_context
+  return find_functions_callsites(functions, data, text_start, handles)
+
+def find_functions_callsites(functions, data, text_start, handles):
+  """
+  Disassemble the given list of (address, size, thumb) functions in
+  data (the .text section, starting at text_start), using the given
+  capstone handles (see create_handles). Returns a list of (return
+  address, mnemonic, call address, callee address) tuples for the calls
+  found in each function, in order, and the number of instructions
+  decoded.
+  """
+  results = []
+  instructions = 0
+  for sym_addr, sym_size, thumb in functions:
+    lite, detail = handles[thumb]
+    offset = sym_addr - text_start
+    func = data[offset:offset + sym_size]
+    calls = []
+    results.append(calls)
+
+    for instructions, (address, size, mnemonic, op_str) in enumerate(lite.disasm_lite(func, sym_addr), instructions + 1):
+      if not maybe_branch(mnemonic, op_str):
+        continue
+
+      # Decode just this instruction again, with details
+      insn_offset = address - sym_addr
+      insn = next(detail.disasm(func[insn_offset:insn_offset + size], address, 1))
+      call = analyze_call(insn)
+      if call:
+        calls.append((address + size, mnemonic, call.call_addr, call.callee_addr))
+  return results, instructions
+
 class ArchArm:
+  name = 'arm'
+
   def __init__(self, elf):
     attrs = get_arm_tags(elf)
     cpu_arch = attrs.get('TAG_CPU_ARCH', None)
@@ -102,8 +369,35 @@ class ArchArm:
     else:
       mode |= capstone.CS_MODE_BIG_ENDIAN
 
-    self.cs = capstone.Cs(capstone.CS_ARCH_ARM, mode)
-    self.cs.detail = True
+    self.mode = mode
+    # Number of processes to use for disassembly, None for one per CPU
+    self.jobs = None
+    self.mapping_symbols = None
+    # cache.FunctionCache to reuse the calls found in unchanged
+    # functions, or None
+    self.function_cache = None
+    self.elf = elf
+    self.cfi_index = None
+
+  def get_mapping_symbols(self, elf):
+    """ Return the MappingSymbols for the .text section of elf. """
+    if self.mapping_symbols is None:
+      self.mapping_symbols = MappingSymbols.from_elf(elf)
+    return self.mapping_symbols
+
+  def get_data_regions(self, elf):
+    """
+    Return a sorted list of (start, end) tuples for data (rather than
+    code) in the .text section.
+    """
+    return self.get_mapping_symbols(elf).data_regions()
+
+  def get_cfi_index(self):
+    """ Return the CFIIndex for the elf file. """
+    if self.cfi_index is None:
+      with profiling.phase('cfi_index'):
+        self.cfi_index = CFIIndex.from_elf(self.elf)
+    return self.cfi_index
 
   def get_addrlen(self):
     """ Return the length of a return address on the stack. """
@@ -119,43 +413,103 @@ class ArchArm:
     instructions. Returns a dictionary that maps the return address (i.e.
     the instruction *after* the call instruction) for each call to the
     .CallInfo object.
+
+    When there are many functions, they are disassembled in parallel
+    using worker processes (see the jobs attribute). When the
+    function_cache attribute is set, only functions whose code is not in
+    that cache are disassembled.
     """
     text = elf.get_section_by_name('.text')
-    data = text.data()
+    # A memoryview, so slicing out each function does not copy
+    data = sections.section_view(text)
     text_start = text['sh_addr']
-    calls = {}
 
+    mapping = self.get_mapping_symbols(elf)
+
+    functions = []
     for sym in symdict.values():
       # The LSB indicates Thumb (1) or ARM (0) instructions.
-      if sym['st_value'] & 1 == 0:
-        self.cs.mode = self.cs.mode & ~capstone.CS_MODE_THUMB | capstone.CS_MODE_ARM
-      else:
-        self.cs.mode = self.cs.mode & ~capstone.CS_MODE_ARM | capstone.CS_MODE_THUMB
-
+      thumb = sym['st_value'] & 1 == 1
       sym_addr = sym['st_value'] & ~1
-      sym_size = sym['st_size']
-      offset = sym_addr - text_start
-      end = offset + sym['st_size']
-      func = data[offset:end]
-      #print("\n%{:08X} <{}>".format(sym_addr, sym.name))
-
-      for insn in self.cs.disasm(func, sym_addr, sym_size):
-        call = analyze_call(insn)
-        if call:
-          ret_addr = insn.address + insn.size
-          calls[ret_addr] = call
-          #print(insn_repr(insn))
+      if not mapping:
+        functions.append((sym_addr, sym['st_size'], thumb))
+        continue
+
+      # Mapping symbols tell exactly which parts of the function are
+      # ARM or Thumb code, and which are data (e.g. literal pools) that
+      # should not be disassembled at all.
+      for start, end, kind in mapping.regions(sym_addr, sym_addr + sym['st_size']):
+        if kind == 'd':
+          continue
+        elif kind is not None:
+          thumb = kind == 't'
+        functions.append((start, end - start, thumb))
 
+    if self.function_cache is None:
+      results = self.disassemble(functions, data, text_start)
+    else:
+      base_mode = '{}:{:x}:'.format(self.name, self.mode)
+      def code(addr, size):
+        return data[addr - text_start:addr - text_start + size]
+      cached = [(addr, code(addr, size), base_mode + ('t' if thumb else 'a'))
+                for addr, size, thumb in functions]
+      def decode(missing):
+        return self.disassemble([(addr, len(func), mode.endswith('t')) for addr, func, mode in missing],
+                                data, text_start)
+      # All branch instructions encode a relative offset
+      results = self.function_cache.callsites(cached, decode)
+
+    calls = {}
+    for function_calls in results:
+      for ret_addr, mnemonic, call_addr, callee_addr in function_calls:
+        calls[ret_addr] = CallInfo(mnemonic=mnemonic, call_addr=call_addr, callee_addr=callee_addr)
     return calls
 
+  def disassemble(self, functions, data, text_start):
+    """
+    Disassemble the given (address, size, thumb) functions in data (the
+    .text section), in parallel when there are many. Returns a list of
+    calls for each function, see find_functions_callsites.
+    """
+    import threading
+    import multiprocessing
+
+    jobs = self.jobs or os.cpu_count() or 1
+    # Forking while other threads are running (e.g. in the server) is
+    # not safe, so only use worker processes from a single thread
+    if (jobs > 1 and len(functions) >= parallel_min_functions and
+        threading.active_count() == 1 and
+        'fork' in multiprocessing.get_all_start_methods()):
+      # Use a few chunks per worker, to balance the load
+      chunk_size = max(1, len(functions) // (jobs * 4))
+      chunks = [functions[i:i + chunk_size] for i in range(0, len(functions), chunk_size)]
+      # Workers are forked, so they share the (mapped) section data
+      # without copying
+      with multiprocessing.get_context('fork').Pool(jobs, initializer = init_worker,
+                                                    initargs = (self.mode, data, text_start)) as pool:
+        # imap keeps the results in order, so later functions overwrite
+        # earlier ones just like when processing serially
+        results = []
+        for chunk_results, instructions in pool.imap(worker_find_callsites, chunks):
+          results.extend(chunk_results)
+          profiling.count('instructions_decoded', instructions)
+    else:
+      results, instructions = find_functions_callsites(functions, data, text_start, create_handles(self.mode))
+      profiling.count('instructions_decoded', instructions)
+    return results
+
   def decode_ptr(self, bytestr):
     """
     Decode a given stack fragment of size addrlen into a return address.
     """
+    return pointers.decode_arm_ptr(bytestr)
 
-    ptr = int.from_bytes(bytestr, byteorder = 'little')
-    # Clear lower bit, which is used to select between ARM/thumb mode
-    return ptr & ~0x1
+  def decode_ptrs(self, data, first, step):
+    """
+    Vectorized version of decode_ptr, see pointers.decode_arm_ptrs.
+    Requires numpy.
+    """
+    return pointers.decode_arm_ptrs(data, first, step)
 
   def sym_to_addr(self, sym):
     """
@@ -164,4 +518,168 @@ class ArchArm:
     # Clear lower bit, which is used to select between ARM/thumb mode
     return sym['st_value'] & ~0x1
 
+  def data_addr(self, value):
+    """
+    Return the data memory address (as used in memory dumps) for the
+    given address of a data symbol, or None if it is not in RAM.
+    """
+    return value
+
+  def task_resume_addr(self, symbols, memory, sp):
+    """
+    Return the address a suspended RTOS task will resume at, from the
+    exception frame left on its stack by the context switch, or None.
+    The context switch saves r4-r11 below the exception frame, and with
+    an FPU also lr (EXC_RETURN) and, when the task used the FPU, s16-s31.
+    """
+    from intelhex import NotEnoughDataError
+
+    def word_at(addr):
+      try:
+        return int.from_bytes(memory.gets(addr, 4), 'little')
+      except NotEnoughDataError:
+        return None
+
+    frame = sp + 32
+    exc_return = word_at(frame)
+    if exc_return is not None and exc_return & 0xFFFFFF00 == 0xFFFFFF00:
+      frame += 4
+      # Bit 4 clear means the FPU context was saved as well
+      if not exc_return & 0x10:
+        frame += 64
+
+    pc = word_at(frame + 24)
+    xpsr = word_at(frame + 28)
+    if pc is None or xpsr is None or not xpsr & (1 << 24):
+      return None
+    if symbols.find(pc & ~0x1) < 0:
+      return None
+    return pc & ~0x1
+
+  def unwind(self, symbols, callsites, memory, sp, isr_ret):
+    """
+    Find the return addresses on the stack by following the chain of
+    stack frames, using the call frame information (CFI) from the elf
+    file. Unlike find_stack_frames, this only looks at a single return
+    address for each frame. When a function has no CFI, or it does not
+    lead to a valid return address, this falls back to scanning the
+    stack for the next valid return address and picks up the chain again
+    from there. Returns an UnwoundFrames list of (stack address,
+    CallInfo) tuples, or None when there is no CFI at all.
+    """
+    index = self.get_cfi_index()
+    if not index:
+      return None
+
+    frames = UnwoundFrames()
+    for start, end in memory.segments():
+      data = memory.gets(start, end - start)
+      first = start
+      if sp is not None and first < sp:
+        first = sp
+      # Stack slots are always word-aligned
+      first += -first % 4
+
+      def word_at(slot):
+        if slot < start or slot + 4 > end:
+          return None
+        return int.from_bytes(data[slot - start:slot - start + 4], 'little')
+
+      def scan(slot):
+        profiling.count('unwind_scans')
+        while slot + 4 <= end:
+          ptr = word_at(slot)
+          if ptr & ~0x1 in callsites:
+            return slot
+          slot += 4
+        return None
+
+      def restore(row, cfa, regs):
+        # Registers not saved by the function still have the caller's value
+        caller_regs = {reg: value for reg, value in regs.items() if 4 <= reg <= 11}
+        caller_regs[DWARF_REG_SP] = cfa
+        slots = {}
+        for reg, offset in row.offsets.items():
+          value = word_at(cfa + offset)
+          if value is not None:
+            caller_regs[reg] = value
+            slots[reg] = cfa + offset
+        return caller_regs, slots
+
+      def step(addr, regs, lr_slot):
+        # Returns the stack slot with the return address of the frame
+        # at addr, with the caller's registers, or None.
+        row = index.lookup(addr)
+        if row is None or row.cfa_reg not in regs:
+          return None
+        cfa = regs[row.cfa_reg] + row.cfa_offset
+        caller_regs, slots = restore(row, cfa, regs)
+        if DWARF_REG_LR in slots:
+          return slots[DWARF_REG_LR], caller_regs
+        if lr_slot is not None:
+          # A leaf function interrupted by an exception, with the return
+          # address still in lr (saved in the exception frame)
+          return lr_slot, caller_regs
+        return None
+
+      def resync(slot, ret):
+        # Find the caller's registers from a return address found by
+        # scanning, using the frame layout of the function it called
+        callee = callsites[ret].callee_addr
+        row = index.saved_lr_row(callee) if callee is not None else None
+        if row is None:
+          return None
+        return restore(row, slot - row.offsets[DWARF_REG_LR], {})[0]
+
+      # Where to start scanning when the CFI turns out to be missing or wrong
+      resume = first
+      # State of the next frame to unwind: The address to look up in the
+      # CFI, the known register values and the slot of lr in the
+      # exception frame
+      addr = regs = lr_slot = None
+      if isr_ret is not None:
+        # Find the exception frame (r0-r3, r12, lr, pc, xPSR) by its
+        # stacked pc, checking the thumb bit in the stacked xPSR
+        slot = first
+        while slot + 32 <= end:
+          if word_at(slot + 24) & ~0x1 == isr_ret & ~0x1 and word_at(slot + 28) & (1 << 24):
+            break
+          slot += 4
+        else:
+          slot = None
+
+        if slot is not None:
+          lr_slot = slot + 20
+          resume = lr_slot
+          # Bit 9 of xPSR signals the stack was realigned
+          caller_sp = slot + 32 + (4 if word_at(slot + 28) & (1 << 9) else 0)
+          # The interrupted instruction did not run yet, so look up isr_ret
+          # itself rather than the call instruction before it
+          addr = isr_ret & ~0x1
+          regs = {DWARF_REG_SP: caller_sp, DWARF_REG_LR: word_at(lr_slot)}
+
+      while True:
+        found = step(addr, regs, lr_slot) if regs is not None else None
+        lr_slot = None
+        if found is not None:
+          slot, regs = found
+          ret = word_at(slot) & ~0x1
+          if slot < resume or ret not in callsites:
+            found = None
+
+        if found is None:
+          slot = scan(resume)
+          if slot is None:
+            break
+          ret = word_at(slot) & ~0x1
+          regs = resync(slot, ret)
+          frames.scanned.add(slot)
+
+        frames.append((slot, callsites[ret]))
+        resume = slot + 4
+        # Look up the call instruction, since a call at the end of a
+        # function returns just past its FDE
+        addr = ret - 1
+    return frames
+
 __all__ = ('ArchArm',)
@@ -27,8 +27,21 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import struct
+import bisect
 from collections import namedtuple
 
+import profiling
+import pointers
+import sections
+from indexes import CallInfo, UnwoundFrames
+
+try:
+  import numpy
+except ImportError:
+  # Optional, only needed for faster callsite analysis
+  numpy = None
+
 InstructionInfo = namedtuple('InstructionInfo', ['mnemonic', 'length', 'opcode', 'operands'])
 OperandInfo = namedtuple('OperandInfo', ['kind', 'mask'])
 
@@ -195,35 +208,100 @@ def decode_operand(words, info, operand):
 
 Instruction = namedtuple('Instruction', ['addr', 'info', 'raw', 'operands'])
 
-# TODO: Precalculate instruction lookup table for faster decoding
+# Entry in the opcode lookup table. operands contains the operand values
+# as decoded from the first word, long_operand is the index of the
+# operand whose lower 16 bits come from the second word (or None).
+DecodeInfo = namedtuple('DecodeInfo', ['info', 'operands', 'long_operand'])
+
+unknown_decode_info = DecodeInfo(unknown_instruction, (), None)
+
+def build_lookup_table(candidates):
+  """
+  Build a table that maps every possible first opcode word to the
+  DecodeInfo for the first instruction in candidates that matches it.
+  """
+  table = [unknown_decode_info] * 0x10000
+  # Go backwards, so earlier instructions overwrite later ones, giving
+  # the same priority as a linear search would
+  for info in reversed(candidates):
+    mask = 0
+    for operand in info.operands:
+      mask |= operand.mask
+    if info.opcode & mask:
+      # Can never match
+      continue
+
+    long_operand = None
+    for i, operand in enumerate(info.operands):
+      if operand.kind == 'OPERAND_LONG_ABSOLUTE_ADDRESS':
+        long_operand = i
+
+    # Iterate over all possible operand values, i.e. all subsets of
+    # the operand mask bits
+    bits = mask
+    while True:
+      opcode = info.opcode | bits
+      operands = tuple(decode_operand([opcode, 0], info, operand) for operand in info.operands)
+      table[opcode] = DecodeInfo(info, operands, long_operand)
+      if bits == 0:
+        break
+      bits = (bits - 1) & mask
+  return table
+
+# Lookup tables, built on first use
+lookup_tables = {}
+
+def get_lookup_table(call_only):
+  table = lookup_tables.get(call_only)
+  if table is None:
+    table = build_lookup_table(call_and_long_instructions if call_only else instructions)
+    lookup_tables[call_only] = table
+  return table
+
+word_struct = struct.Struct('<H')
+
+def read_word(data, offset):
+  """
+  Read the little-endian word at offset in data (bytes, memoryview or
+  anything else supporting the buffer protocol), without slicing.
+  Missing bytes past the end of data read as zero.
+  """
+  try:
+    return word_struct.unpack_from(data, offset)[0]
+  except struct.error:
+    return int.from_bytes(bytes(data[offset:offset+2]), byteorder='little')
+
 def decode_instruction(data, offset, call_only = False):
+  """
+  Decode the instruction at offset in data. When call_only is True,
+  only calls and long instructions are recognized (everything else is
+  decoded as an unknown 2-byte instruction) and raw is not filled in.
+  """
   # The upper (and often only) 2-byte word in the instruction identifies
   # the instruction. Note that each word is little-endian internally,
   # but the words themselves are big endian...
-  opcode = int.from_bytes(data[offset:offset+2], byteorder='little')
-  candidates = instructions
-  if call_only:
-    candidates = call_and_long_instructions
-
-  for info in candidates:
-    # Clear out all operands from the opcode
-    masked = opcode
-    for operand in info.operands:
-      masked &= ~operand.mask
-    # See if it now matches the opcode from the table
-    if masked == info.opcode:
-      # Read the instructions (2 or 4 bytes), shown as big-endian
-      raw = hex(int.from_bytes(data[offset:offset+info.length], byteorder='big'))
-      words = [int.from_bytes(data[offset+i*2:offset+i*2+2], byteorder='little') for i in range(info.length//2)]
-      # Figure out operand values
-      operands = []
-      for operand in info.operands:
-        operands.append(decode_operand(words, info, operand))
-      return Instruction(offset, info, raw, operands)
-
-  return Instruction(addr=offset, info=unknown_instruction, raw=0, operands=[])
-
-CallInfo = namedtuple('CallInfo', ['mnemonic', 'call_addr', 'callee_addr'])
+  opcode = read_word(data, offset)
+  decode_info = get_lookup_table(call_only)[opcode]
+  info = decode_info.info
+  if info is unknown_instruction:
+    return Instruction(addr=offset, info=unknown_instruction, raw=0, operands=[])
+
+  operands = list(decode_info.operands)
+  second = None
+  if info.length == 4:
+    second = read_word(data, offset + 2)
+  if decode_info.long_operand is not None:
+    operands[decode_info.long_operand] |= second
+
+  raw = None
+  if not call_only:
+    # The instruction (2 or 4 bytes), shown as big-endian
+    raw = opcode >> 8 | (opcode & 0xff) << 8
+    if second is not None:
+      raw = raw << 16 | second >> 8 | (second & 0xff) << 8
+    raw = hex(raw)
+  return Instruction(offset, info, raw, operands)
+
 def analyze_call(ins):
   """ Analyze an instruction and return a CallInfo if it is a call. """
   if ins.info.mnemonic == 'call':
@@ -242,7 +320,243 @@ def analyze_call(ins):
 
   return CallInfo(mnemonic=ins.info.mnemonic, call_addr=ins.addr, callee_addr=callee_addr)
 
+def find_function_callsites(data, offset, end, calls):
+  """
+  Decode the instructions between offset and end and add any calls
+  found to the calls dictionary, indexed by return address. Returns the
+  number of instructions decoded.
+  """
+  instructions = 0
+  while offset < end:
+    ins = decode_instruction(data, offset, call_only = True)
+    call = analyze_call(ins)
+    if call:
+      ret_addr = ins.addr + ins.info.length
+      calls[ret_addr] = call
+    offset += ins.info.length
+    instructions += 1
+  return instructions
+
+# Mnemonics that analyze_call considers calls, the index (plus one) is
+# used as a code in the numpy lookup tables
+call_mnemonics = ['call', 'rcall', 'icall', 'eicall']
+
+# Numpy versions of the call-only lookup table, built on first use
+numpy_lookup_tables = None
+
+def get_numpy_lookup_tables():
+  """
+  Return (length, kind, operand) numpy arrays that map the first word of
+  an instruction to its length, its index in call_mnemonics plus one (or
+  0 when it is not a call) and the value of its first operand (as far as
+  it can be decoded from the first word).
+  """
+  global numpy_lookup_tables
+  if numpy_lookup_tables is None:
+    table = get_lookup_table(call_only = True)
+    length = numpy.array([d.info.length for d in table], dtype=numpy.uint8)
+    kind = numpy.array([call_mnemonics.index(d.info.mnemonic) + 1 if d.info.mnemonic in call_mnemonics else 0
+                        for d in table], dtype=numpy.uint8)
+    operand = numpy.array([d.operands[0] if d.operands else 0 for d in table], dtype=numpy.int64)
+    numpy_lookup_tables = (length, kind, operand)
+  return numpy_lookup_tables
+
+def find_callsites_numpy(data, ranges):
+  """
+  Vectorized version of find_function_callsites, that processes the
+  given (start, end) function ranges all at once using numpy. Returns
+  the same dictionary of calls.
+  """
+  lut_length, lut_kind, lut_operand = get_numpy_lookup_tables()
+
+  # Functions that overlap a preceding function or are not aligned
+  # cannot be handled by the vectorized code below, those are decoded
+  # one by one afterwards.
+  regular = []
+  irregular = []
+  max_end = 0
+  for start, end in sorted(ranges):
+    if start % 2 or start < max_end:
+      irregular.append((start, end))
+    else:
+      regular.append((start, end))
+    max_end = max(max_end, end)
+
+  # View the code as an array of little-endian words, padded with zeroes
+  # so that the second word of a trailing long instruction can always be
+  # read.
+  nwords = (max_end + 1) // 2 + 2
+  buf = numpy.zeros(nwords * 2, dtype=numpy.uint8)
+  chunk = numpy.frombuffer(data, dtype=numpy.uint8)[:nwords * 2]
+  buf[:len(chunk)] = chunk
+  words = buf.view('<u2')
+
+  in_func = numpy.zeros(nwords, dtype=bool)
+  for start, end in regular:
+    in_func[start // 2:(end + 1) // 2] = True
+  regular_starts = numpy.array([start for start, end in regular], dtype=numpy.int64)
+
+  lengths = lut_length[words]
+  is_long = lengths == 4
+
+  # Figure out which words are the start of an instruction. A word is
+  # the start of an instruction when it is preceded by an even number of
+  # long instruction words (counting from the start of the function),
+  # since a run of long instruction words is decoded as alternating
+  # first and second words.
+  index = numpy.arange(nwords)
+  run_break = ~is_long
+  func_starts = regular_starts[regular_starts > 0] // 2
+  run_break[func_starts - 1] = True
+  last_break = numpy.maximum.accumulate(numpy.where(run_break, index, -1))
+  preceding_longs = index - 1 - numpy.concatenate(([-1], last_break[:-1]))
+  is_start = in_func & (preceding_longs % 2 == 0)
+  profiling.count('instructions_decoded', int(numpy.count_nonzero(is_start)))
+
+  kinds = lut_kind[words]
+  positions = numpy.nonzero(is_start & (kinds != 0))[0]
+
+  kinds = kinds[positions]
+  call_addrs = positions * 2
+  ret_addrs = call_addrs + lengths[positions]
+  operands = lut_operand[words[positions]]
+  second = words[positions + 1].astype(numpy.int64)
+
+  callees = numpy.where(kinds == 1, (operands | second) * 2, call_addrs + (operands + 1) * 2)
+  # gcc uses rcall 0 instructions to set up the stack frame, these are
+  # not calls (see analyze_call).
+  keep = ~((kinds == 2) & (operands == 0))
+
+  calls = {}
+  for kind, call_addr, ret_addr, callee in zip(kinds[keep].tolist(), call_addrs[keep].tolist(),
+                                               ret_addrs[keep].tolist(), callees[keep].tolist()):
+    mnemonic = call_mnemonics[kind - 1]
+    if mnemonic == 'icall' or mnemonic == 'eicall':
+      callee = None
+    calls[ret_addr] = CallInfo(mnemonic=mnemonic, call_addr=call_addr, callee_addr=callee)
+
+  if not irregular:
+    return calls
+
+  # When functions are decoded in order, a call found in a later
+  # function overwrites one with the same return address in an earlier
+  # function (this can happen when a long instruction crosses the end
+  # of a function), so keep track of the function each call was found
+  # in.
+  owners = regular_starts[numpy.searchsorted(regular_starts, call_addrs[keep], 'right') - 1]
+  owner = dict(zip(ret_addrs[keep].tolist(), owners.tolist()))
+  for start, end in irregular:
+    found = {}
+    profiling.count('instructions_decoded', find_function_callsites(data, start, end, found))
+    for ret_addr, call in found.items():
+      if owner.get(ret_addr, -1) <= start:
+        calls[ret_addr] = call
+        owner[ret_addr] = start
+
+  return calls
+
+def decode_callsites(data, ranges):
+  """
+  Find the calls in the given (start, end) function ranges. Returns a
+  dictionary of calls, like find_function_callsites.
+  """
+  if numpy is not None:
+    return find_callsites_numpy(data, ranges)
+
+  calls = {}
+  for start, end in ranges:
+    profiling.count('instructions_decoded', find_function_callsites(data, start, end, calls))
+  return calls
+
+def split_callsites(calls, ranges):
+  """
+  Split a dictionary of calls into a list of (return address,
+  mnemonic, call address, callee address) tuples for each of the given
+  (start, end) function ranges.
+  """
+  found = sorted((call.call_addr, ret_addr, call.mnemonic, call.callee_addr)
+                 for ret_addr, call in calls.items())
+  call_addrs = [call_addr for call_addr, _, _, _ in found]
+  result = []
+  for start, end in ranges:
+    lo = bisect.bisect_left(call_addrs, start)
+    hi = bisect.bisect_left(call_addrs, end)
+    result.append([(ret_addr, mnemonic, call_addr, callee_addr)
+                   for call_addr, ret_addr, mnemonic, callee_addr in found[lo:hi]])
+  return result
+
+# I/O addresses of the stack pointer and status register
+SPL = 0x3d
+SPH = 0x3e
+SREG = 0x3f
+
+def io_register(word):
+  """ Return the I/O address operand of an in or out instruction. """
+  return (word & 0xf) | (word >> 5) & 0x30
+
+def analyze_prologue(data, start, end, addrlen):
+  """
+  Figure out the stack frame size of the function between start and end
+  from the prologue generated by gcc: Pushes of registers, optionally
+  followed by setting up the Y frame pointer and reserving space for
+  local variables by subtracting from it (using sbiw or subi/sbci) and
+  writing it to SP. Small frames can also be reserved using rcall .+0
+  (which pushes addrlen bytes) or push r0 instructions.
+
+  Returns a list of (address, size) tuples, meaning that once execution
+  reaches address, the frame (excluding the return address) is size
+  bytes. Returns None when the prologue modifies SP in an unknown way.
+  Other ways of setting up a frame (e.g. -mcall-prologues) are not
+  recognized and result in a frame that is too small.
+  """
+  steps = []
+  size = 0
+  # Amount subtracted from Y, once it was loaded from SP
+  frame_pointer = None
+  offset = start
+  while offset < end:
+    ins = decode_instruction(data, offset)
+    mnemonic = ins.info.mnemonic
+    word = read_word(data, offset)
+    reg = (word >> 4) & 0x1f
+    offset += ins.info.length
+
+    if mnemonic == 'push':
+      size += 1
+      steps.append((offset, size))
+    elif mnemonic == 'rcall' and word & 0xfff == 0:
+      # rcall .+0 (see analyze_call)
+      size += addrlen
+      steps.append((offset, size))
+    elif mnemonic == 'in' and reg in (28, 29) and io_register(word) in (SPL, SPH):
+      frame_pointer = 0
+    elif mnemonic == 'in' and reg == 0:
+      # Saving SREG (or RAMPZ etc. in an ISR)
+      pass
+    elif mnemonic in ('cli', 'eor') or (mnemonic == 'out' and io_register(word) in (SPH, SREG)):
+      # Disabling interrupts while writing SP, or clearing r1 in an ISR
+      pass
+    elif mnemonic == 'sbiw' and frame_pointer is not None and (word >> 4) & 0x3 == 2:
+      # sbiw r28, K
+      frame_pointer += (word & 0xf) | (word >> 2) & 0x30
+    elif mnemonic in ('subi', 'sbci') and frame_pointer is not None and 16 + (reg & 0xf) in (28, 29):
+      # subi r28, lo8(K) / sbci r29, hi8(K)
+      value = (word & 0xf) | (word >> 4) & 0xf0
+      frame_pointer += value << 8 if mnemonic == 'sbci' else value
+    elif mnemonic == 'out' and io_register(word) == SPL:
+      if frame_pointer is None:
+        return None
+      size += frame_pointer
+      steps.append((offset, size))
+      frame_pointer = None
+    else:
+      # End of the prologue
+      break
+  return steps
+
 class ArchAvr:
+  name = 'avr'
+
   def __init__(self, elf):
       # https://sourceware.org/git/gitweb.cgi?p=binutils-gdb.git;a=blob;f=include/elf/avr.h;h=70d750b8c7147501dfc6c9cc2c201028e970171e;hb=HEAD#l27
       # #define EF_AVR_MACH 0x7F
@@ -261,6 +575,22 @@ class ArchAvr:
       else:
         self.addrlen = 2
 
+      self.elf = elf
+      # Contents of the .text section, read on first use
+      self.text = None
+      # Function address -> analyze_prologue result
+      self.frame_layouts = {}
+      # cache.FunctionCache to reuse the calls found in unchanged
+      # functions, or None
+      self.function_cache = None
+
+  def get_data_regions(self, elf):
+    """
+    Return a sorted list of (start, end) tuples for data (rather than
+    code) in the .text section. AVR has no way to tell these apart.
+    """
+    return []
+
   def get_addrlen(self):
     """ Return the length of a return address on the stack. """
     return self.addrlen
@@ -274,33 +604,45 @@ class ArchAvr:
     Look through all code in the .text section and identify call
     instructions. Returns a dictionary that maps the return address (i.e.
     the instruction *after* the call instruction) for each call to the
-    CallInfo object.
+    CallInfo object. When the function_cache attribute is set, only
+    functions whose code is not in that cache are decoded.
     """
     text = elf.get_section_by_name('.text')
-    data = text.data()
-    calls = {}
+    data = sections.section_view(text)
+
+    ranges = [(sym['st_value'], sym['st_value'] + sym['st_size']) for sym in symdict.values()]
+    if self.function_cache is None:
+      return decode_callsites(data, ranges)
+
+    # The second word of a long instruction at the end of a function
+    # comes from past its end, so include it in the cache key as well
+    ends = dict(ranges)
+    functions = [(start, data[start:end + 2], 'avr') for start, end in ranges]
 
-    for sym in symdict.values():
-      offset = sym['st_value']
-      end = offset + sym['st_size']
-      while offset < end:
-        ins = decode_instruction(data, offset, call_only = True)
-        call = analyze_call(ins)
-        if call:
-          ret_addr = ins.addr + ins.info.length
-          calls[ret_addr] = call
-        offset += ins.info.length
+    def decode(missing):
+      missing_ranges = [(start, ends[start]) for start, code, mode in missing]
+      return split_callsites(decode_callsites(data, missing_ranges), missing_ranges)
+
+    calls = {}
+    # Absolute call instructions encode the callee address, rcall a
+    # relative offset
+    for function_calls in self.function_cache.callsites(functions, decode, absolute = ('call',)):
+      for ret_addr, mnemonic, call_addr, callee_addr in function_calls:
+        calls[ret_addr] = CallInfo(mnemonic=mnemonic, call_addr=call_addr, callee_addr=callee_addr)
     return calls
 
   def decode_ptr(self, bytestr):
     """
     Decode a given stack fragment of size addrlen into a return address.
     """
+    return pointers.decode_avr_ptr(bytestr)
 
-    wordptr = int.from_bytes(bytestr, byteorder = 'big')
-
-    # Memory contains word addresses, convert to byte addresses
-    return wordptr * 2
+  def decode_ptrs(self, data, first, step):
+    """
+    Vectorized version of decode_ptr, see pointers.decode_avr_ptrs.
+    Requires numpy.
+    """
+    return pointers.decode_avr_ptrs(data, first, step, self.addrlen)
 
   def sym_to_addr(self, sym):
     """
@@ -308,4 +650,99 @@ class ArchAvr:
     """
     return sym['st_value']
 
+  def data_addr(self, value):
+    """
+    Return the data memory address (as used in memory dumps) for the
+    given address of a data symbol, or None if it is not in RAM.
+    """
+    # The linker maps data memory at 0x800000 and eeprom at 0x810000
+    if 0x800000 <= value < 0x810000:
+      return value - 0x800000
+    return None
+
+  def frame_size(self, symbols, addr, pc):
+    """
+    Return the size of the stack frame (excluding the return address)
+    of the function containing addr, at the moment execution reached
+    pc. Returns None when this cannot be determined.
+    """
+    index = symbols.find(addr)
+    if index < 0:
+      return None
+    start = symbols.starts[index]
+    end = symbols.ends[index]
+
+    if start not in self.frame_layouts:
+      if self.text is None:
+        self.text = sections.section_view(self.elf.get_section_by_name('.text'))
+      self.frame_layouts[start] = analyze_prologue(self.text, start, end, self.addrlen)
+    steps = self.frame_layouts[start]
+    if steps is None:
+      return None
+
+    size = 0
+    for step_addr, step_size in steps:
+      if step_addr > pc:
+        break
+      size = step_size
+    return size
+
+  def unwind(self, symbols, callsites, memory, sp, isr_ret):
+    """
+    Find the return addresses on the stack by following the chain of
+    stack frames, using the frame sizes from the function prologues.
+    Unlike find_stack_frames, this only looks at a single return address
+    for each frame. When a frame size is unknown or wrong (i.e. does not
+    point to a valid return address), this falls back to scanning the
+    stack for the next valid return address. Returns an UnwoundFrames
+    list of (stack address, CallInfo) tuples.
+    """
+    addrlen = self.addrlen
+    frames = UnwoundFrames()
+    for start, end in memory.segments():
+      data = memory.gets(start, end - start)
+      first = start
+      if sp is not None and first < sp:
+        first = sp
+
+      def ptr_at(slot):
+        if slot is None or slot + addrlen > end:
+          return None
+        return self.decode_ptr(data[slot - start:slot - start + addrlen])
+
+      def scan(slot, match):
+        profiling.count('unwind_scans')
+        while slot + addrlen <= end:
+          if match(ptr_at(slot)):
+            return slot
+          slot += 1
+        return None
+
+      # Where to start scanning when a frame size turns out to be wrong
+      resume = first
+      slot = None
+      if isr_ret is not None:
+        # The ISR frame is not known, but its return address is
+        isr_slot = scan(first, lambda ptr: ptr == isr_ret)
+        if isr_slot is not None:
+          resume = isr_slot + addrlen
+          size = self.frame_size(symbols, isr_ret, isr_ret)
+          if size is not None:
+            slot = resume + size
+
+      while True:
+        call = callsites.get(ptr_at(slot))
+        if call is None:
+          slot = scan(resume, lambda ptr: ptr in callsites)
+          if slot is None:
+            break
+          call = callsites[ptr_at(slot)]
+          frames.scanned.add(slot)
+
+        frames.append((slot, call))
+        resume = slot + addrlen
+        size = self.frame_size(symbols, call.call_addr, ptr_at(slot))
+        slot = resume + size if size is not None else None
+    return frames
+
 __all__ = ('ArchAvr',)
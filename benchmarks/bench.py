@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+from collections import OrderedDict
+
+# The analyzer modules live in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthelf
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+# Benchmark scenarios: the program generator, its default size
+# parameters and the RAM area (start, size) to generate a dump for.
+scenarios = OrderedDict([
+  ('avr5', (lambda **kwargs: synthelf.avr_program(avr6 = False, **kwargs),
+            dict(functions = 1500, text_size = 100 << 10, rows = 30000), (0x0200, 8 << 10))),
+  ('avr6', (lambda **kwargs: synthelf.avr_program(avr6 = True, **kwargs),
+            dict(functions = 3000, text_size = 240 << 10, rows = 60000), (0x0200, 8 << 10))),
+  ('arm', (synthelf.arm_program,
+           dict(functions = 4000, text_size = 400 << 10, rows = 60000), (0x20000000, 192 << 10))),
+])
+
+def timed(repeat, func, *args):
+  """
+  Run func repeat times, returning the result of the last run and the
+  shortest time taken.
+  """
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return result, best
+
+def decode_all(data, symdict):
+  """ Decode all functions one instruction at a time (AVR only). """
+  import avr
+  for sym in symdict.values():
+    avr.find_function_callsites(data, sym['st_value'], sym['st_value'] + sym['st_size'], {})
+
+def run_scenario(name, params, repeat, save_dir):
+  """
+  Generate the program and dump for a scenario and time each phase of
+  analyzing them. Returns an (OrderedDict of phase -> seconds, list of
+  errors) tuple.
+  """
+  import main
+  import dwarf
+  import sections
+
+  generate, defaults, (ram_start, ram_size) = scenarios[name]
+  program = generate(**params)
+  dump = synthelf.stack_dump(program, ram_start, ram_size)
+
+  if save_dir:
+    os.makedirs(save_dir, exist_ok = True)
+  directory = save_dir or tempfile.mkdtemp()
+  elf_path = os.path.join(directory, name + '.elf')
+  with open(elf_path, 'wb') as f:
+    f.write(program.elf)
+  if save_dir:
+    dump.hex.write_hex_file(os.path.join(directory, name + '.hex'))
+
+  times = OrderedDict()
+  errors = []
+  # Keep informational messages of the analyzer out of the results
+  with contextlib.redirect_stdout(io.StringIO()):
+    (elf, arch), times['open_elf'] = timed(repeat, main.open_elf, elf_path)
+    addr_to_line, times['line_table'] = timed(repeat, dwarf.get_addr_to_line_map, elf)
+    (symdict, skipped), times['symtab'] = timed(repeat, main.process_symtab, elf, arch)
+    if program.arch != 'arm':
+      data = sections.section_view(elf.get_section_by_name('.text'))
+      _, times['decode_instruction'] = timed(repeat, decode_all, data, symdict)
+    callsites, times['callsites'] = timed(repeat, arch.find_callsites, elf, symdict)
+    frames, times['stack_scan'] = timed(repeat, main.find_stack_frames, callsites, dump.hex, arch, None, arch.get_alignment())
+
+  # Check the results, a faster but wrong analysis is no improvement
+  found = {ret_addr: (call.mnemonic, call.call_addr) for ret_addr, call in callsites.items()}
+  expected = {ret_addr: call[:2] for ret_addr, call in program.calls.items()}
+  if found != expected:
+    errors.append("{} callsites found, {} expected ({} differ)".format(
+      len(found), len(expected), len(set(found.items()) ^ set(expected.items()))))
+  frame_addrs = set(addr for addr, call in frames)
+  missing = [addr for addr, ret_addr in dump.planted if addr not in frame_addrs]
+  if missing:
+    errors.append("{} of {} planted return addresses not found".format(len(missing), len(dump.planted)))
+  if len(addr_to_line) == 0:
+    errors.append("No line info decoded")
+
+  if not save_dir:
+    os.unlink(elf_path)
+    os.rmdir(directory)
+  return times, errors
+
+def machine_description():
+  """
+  Return a description of this machine, to tell whether baselines were
+  measured on it.
+  """
+  cpu = platform.processor()
+  try:
+    with open('/proc/cpuinfo') as f:
+      for line in f:
+        if line.startswith('model name'):
+          cpu = line.split(':', 1)[1].strip()
+          break
+  except OSError:
+    pass
+  return "{}, {} CPUs, {} {}".format(cpu or platform.machine(), os.cpu_count(),
+                                     platform.python_implementation(), platform.python_version())
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Benchmark the analysis of synthetic elf files and memory dumps')
+  parser.add_argument('--scenario', action='append', choices=list(scenarios), help='Scenario to run (can be given multiple times, default: all)')
+  parser.add_argument('--repeat', type=int, default=3, help='Number of times to run each phase, the fastest run counts (default: 3)')
+  parser.add_argument('--scale', type=float, default=1.0, help='Multiply the number of functions, code size and line rows by this factor')
+  parser.add_argument('--functions', type=int, help='Number of functions to generate')
+  parser.add_argument('--text-size', type=int, help='Approximate size of the generated code in bytes')
+  parser.add_argument('--line-rows', type=int, help='Approximate number of DWARF line rows to generate')
+  parser.add_argument('--tolerance', type=float, default=0.5, help='Report phases that are slower than the baseline by more than this fraction (default: 0.5)')
+  parser.add_argument('--update-baselines', action='store_true', help='Store the results as the new baselines')
+  parser.add_argument('--json', help='Write the results as JSON to the given file', metavar='FILE')
+  parser.add_argument('--save', help='Keep the generated elf and hex files in the given directory', metavar='DIR')
+  args = parser.parse_args()
+
+  overridden = args.scale != 1.0 or args.functions or args.text_size or args.line_rows
+  if overridden and args.update_baselines:
+    sys.stderr.write("Baselines can only be updated using the default sizes\n")
+    sys.exit(1)
+
+  machine = machine_description()
+  baselines = {}
+  if os.path.exists(BASELINES):
+    with open(BASELINES) as f:
+      baselines = json.load(f)
+  # Timings from another machine are shown, but cannot fail the benchmark
+  same_machine = baselines.get('machine') == machine
+  if baselines and not same_machine and not args.update_baselines:
+    print("Baselines were measured on another machine ({}), run with "
+          "--update-baselines to measure them on this one\n".format(baselines.get('machine', 'unknown')))
+
+  results = OrderedDict()
+  failed = False
+  for name in args.scenario or scenarios:
+    params = {key: int(value * args.scale) for key, value in scenarios[name][1].items()}
+    if args.functions:
+      params['functions'] = args.functions
+    if args.text_size:
+      params['text_size'] = args.text_size
+    if args.line_rows:
+      params['rows'] = args.line_rows
+
+    times, errors = run_scenario(name, params, args.repeat, args.save)
+    results[name] = OrderedDict((phase, round(elapsed, 6)) for phase, elapsed in times.items())
+
+    print("{} ({}):".format(name, ', '.join('{}={}'.format(key, value) for key, value in params.items())))
+    for phase, elapsed in times.items():
+      line = "  {:<20} {:>9.4f}s".format(phase, elapsed)
+      baseline = baselines.get('timings', {}).get(name, {}).get(phase)
+      if baseline and not overridden:
+        ratio = elapsed / baseline
+        line += "  baseline {:>9.4f}s  {:>5.2f}x".format(baseline, ratio)
+        # Ignore differences that are too small to measure reliably
+        if ratio > 1 + args.tolerance and elapsed - baseline > 0.005:
+          line += "  SLOWER"
+          failed = failed or same_machine
+      print(line)
+    for error in errors:
+      print("  ERROR: {}".format(error))
+      failed = True
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(results, f, indent = 2)
+
+  if args.update_baselines:
+    if not same_machine:
+      baselines = {'machine': machine, 'timings': {}}
+    baselines['timings'].update(results)
+    with open(BASELINES, 'w') as f:
+      json.dump(baselines, f, indent = 2, sort_keys = True)
+      f.write('\n')
+
+  sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,467 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import random
+import struct
+from collections import namedtuple
+
+# Generators for synthetic elf files and matching memory dumps, used by
+# the benchmarks. The elf files contain just enough to be analyzed: a
+# .text section with plausible code, a symbol table and DWARF line
+# number info.
+
+EM_ARM = 40
+EM_AVR = 83
+
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+SHT_ARM_ATTRIBUTES = 0x70000003
+
+SHF_WRITE = 0x1
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+
+STT_NOTYPE = 0
+STT_OBJECT = 1
+STT_FUNC = 2
+STB_LOCAL = 0
+STB_GLOBAL = 1
+
+# Lines in a function are spread over this many source files (one per
+# compilation unit)
+FUNCTIONS_PER_CU = 50
+
+# The result of generating a program. calls maps the return address of
+# every generated call instruction to its (mnemonic, call address, callee
+# address or None) tuple.
+Program = namedtuple('Program', ['arch', 'elf', 'text_start', 'text_size', 'functions', 'calls', 'addrlen'])
+# The result of generating a memory dump. planted is a list of (stack
+# address, return address) tuples.
+Dump = namedtuple('Dump', ['hex', 'start', 'size', 'planted'])
+
+def uleb128(value):
+  result = bytearray()
+  while True:
+    byte = value & 0x7f
+    value >>= 7
+    if value:
+      result.append(byte | 0x80)
+    else:
+      result.append(byte)
+      return bytes(result)
+
+def sleb128(value):
+  result = bytearray()
+  while True:
+    byte = value & 0x7f
+    value >>= 7
+    if (value == 0 and not byte & 0x40) or (value == -1 and byte & 0x40):
+      result.append(byte)
+      return bytes(result)
+    result.append(byte | 0x80)
+
+class StringTable:
+  """ Builds an elf string table section. """
+  def __init__(self):
+    self.data = bytearray(b'\0')
+    self.offsets = {}
+
+  def add(self, name):
+    if name not in self.offsets:
+      self.offsets[name] = len(self.data)
+      self.data += name.encode('ascii') + b'\0'
+    return self.offsets[name]
+
+def build_elf(machine, flags, sections, symbols):
+  """
+  Build a 32-bit little-endian ET_EXEC elf file. sections is a list of
+  (name, type, flags, addr, data) tuples, symbols a list of (name,
+  value, size, type, bind, section index) tuples, where the section
+  index counts from 1 for the first of the given sections. Returns the
+  file contents.
+  """
+  shstrtab = StringTable()
+  strtab = StringTable()
+
+  # Local symbols must come first
+  symbols = sorted(symbols, key = lambda sym: sym[4] != STB_LOCAL)
+  first_global = 1 + sum(1 for sym in symbols if sym[4] == STB_LOCAL)
+  symtab = bytearray(16)
+  for name, value, size, type, bind, shndx in symbols:
+    symtab += struct.pack('<IIIBBH', strtab.add(name), value, size, (bind << 4) | type, 0, shndx)
+
+  symtab_index = len(sections) + 1
+  # (name, type, flags, addr, data, link, info, align, entsize)
+  headers = [(name, type, sh_flags, addr, data, 0, 0, 1, 0) for name, type, sh_flags, addr, data in sections]
+  headers.append(('.symtab', SHT_SYMTAB, 0, 0, bytes(symtab), symtab_index + 1, first_global, 4, 16))
+  headers.append(('.strtab', SHT_STRTAB, 0, 0, bytes(strtab.data), 0, 0, 1, 0))
+  for header in headers:
+    shstrtab.add(header[0])
+  shstrtab.add('.shstrtab')
+  headers.append(('.shstrtab', SHT_STRTAB, 0, 0, bytes(shstrtab.data), 0, 0, 1, 0))
+
+  contents = bytearray(52)
+  section_headers = bytearray(40)
+  for name, type, sh_flags, addr, data, link, info, align, entsize in headers:
+    contents += bytes(-len(contents) % 4)
+    section_headers += struct.pack('<10I', shstrtab.add(name), type, sh_flags, addr, len(contents),
+                                   len(data), link, info, align, entsize)
+    contents += data
+
+  contents += bytes(-len(contents) % 4)
+  shoff = len(contents)
+  contents += section_headers
+
+  ident = b'\x7fELF' + bytes([1, 1, 1]) + bytes(9)
+  contents[:52] = ident + struct.pack('<HHIIIIIHHHHHH', 2, machine, 1, 0, 0, shoff, flags,
+                                      52, 32, 0, 40, len(headers) + 1, len(headers))
+  return bytes(contents)
+
+def build_line_program(filename, ranges, rows, address_size):
+  """
+  Build a DWARF 2 line program unit for a single file, with a sequence
+  for each of the given (start, end) address ranges. rows is a sorted
+  list of (address, line) tuples, each range must start with a row.
+  """
+  addr_format = '<I' if address_size == 4 else '<H'
+  # Header fields after header_length: minimum_instruction_length,
+  # default_is_stmt, line_base, line_range, opcode_base and the
+  # standard opcode lengths, followed by the (empty) include directory
+  # and file name tables.
+  header = struct.pack('<BBbBB', 1, 1, -5, 14, 13) + bytes([0, 1, 1, 1, 1, 0, 0, 0, 1, 0, 0, 1])
+  header += b'\0' + filename.encode('ascii') + b'\0' + bytes([0, 0, 0]) + b'\0'
+
+  DW_LNS_copy, DW_LNS_advance_pc, DW_LNS_advance_line = 1, 2, 3
+  DW_LNE_end_sequence, DW_LNE_set_address = 1, 2
+  program = bytearray()
+  for start, end in ranges:
+    program += b'\0' + uleb128(1 + address_size) + bytes([DW_LNE_set_address]) + struct.pack(addr_format, start)
+    address, lineno = start, 1
+    for row_address, row_line in rows:
+      if not start <= row_address < end:
+        continue
+      if row_address != address:
+        program += bytes([DW_LNS_advance_pc]) + uleb128(row_address - address)
+      if row_line != lineno:
+        program += bytes([DW_LNS_advance_line]) + sleb128(row_line - lineno)
+      program += bytes([DW_LNS_copy])
+      address, lineno = row_address, row_line
+    program += bytes([DW_LNS_advance_pc]) + uleb128(end - address)
+    program += bytes([0, 1, DW_LNE_end_sequence])
+
+  unit = struct.pack('<HI', 2, len(header)) + header + program
+  return struct.pack('<I', len(unit)) + unit
+
+def build_dwarf(cus, address_size = 4):
+  """
+  Build minimal DWARF 2 .debug_info, .debug_abbrev and .debug_line
+  section contents. cus is a list of (filename, low_pc, high_pc, rows)
+  tuples, where rows is a sorted list of (address, line) tuples.
+  """
+  DW_TAG_compile_unit = 0x11
+  DW_AT_name, DW_AT_stmt_list, DW_AT_low_pc, DW_AT_high_pc = 0x03, 0x10, 0x11, 0x12
+  DW_FORM_addr, DW_FORM_data4, DW_FORM_string = 0x01, 0x06, 0x08
+
+  abbrev = bytes([1, DW_TAG_compile_unit, 0,
+                  DW_AT_name, DW_FORM_string, DW_AT_stmt_list, DW_FORM_data4,
+                  DW_AT_low_pc, DW_FORM_addr, DW_AT_high_pc, DW_FORM_addr, 0, 0, 0])
+  addr_format = '<I' if address_size == 4 else '<H'
+
+  info = bytearray()
+  line = bytearray()
+  for filename, low_pc, high_pc, rows in cus:
+    die = (uleb128(1) + filename.encode('ascii') + b'\0' + struct.pack('<I', len(line)) +
+           struct.pack(addr_format, low_pc) + struct.pack(addr_format, high_pc))
+    unit = struct.pack('<HIB', 2, 0, address_size) + die
+    info += struct.pack('<I', len(unit)) + unit
+    line += build_line_program(filename, [(rows[0][0], high_pc)], rows, address_size)
+
+  return bytes(info), abbrev, bytes(line)
+
+def build_dwarf5(cus, address_size = 4):
+  """
+  Build minimal DWARF 5 .debug_info, .debug_abbrev, .debug_line and
+  .debug_rnglists section contents, where each CU lists the address
+  ranges it covers in .debug_rnglists (like gcc does for code in
+  multiple sections, e.g. with -ffunction-sections). cus is a list of
+  (filename, ranges, rows) tuples, where ranges is a list of (start,
+  end) tuples and rows is a sorted list of (address, line) tuples. The
+  line programs use DWARF 2.
+  """
+  DW_TAG_compile_unit = 0x11
+  DW_AT_name, DW_AT_stmt_list, DW_AT_ranges = 0x03, 0x10, 0x55
+  DW_FORM_string, DW_FORM_sec_offset = 0x08, 0x17
+  DW_UT_compile = 0x01
+  DW_RLE_end_of_list, DW_RLE_start_length = 0x00, 0x07
+
+  abbrev = bytes([1, DW_TAG_compile_unit, 0,
+                  DW_AT_name, DW_FORM_string, DW_AT_stmt_list, DW_FORM_sec_offset,
+                  DW_AT_ranges, DW_FORM_sec_offset, 0, 0, 0])
+  addr_format = '<I' if address_size == 4 else '<H'
+
+  info = bytearray()
+  line = bytearray()
+  lists = bytearray()
+  # Offsets are relative to the start of the section, i.e. include the
+  # 12-byte header (without an offset table)
+  lists_start = 12
+  for filename, ranges, rows in cus:
+    die = (uleb128(1) + filename.encode('ascii') + b'\0' + struct.pack('<I', len(line)) +
+           struct.pack('<I', lists_start + len(lists)))
+    unit = struct.pack('<HBBI', 5, DW_UT_compile, address_size, 0) + die
+    info += struct.pack('<I', len(unit)) + unit
+    line += build_line_program(filename, ranges, rows, address_size)
+    for start, end in ranges:
+      lists += bytes([DW_RLE_start_length]) + struct.pack(addr_format, start) + uleb128(end - start)
+    lists += bytes([DW_RLE_end_of_list])
+
+  rnglists = struct.pack('<HBBI', 5, address_size, 0, 0) + lists
+  rnglists = struct.pack('<I', len(rnglists)) + rnglists
+  return bytes(info), abbrev, bytes(line), rnglists
+
+def line_rows(rng, functions, line_rows, step):
+  """
+  Spread approximately line_rows rows over the given (start, size)
+  functions, at addresses that are multiples of step. Returns a list of
+  (filename, low_pc, high_pc, rows) tuples for build_dwarf.
+  """
+  per_function = max(1, line_rows // max(1, len(functions)))
+  cus = []
+  for first in range(0, len(functions), FUNCTIONS_PER_CU):
+    chunk = functions[first:first + FUNCTIONS_PER_CU]
+    rows = []
+    line = 1
+    for start, size in chunk:
+      offsets = sorted(set([0] + [rng.randrange(0, size, step) for _ in range(per_function - 1)]))
+      for offset in offsets:
+        line += rng.randrange(1, 4)
+        rows.append((start + offset, line))
+    low_pc = chunk[0][0]
+    high_pc = chunk[-1][0] + chunk[-1][1]
+    cus.append(("cu{}.c".format(len(cus)), low_pc, high_pc, rows))
+  return cus
+
+def function_sizes(rng, functions, text_size, align):
+  """ Return a list of random function sizes, averaging text_size. """
+  average = max(8, text_size // max(1, functions))
+  return [max(8, rng.randrange(average // 2, average * 3 // 2)) // align * align for _ in range(functions)]
+
+def avr_program(functions = 1000, text_size = 64 << 10, rows = 20000, avr6 = False, seed = 1):
+  """
+  Generate an AVR program (avr5 with 2-byte return addresses, or avr6
+  with 3-byte return addresses when avr6 is True).
+  """
+  rng = random.Random(seed)
+  # Leave room for the vector table (which is not part of any function)
+  text_start = 0
+  offset = 0x100
+  layout = []
+  for size in function_sizes(rng, functions, text_size, 2):
+    layout.append((offset, size))
+    offset += size
+  text = bytearray(offset)
+  calls = {}
+
+  for start, size in layout:
+    words = []
+    end = start + size - 2
+    while start + len(words) * 2 < end:
+      addr = start + len(words) * 2
+      room = (end - addr) // 2
+      kind = rng.random()
+      if kind < 0.08 and room >= 2:
+        # call k
+        callee = rng.choice(layout)[0]
+        k = callee // 2
+        words += [0x940e | ((k >> 17) & 0x1f) << 4 | (k >> 16) & 1, k & 0xffff]
+        calls[addr + 4] = ('call', addr, callee)
+      elif kind < 0.12:
+        # rcall k, relative to the next instruction. rcall 0 is used by
+        # gcc to set up a stack frame and is not a call.
+        k = rng.randrange(-2048, 2048)
+        words.append(0xd000 | k & 0xfff)
+        if k != 0:
+          calls[addr + 2] = ('rcall', addr, addr + (k + 1) * 2)
+      elif kind < 0.13:
+        if avr6 and rng.random() < 0.5:
+          words.append(0x9519)
+          calls[addr + 2] = ('eicall', addr, None)
+        else:
+          words.append(0x9509)
+          calls[addr + 2] = ('icall', addr, None)
+      elif kind < 0.2 and room >= 2:
+        # lds Rd, k (a long instruction that is not a call)
+        words += [0x9000 | rng.randrange(32) << 4, rng.randrange(0x10000)]
+      elif kind < 0.5:
+        # ldi Rd, K
+        K = rng.randrange(256)
+        words.append(0xe000 | (K & 0xf0) << 4 | rng.randrange(16) << 4 | K & 0xf)
+      elif kind < 0.6:
+        # push/pop Rd
+        words.append(rng.choice((0x920f, 0x900f)) | rng.randrange(32) << 4)
+      else:
+        # add Rd, Rr
+        words.append(0x0c00 | rng.randrange(0x400))
+    # ret
+    words.append(0x9508)
+    struct.pack_into('<{}H'.format(len(words)), text, start, *words)
+
+  info, abbrev, line = build_dwarf(line_rows(rng, layout, rows, 2))
+  sections = [
+    ('.text', SHT_PROGBITS, SHF_ALLOC | SHF_EXECINSTR, text_start, bytes(text)),
+    ('.debug_info', SHT_PROGBITS, 0, 0, info),
+    ('.debug_abbrev', SHT_PROGBITS, 0, 0, abbrev),
+    ('.debug_line', SHT_PROGBITS, 0, 0, line),
+  ]
+  symbols = [("func{}".format(i), start, size, STT_FUNC, STB_GLOBAL, 1)
+             for i, (start, size) in enumerate(layout)]
+  elf = build_elf(EM_AVR, 6 if avr6 else 5, sections, symbols)
+  return Program('avr6' if avr6 else 'avr5', elf, text_start, len(text), layout, calls, 3 if avr6 else 2)
+
+def thumb_bl(addr, target):
+  """ Encode a Thumb-2 bl instruction as two halfwords. """
+  offset = ((target - addr - 4) >> 1) & 0xffffff
+  s = offset >> 23
+  i1 = (offset >> 22) & 1
+  i2 = (offset >> 21) & 1
+  j1 = (i1 ^ 1) ^ s
+  j2 = (i2 ^ 1) ^ s
+  return [0xf000 | s << 10 | (offset >> 11) & 0x3ff, 0xd000 | j1 << 13 | j2 << 11 | offset & 0x7ff]
+
+def arm_attributes():
+  """ Return the contents of an .ARM.attributes section for a Cortex-M4. """
+  # Tag_CPU_arch = ARM v7E-M
+  attrs = b'\x06\x0d'
+  subsubsection = b'\x01' + struct.pack('<I', 5 + len(attrs)) + attrs
+  subsection = b'aeabi\0' + subsubsection
+  return b'A' + struct.pack('<I', 4 + len(subsection)) + subsection
+
+def arm_program(functions = 4000, text_size = 400 << 10, rows = 50000, seed = 1):
+  """
+  Generate an ARM (Cortex-M4, Thumb) program, where most functions end
+  in a literal pool that is marked using mapping symbols.
+  """
+  rng = random.Random(seed)
+  text_start = 0x08000000
+  offset = 0x200
+  layout = []
+  for size in function_sizes(rng, functions, text_size, 4):
+    layout.append((text_start + offset, size))
+    offset += size
+  text = bytearray(offset)
+  calls = {}
+  symbols = []
+
+  for i, (start, size) in enumerate(layout):
+    end = start + size
+    pool = rng.randrange(0, min(5, size // 8)) * 4
+    code_end = end - pool
+    symbols.append(("func{}".format(i), start | 1, size, STT_FUNC, STB_GLOBAL, 1))
+    symbols.append(("$t", start, 0, STT_NOTYPE, STB_LOCAL, 1))
+
+    # push {r4, lr}
+    halfwords = [0xb510]
+    while start + len(halfwords) * 2 < code_end - 2:
+      addr = start + len(halfwords) * 2
+      room = (code_end - 2 - addr) // 2
+      kind = rng.random()
+      if kind < 0.08 and room >= 2:
+        callee = rng.choice(layout)[0]
+        halfwords += thumb_bl(addr, callee)
+        calls[addr + 4] = ('bl', addr, callee)
+      elif kind < 0.1:
+        # blx r3
+        halfwords.append(0x4798)
+        calls[addr + 2] = ('blx', addr, None)
+      elif kind < 0.2 and pool and code_end - addr < 1000:
+        # ldr r0, [pc, #imm] from the literal pool
+        pool_offset = code_end + rng.randrange(0, pool, 4) - ((addr + 4) & ~3)
+        halfwords.append(0x4800 | pool_offset // 4)
+      elif kind < 0.5:
+        # movs rN, #imm
+        halfwords.append(0x2000 | rng.randrange(8) << 8 | rng.randrange(256))
+      elif kind < 0.6:
+        # nop
+        halfwords.append(0xbf00)
+      else:
+        # adds rD, rN, rM
+        halfwords.append(0x1800 | rng.randrange(0x200))
+    # pop {r4, pc}
+    halfwords.append(0xbd10)
+    struct.pack_into('<{}H'.format(len(halfwords)), text, start - text_start, *halfwords)
+
+    if pool:
+      # Random data, which might well look like instructions
+      text[code_end - text_start:end - text_start] = bytes(rng.randrange(256) for _ in range(pool))
+      symbols.append(("$d", code_end, 0, STT_NOTYPE, STB_LOCAL, 1))
+
+  info, abbrev, line = build_dwarf(line_rows(rng, layout, rows, 2))
+  sections = [
+    ('.text', SHT_PROGBITS, SHF_ALLOC | SHF_EXECINSTR, text_start, bytes(text)),
+    ('.ARM.attributes', SHT_ARM_ATTRIBUTES, 0, 0, arm_attributes()),
+    ('.debug_info', SHT_PROGBITS, 0, 0, info),
+    ('.debug_abbrev', SHT_PROGBITS, 0, 0, abbrev),
+    ('.debug_line', SHT_PROGBITS, 0, 0, line),
+  ]
+  elf = build_elf(EM_ARM, 0x05000000, sections, symbols)
+  return Program('arm', elf, text_start, len(text), layout, calls, 4)
+
+def stack_dump(program, start, size, frames = 32, seed = 1):
+  """
+  Generate an Intel hex memory dump of size bytes of random data, with
+  return addresses of random calls in program planted in it. Returns a
+  Dump, whose hex attribute is an IntelHex object.
+  """
+  from intelhex import IntelHex
+
+  rng = random.Random(seed)
+  data = bytearray(rng.randrange(256) for _ in range(size))
+  addrlen = program.addrlen
+  ret_addrs = sorted(program.calls)
+  planted = []
+  # Use distinct, aligned slots, so planted addresses do not overlap
+  slots = sorted(rng.sample(range(size // addrlen), min(frames, size // addrlen)))
+  for slot in slots:
+    ret_addr = rng.choice(ret_addrs)
+    if program.arch == 'arm':
+      # Thumb return addresses have the LSB set
+      encoded = (ret_addr | 1).to_bytes(4, 'little')
+    else:
+      # AVR return addresses are big-endian word addresses
+      encoded = (ret_addr // 2).to_bytes(addrlen, 'big')
+    data[slot * addrlen:(slot + 1) * addrlen] = encoded
+    planted.append((start + slot * addrlen, ret_addr))
+
+  ih = IntelHex()
+  ih.frombytes(bytes(data), offset = start)
+  return Dump(ih, start, size, planted)
+
+__all__ = ('Program', 'Dump', 'avr_program', 'arm_program', 'stack_dump', 'build_elf', 'build_dwarf', 'build_dwarf5')
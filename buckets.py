@@ -0,0 +1,166 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import json
+import sqlite3
+import hashlib
+
+# Bump this whenever the layout or meaning of the database changes
+SCHEMA_VERSION = 1
+
+# Number of example dumps remembered for each bucket
+MAX_EXAMPLES = 3
+
+class BucketError(Exception):
+  pass
+
+def signature_id(signature):
+  """ Return a short, stable identifier for the given signature. """
+  return hashlib.sha1('\n'.join(signature).encode('utf8')).hexdigest()[:12]
+
+class BucketIndex:
+  """
+  On-disk (SQLite) index of crash signatures, counting how many dumps
+  share each signature (i.e. fall in the same bucket), when these were
+  first and last seen and a few example dumps. Every dump added is
+  remembered (by path, modification time and size), so a collection of
+  dumps can be indexed incrementally, only processing new dumps.
+
+  Signatures depend on the options used to generate them, so these are
+  stored in the index as well, and opening an index with different
+  options raises BucketError.
+  """
+  def __init__(self, path, options):
+    options = json.dumps(options, sort_keys = True)
+    try:
+      self.db = sqlite3.connect(path)
+      self.create_tables()
+      meta = dict(self.db.execute('SELECT key, value FROM meta'))
+    except sqlite3.DatabaseError as e:
+      raise BucketError("Cannot open bucket index {}: {}".format(path, e))
+
+    if not meta:
+      with self.db:
+        self.db.executemany('INSERT INTO meta VALUES (?, ?)',
+                            [('version', str(SCHEMA_VERSION)), ('options', options)])
+    elif meta.get('version') != str(SCHEMA_VERSION):
+      raise BucketError("Unsupported bucket index version {} (expected {})".format(meta.get('version'), SCHEMA_VERSION))
+    elif meta.get('options') != options:
+      raise BucketError("Bucket index was created with different signature options: {}".format(meta.get('options')))
+
+  def create_tables(self):
+    self.db.executescript('''
+      CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+      CREATE TABLE IF NOT EXISTS buckets (
+        id TEXT PRIMARY KEY, signature TEXT, count INTEGER,
+        first_seen REAL, last_seen REAL);
+      CREATE INDEX IF NOT EXISTS buckets_count ON buckets (count);
+      CREATE TABLE IF NOT EXISTS examples (bucket TEXT, path TEXT);
+      CREATE INDEX IF NOT EXISTS examples_bucket ON examples (bucket);
+      CREATE TABLE IF NOT EXISTS dumps (
+        path TEXT PRIMARY KEY, mtime REAL, size INTEGER, bucket TEXT);
+    ''')
+
+  def close(self):
+    self.db.close()
+
+  def is_indexed(self, path, mtime, size):
+    """ Return whether the given version of a dump was added already. """
+    row = self.db.execute('SELECT mtime, size FROM dumps WHERE path = ?', (path,)).fetchone()
+    return row is not None and row[0] == mtime and row[1] == size
+
+  def add(self, path, mtime, size, signature):
+    """
+    Add a dump with the given signature (a list of strings, or None
+    when the dump could not be read) seen at time mtime. A dump that
+    was added before (with a different mtime or size) is moved out of
+    its old bucket. Changes are only committed by commit().
+    """
+    old = self.db.execute('SELECT bucket FROM dumps WHERE path = ?', (path,)).fetchone()
+    if old is not None and old[0] is not None:
+      self.remove_from_bucket(path, old[0])
+
+    bucket = None
+    if signature is not None:
+      bucket = signature_id(signature)
+      # first_seen and last_seen are NULL when all dumps moved out
+      updated = self.db.execute('''
+        UPDATE buckets SET count = count + 1, first_seen = min(coalesce(first_seen, ?), ?),
+                           last_seen = max(coalesce(last_seen, ?), ?)
+        WHERE id = ?''', (mtime, mtime, mtime, mtime, bucket)).rowcount
+      if not updated:
+        self.db.execute('INSERT INTO buckets VALUES (?, ?, 1, ?, ?)',
+                        (bucket, '\n'.join(signature), mtime, mtime))
+      examples = self.db.execute('SELECT count(*) FROM examples WHERE bucket = ?', (bucket,)).fetchone()[0]
+      if examples < MAX_EXAMPLES:
+        self.db.execute('INSERT INTO examples VALUES (?, ?)', (bucket, path))
+    self.db.execute('INSERT OR REPLACE INTO dumps VALUES (?, ?, ?, ?)', (path, mtime, size, bucket))
+
+  def remove_from_bucket(self, path, bucket):
+    """
+    Remove a dump from the given bucket, updating its count, first and
+    last seen times from the remaining dumps and replacing the dump in
+    its examples.
+    """
+    self.db.execute('''
+      UPDATE buckets SET count = count - 1,
+        first_seen = (SELECT min(mtime) FROM dumps WHERE bucket = :bucket AND path != :path),
+        last_seen = (SELECT max(mtime) FROM dumps WHERE bucket = :bucket AND path != :path)
+      WHERE id = :bucket''', {'bucket': bucket, 'path': path})
+    removed = self.db.execute('DELETE FROM examples WHERE bucket = ? AND path = ?', (bucket, path)).rowcount
+    if removed:
+      self.db.execute('''
+        INSERT INTO examples SELECT bucket, path FROM dumps
+        WHERE bucket = :bucket AND path != :path
+          AND path NOT IN (SELECT path FROM examples WHERE bucket = :bucket)
+        ORDER BY mtime LIMIT :limit''', {'bucket': bucket, 'path': path, 'limit': removed})
+
+  def commit(self):
+    self.db.commit()
+
+  def totals(self):
+    """ Return a (buckets, dumps, unreadable dumps) tuple. """
+    buckets, dumps = self.db.execute('SELECT count(*), coalesce(sum(count), 0) FROM buckets WHERE count > 0').fetchone()
+    unreadable = self.db.execute('SELECT count(*) FROM dumps WHERE bucket IS NULL').fetchone()[0]
+    return buckets, dumps, unreadable
+
+  def top(self, limit):
+    """
+    Yields (id, signature, count, first seen, last seen, examples)
+    tuples for the limit biggest buckets, biggest first.
+    """
+    rows = self.db.execute('''
+      SELECT id, signature, count, first_seen, last_seen FROM buckets WHERE count > 0
+      ORDER BY count DESC, last_seen DESC LIMIT ?''', (limit,)).fetchall()
+    for bucket, signature, count, first_seen, last_seen in rows:
+      examples = [path for path, in self.db.execute('SELECT path FROM examples WHERE bucket = ?', (bucket,))]
+      yield bucket, signature.split('\n') if signature else [], count, first_seen, last_seen, examples
+
+__all__ = ('BucketIndex', 'BucketError', 'signature_id')
@@ -0,0 +1,327 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import os
+import sys
+import zlib
+import marshal
+import hashlib
+import tempfile
+import threading
+from array import array
+
+import dwarf
+import indexes
+import profiling
+
+# Bump this whenever the contents or meaning of the cached data changes,
+# so stale cache files are ignored rather than misinterpreted.
+CACHE_VERSION = 5
+MAGIC = b'AMAC'
+
+def default_cache_dir():
+  """ Return the default directory to store cache files in. """
+  base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(base, 'avr-memory-analyzer')
+
+def elf_hash(path):
+  """ Return a hex digest of the contents of the given file. """
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+def encode_analysis(symbols, callsites, addr_to_line):
+  """
+  Convert the analysis results into plain builtin types, suitable for
+  marshalling.
+  """
+  data = {
+    'sym_starts': symbols.starts.tobytes(),
+    'sym_ends': symbols.ends.tobytes(),
+    'sym_name_ids': symbols.name_ids.tobytes(),
+    'sym_names': symbols.names,
+    'sym_skipped': symbols.skipped,
+    'call_returns': callsites.returns.tobytes(),
+    'call_calls': callsites.calls.tobytes(),
+    'call_callees': callsites.callees.tobytes(),
+    'call_mnemonic_ids': callsites.mnemonic_ids.tobytes(),
+    'call_mnemonics': callsites.mnemonics,
+  }
+
+  # A lazily decoded line table is not stored, it is rebuilt from the
+  # elf file when needed.
+  if isinstance(addr_to_line, dwarf.LineTable):
+    data['line_starts'] = addr_to_line.starts.tobytes()
+    data['line_ends'] = addr_to_line.ends.tobytes()
+    data['line_locs'] = addr_to_line.locs.tobytes()
+    data['line_locations'] = addr_to_line.locations
+  return data
+
+def decode_analysis(data):
+  """ Inverse of encode_analysis. """
+  def unpack(name, typecode = 'I'):
+    a = array(typecode)
+    a.frombytes(data[name])
+    return a
+
+  symbols = indexes.SymbolIndex(unpack('sym_starts'), unpack('sym_ends'),
+                                unpack('sym_name_ids'), data['sym_names'],
+                                skipped = [tuple(s) for s in data['sym_skipped']])
+  callsites = indexes.CallsiteIndex(unpack('call_returns'), unpack('call_calls'),
+                                    unpack('call_callees'), unpack('call_mnemonic_ids', 'H'),
+                                    data['call_mnemonics'])
+
+  if 'line_starts' in data:
+    addr_to_line = dwarf.LineTable(unpack('line_starts'), unpack('line_ends'),
+                                   unpack('line_locs'), data['line_locations'])
+  else:
+    addr_to_line = None
+
+  return symbols, callsites, addr_to_line
+
+class AnalysisCache:
+  """
+  On-disk cache of analysis results, keyed by the hash of the elf file.
+  Each elf file gets its own cache file. When the total size exceeds
+  max_size bytes, the least recently used files are removed. This
+  includes the FunctionCache, which may use up to half of max_size.
+  """
+  def __init__(self, directory = None, max_size = 256 << 20):
+    self.directory = directory or default_cache_dir()
+    self.max_size = max_size
+    # Used to speed up analyzing elf files that are not cached yet
+    self.functions = FunctionCache(self.directory, max_size = max_size // 2)
+
+  def path(self, key):
+    return os.path.join(self.directory, key + '.cache')
+
+  def load(self, key):
+    """
+    Return the cached (symbols, callsites, addr_to_line) tuple for the
+    given key, or None when it is not cached (or unusable). addr_to_line
+    is None when no line table was stored.
+    """
+    path = self.path(key)
+    try:
+      with open(path, 'rb') as f:
+        header = f.read(8)
+        if (header[:4] != MAGIC or
+            int.from_bytes(header[4:6], 'little') != CACHE_VERSION or
+            int.from_bytes(header[6:8], 'little') != marshal.version):
+          return None
+        data = marshal.loads(zlib.decompress(f.read()))
+    except (OSError, ValueError, EOFError, TypeError, zlib.error):
+      return None
+
+    # Mark as recently used
+    try:
+      os.utime(path)
+    except OSError:
+      pass
+
+    return decode_analysis(data)
+
+  def store(self, key, symbols, callsites, addr_to_line):
+    """ Store analysis results under the given key. """
+    payload = zlib.compress(marshal.dumps(encode_analysis(symbols, callsites, addr_to_line)))
+    header = MAGIC + CACHE_VERSION.to_bytes(2, 'little') + marshal.version.to_bytes(2, 'little')
+
+    try:
+      os.makedirs(self.directory, exist_ok = True)
+      # Write to a temporary file and rename, so concurrent runs never
+      # see a partially written file.
+      fd, tmp = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+      with os.fdopen(fd, 'wb') as f:
+        f.write(header)
+        f.write(payload)
+      os.replace(tmp, self.path(key))
+    except OSError as e:
+      sys.stderr.write("Failed to write analysis cache: {}\n".format(e))
+      return
+
+    self.evict()
+
+  def evict(self):
+    """ Remove least recently used files until under the size limit. """
+    entries = []
+    for name in os.listdir(self.directory):
+      if not name.endswith('.cache') and name != FunctionCache.filename:
+        continue
+      try:
+        st = os.stat(os.path.join(self.directory, name))
+      except OSError:
+        continue
+      entries.append((st.st_mtime, st.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+      if total <= self.max_size:
+        break
+      try:
+        os.remove(os.path.join(self.directory, name))
+      except OSError:
+        pass
+      total -= size
+
+class FunctionCache:
+  """
+  On-disk cache of the calls found in individual functions, so a new
+  build of a program only needs the functions that changed (or moved,
+  for position-dependent code) to be decoded again. Entries are keyed
+  by a hash of the code of a function, its size and the disassembly
+  mode, and store the calls relative to the start of the function.
+  Least recently used entries beyond max_entries, or that make the file
+  bigger than max_size bytes, are dropped on save. A single instance
+  can be shared between threads.
+  """
+  filename = 'functions.dat'
+
+  def __init__(self, directory = None, max_entries = 1 << 18, max_size = None):
+    self.directory = directory or default_cache_dir()
+    self.path = os.path.join(self.directory, self.filename)
+    self.max_entries = max_entries
+    self.max_size = max_size
+    # Key -> tuple of (return offset, mnemonic, call offset, callee)
+    # tuples, loaded on first use
+    self.entries = None
+    self.dirty = False
+    # Protects entries and dirty
+    self.lock = threading.Lock()
+
+  def load(self):
+    """ Read the entries from disk. Must be called with the lock held. """
+    self.entries = {}
+    try:
+      with open(self.path, 'rb') as f:
+        header = f.read(8)
+        if (header[:4] != MAGIC or
+            int.from_bytes(header[4:6], 'little') != CACHE_VERSION or
+            int.from_bytes(header[6:8], 'little') != marshal.version):
+          return
+        self.entries = marshal.loads(zlib.decompress(f.read()))
+    except (OSError, ValueError, EOFError, TypeError, zlib.error):
+      pass
+
+  @staticmethod
+  def key(mode, code):
+    """ Return the key for a function with the given code and mode. """
+    h = hashlib.blake2b(digest_size = 16)
+    h.update(mode.encode('utf8'))
+    h.update(len(code).to_bytes(4, 'little'))
+    h.update(code)
+    return h.digest()
+
+  def callsites(self, functions, decode, absolute = ()):
+    """
+    Return the calls in each of the given (start, code, mode) functions,
+    as a list of (return address, mnemonic, call address, callee
+    address) tuples for each function. Functions that are not cached are
+    passed to decode (as a list), which should return the list of calls
+    for each of them. Calls with a mnemonic in absolute encode an
+    absolute callee address, for other calls the callee address is
+    relative to the call (so it is stored relative to the function).
+    """
+    keys = [self.key(mode, code) for start, code, mode in functions]
+    with self.lock:
+      if self.entries is None:
+        self.load()
+      entries = []
+      for key in keys:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+          # Reinsert to mark as recently used
+          self.entries[key] = entry
+        entries.append(entry)
+
+    results = [None] * len(functions)
+    missing = []
+    for i, entry in enumerate(entries):
+      if entry is None:
+        missing.append(i)
+        continue
+      start = functions[i][0]
+      results[i] = [(start + ret, mnemonic, start + call,
+                     callee if callee is None or mnemonic in absolute else start + callee)
+                    for ret, mnemonic, call, callee in entry]
+    profiling.count('functions_cached', len(functions) - len(missing))
+    profiling.count('functions_decoded', len(missing))
+
+    if missing:
+      # Decoding is slow, so do not hold the lock meanwhile
+      decoded = decode([functions[i] for i in missing])
+      new_entries = {}
+      for i, calls in zip(missing, decoded):
+        start = functions[i][0]
+        new_entries[keys[i]] = tuple((ret - start, mnemonic, call - start,
+                                      callee if callee is None or mnemonic in absolute else callee - start)
+                                     for ret, mnemonic, call, callee in calls)
+        results[i] = calls
+      with self.lock:
+        self.entries.update(new_entries)
+        self.dirty = True
+    return results
+
+  def save(self):
+    """ Write the cache back to disk, when anything was added. """
+    with self.lock:
+      if not self.dirty:
+        return
+      self.trim(len(self.entries) - self.max_entries)
+      header = MAGIC + CACHE_VERSION.to_bytes(2, 'little') + marshal.version.to_bytes(2, 'little')
+      payload = zlib.compress(marshal.dumps(self.entries))
+      while self.max_size is not None and self.entries and len(header) + len(payload) > self.max_size:
+        # Keep entries in proportion to the allowed size (and a bit less,
+        # so this rarely needs a second round)
+        keep = int(len(self.entries) * self.max_size / (len(header) + len(payload)) * 0.9)
+        self.trim(max(1, len(self.entries) - keep))
+        payload = zlib.compress(marshal.dumps(self.entries))
+
+      try:
+        os.makedirs(self.directory, exist_ok = True)
+        fd, tmp = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+        with os.fdopen(fd, 'wb') as f:
+          f.write(header)
+          f.write(payload)
+        os.replace(tmp, self.path)
+      except OSError as e:
+        sys.stderr.write("Failed to write function cache: {}\n".format(e))
+        return
+      self.dirty = False
+
+  def trim(self, count):
+    """ Drop the count least recently used entries. """
+    if count <= 0:
+      return
+    for key in list(self.entries)[:count]:
+      del self.entries[key]
+
+__all__ = ('AnalysisCache', 'FunctionCache', 'elf_hash')
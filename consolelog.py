@@ -0,0 +1,149 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import re
+import io
+from collections import namedtuple
+from intelhex import IntelHex
+
+# A single memory dump found in a console log. memory is an IntelHex
+# object with the stack contents, sp and isr_return are the values
+# printed before the dump (or None when missing). complete is False when
+# the dump was cut short (e.g. by a watchdog reset). line is the line
+# number where the dump started.
+Dump = namedtuple('Dump', ['line', 'sp', 'isr_return', 'memory', 'complete'])
+
+sp_re = re.compile(r'SP = 0x([0-9A-Fa-f]+)')
+return_re = re.compile(r'Return = 0x([0-9A-Fa-f]+)')
+
+def valid_record(line):
+  """ Return True when line is a valid Intel hex record. """
+  if not line.startswith(':'):
+    return False
+  try:
+    raw = bytes.fromhex(line[1:])
+  except ValueError:
+    return False
+  return len(raw) >= 5 and len(raw) == raw[0] + 5 and sum(raw) & 0xff == 0
+
+class DumpParser:
+  """
+  Incremental parser for console output produced by the dumpMemory()
+  function from dump_memory.h. Feed it lines using feed(), which returns
+  any dump that was completed by that line.
+  """
+  def __init__(self):
+    self.start_dump(None)
+    self.in_progress = False
+
+  def start_dump(self, line):
+    self.line = line
+    self.sp = None
+    self.isr_return = None
+    # One of None (before any section), 'io' or 'stack'
+    self.section = None
+    self.records = []
+
+  def finish_dump(self, complete):
+    """ Return the dump in progress and reset the parser. """
+    memory = IntelHex(io.StringIO('\n'.join(self.records) + '\n'))
+    dump = Dump(line=self.line, sp=self.sp, isr_return=self.isr_return,
+                memory=memory, complete=complete)
+    self.in_progress = False
+    self.start_dump(None)
+    return dump
+
+  def feed(self, line, lineno):
+    """
+    Process a single line of console output. Returns a list of completed
+    (or aborted) dumps.
+    """
+    result = []
+    line = line.strip()
+
+    match = sp_re.search(line)
+    if match:
+      # A new dump starts, so any dump in progress was cut short
+      if self.in_progress:
+        result.append(self.finish_dump(complete = False))
+      self.start_dump(lineno)
+      self.in_progress = True
+      self.sp = int(match.group(1), 16)
+      return result
+
+    if not self.in_progress:
+      return result
+
+    match = return_re.search(line)
+    if match and self.section is None:
+      self.isr_return = int(match.group(1), 16)
+    elif line == 'IO registers:':
+      self.section = 'io'
+    elif line == 'Stack:':
+      self.section = 'stack'
+    elif line == 'Dump complete':
+      result.append(self.finish_dump(complete = True))
+    elif self.section == 'stack':
+      if valid_record(line):
+        if line[7:9] == '01':
+          # End of file record, the dump is complete (there might
+          # still be a "Dump complete" line, but that is not printed
+          # on all platforms).
+          result.append(self.finish_dump(complete = True))
+        else:
+          self.records.append(line)
+      elif line:
+        # Anything else (e.g. a partial line followed by a startup
+        # message after a reset) means the dump was cut short
+        result.append(self.finish_dump(complete = False))
+    return result
+
+  def finish(self):
+    """
+    Signal the end of the input. Returns a list containing the dump in
+    progress (if any), which is incomplete.
+    """
+    if self.in_progress:
+      return [self.finish_dump(complete = False)]
+    return []
+
+def iter_dumps(stream):
+  """
+  Find all memory dumps in the given console output stream (a text
+  file object), yielding a Dump object for each dump as soon as it is
+  complete. The stream is read line by line, so it can be arbitrarily
+  big (or even still being written).
+  """
+  parser = DumpParser()
+  for lineno, line in enumerate(stream, 1):
+    yield from parser.feed(line, lineno)
+  yield from parser.finish()
+
+__all__ = ('Dump', 'DumpParser', 'iter_dumps')
@@ -0,0 +1,145 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import sys
+import threading
+import subprocess
+from collections import OrderedDict
+
+import profiling
+
+class Demangler:
+  """
+  Demangles C++ symbol names using an external c++filt tool.
+
+  Rather than running c++filt once for every name, a single long-lived
+  c++filt process is started on first use, which is fed names through
+  stdin one line at a time. Results are remembered in an LRU cache, so
+  names that are needed repeatedly (e.g. functions showing up in many
+  traces) are only demangled once. This class is thread-safe, the cache
+  can be used while another thread is waiting for c++filt.
+  """
+  def __init__(self, cppfilt = 'c++filt', cache_size = 65536):
+    self.cppfilt = cppfilt
+    self.cache_size = cache_size
+    self.cache = OrderedDict()
+    # Protects cache
+    self.lock = threading.RLock()
+    # The c++filt process, started on first use, and the lock that
+    # protects it
+    self.process = None
+    self.process_lock = threading.Lock()
+
+  def remember(self, name, demangled):
+    self.cache[name] = demangled
+    self.cache.move_to_end(name)
+    if len(self.cache) > self.cache_size:
+      self.cache.popitem(last = False)
+
+  def close(self):
+    """ Stop the c++filt process, if it is running. """
+    with self.process_lock:
+      if self.process is not None:
+        self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+  def run_cppfilt(self, names):
+    """
+    Demangle the given names using the c++filt process. When c++filt
+    stops unexpectedly, a warning is printed and the remaining names
+    are returned as they are.
+    """
+    profiling.count('demangled_names', len(names))
+    with self.process_lock, profiling.phase('demangle'):
+      if self.process is None:
+        profiling.count('demangle_calls')
+        self.process = subprocess.Popen([self.cppfilt], stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+                                        universal_newlines = True)
+      result = []
+      try:
+        # c++filt demangles each line on stdin and outputs one line for
+        # each, one at a time so neither side blocks on a full pipe
+        for name in names:
+          self.process.stdin.write(name + '\n')
+          self.process.stdin.flush()
+          line = self.process.stdout.readline()
+          if not line:
+            raise EOFError("no output")
+          result.append(line.strip())
+      except (OSError, EOFError) as e:
+        sys.stderr.write("Warning: {} stopped unexpectedly ({}), not demangling {} names\n".format(
+          self.cppfilt, e, len(names) - len(result)))
+        self.process.kill()
+        self.process.wait()
+        self.process = None
+        result += names[len(result):]
+      return result
+
+  def prefetch(self, names):
+    """
+    Demangle all of the given names that are not cached yet in a single
+    batch, so subsequent lookups are served from the cache.
+    """
+    with self.lock:
+      missing = list(OrderedDict.fromkeys(name for name in names
+                                          if name not in self.cache and '\n' not in name))
+    if not missing:
+      return
+
+    demangled = self.run_cppfilt(missing)
+    with self.lock:
+      for name, result in zip(missing, demangled):
+        self.remember(name, result)
+
+  def demangle(self, name):
+    """ Demangle the given name """
+    with self.lock:
+      try:
+        demangled = self.cache[name]
+        self.cache.move_to_end(name)
+        return demangled
+      except KeyError:
+        pass
+
+    if '\n' in name:
+      # Cannot be passed through stdin, but should never happen for
+      # actual symbol names.
+      return name
+
+    # Not taken from the cache, since it might have been evicted again
+    # by another thread meanwhile
+    demangled = self.run_cppfilt([name])[0]
+    with self.lock:
+      self.remember(name, demangled)
+    return demangled
+
+__all__ = ('Demangler',)
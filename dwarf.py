@@ -3,74 +3,317 @@
 # https://github.com/eliben/pyelftools/blob/master/examples/dwarf_decode_address.py
 # It has since been mostly rewritten.
 
-def get_addr_to_line_map(elf):
-  dwarf_info = elf.get_dwarf_info()
-  cache = {}
+import heapq
+from array import array
+from bisect import bisect_right
 
-  # Go over all the line programs in the DWARF information, looking for
-  # one that describes the given address.
-  for CU in dwarf_info.iter_CUs():
-    # First, look at line programs to find the file/line for the address
-    lineprog = dwarf_info.line_program_for_CU(CU)
-    prevstate = None
-    ignore_this_sequence = False
-    for entry in lineprog.get_entries():
-      # DWARF lineinfo is a sequence of instructions, some of
-      # which build internal registers, and some which output a
-      # new state based on those internal registers. We're only
-      # interested in the resulting states, so ignore everything
-      # else.
-      if entry.state is None:
+import profiling
+
+class LineTable:
+  """
+  Maps instruction addresses to (filename, line) tuples.
+
+  This stores sorted, non-overlapping address ranges in parallel arrays
+  (start, end and an index into a list of interned locations), so it
+  only needs a few bytes per line table row, regardless of the size of
+  the code. Lookups use bisect. Like a dict, indexing raises KeyError
+  for addresses not covered by any range.
+  """
+  def __init__(self, starts, ends, locs, locations):
+    self.starts = starts
+    self.ends = ends
+    self.locs = locs
+    self.locations = locations
+
+  @classmethod
+  def from_ranges(cls, ranges):
+    """
+    Build a table from an iterable of (start, end, location) tuples.
+    Where ranges overlap, the range given last wins (just like when
+    adding each address to a dict in order).
+    """
+    starts = array('I')
+    ends = array('I')
+    locs = array('I')
+    locations = []
+    interned = {}
+
+    def emit(start, end, location):
+      loc = interned.get(location)
+      if loc is None:
+        loc = interned[location] = len(locations)
+        locations.append(location)
+      # Merge with the previous range when possible
+      if ends and ends[-1] == start and locs[-1] == loc:
+        ends[-1] = end
+      else:
+        starts.append(start)
+        ends.append(end)
+        locs.append(loc)
+
+    # Sort on start address, keeping the original order (priority) as
+    # the secondary key.
+    ranges = sorted((start, prio, end, location)
+                    for prio, (start, end, location) in enumerate(ranges)
+                    if start < end)
+
+    # Sweep over the ranges, keeping a heap of all ranges that cover
+    # the current position, ordered by priority (highest first).
+    active = []
+    i = 0
+    pos = None
+    while i < len(ranges) or active:
+      if not active:
+        pos = ranges[i][0]
+      while i < len(ranges) and ranges[i][0] <= pos:
+        start, prio, end, location = ranges[i]
+        heapq.heappush(active, (-prio, end, location))
+        i += 1
+      # Drop ranges that ended already
+      while active and active[0][1] <= pos:
+        heapq.heappop(active)
+      if not active:
         continue
 
-      # Each resulting state maps a source line to an address,
-      # annotated with some extra info which are not so
-      # interesting to us. The only flag which is interesting is
-      # the end_sequence flag, which indicates that this address
-      # is one-past-the-end of the current sequence of consecutive
-      # addresses.
-
-      if not prevstate and entry.state.address == 0:
-        # For code that was optimized away at link time, the
-        # linker typically emits sequences starting at address 0
-        # rather than removing them. Since these addresses make
-        # no sense, ignore them.
-        ignore_this_sequence = True
-
-      if ignore_this_sequence:
-        # Ignore the sequence up to and including the next
-        # end_sequence
-        if entry.state.end_sequence:
-          ignore_this_sequence = False
+      _, end, location = active[0]
+      # The winning range holds until it ends, or a new range starts
+      nextpos = end
+      if i < len(ranges) and ranges[i][0] < nextpos:
+        nextpos = ranges[i][0]
+      emit(pos, nextpos, location)
+      pos = nextpos
+
+    return cls(starts, ends, locs, locations)
+
+  def get(self, addr, default = None):
+    index = bisect_right(self.starts, addr) - 1
+    if index >= 0 and addr < self.ends[index]:
+      return self.locations[self.locs[index]]
+    return default
+
+  def __getitem__(self, addr):
+    location = self.get(addr)
+    if location is None:
+      raise KeyError(addr)
+    return location
+
+  def __contains__(self, addr):
+    return self.get(addr) is not None
+
+  def __len__(self):
+    return len(self.starts)
+
+class LazyLineTable:
+  """
+  Lazily decoded variant of LineTable. Rather than decoding the line
+  programs of all CUs up front, this looks up the CU that covers an
+  address (using .debug_aranges, or the address ranges of the CUs
+  themselves if that section is missing) and only decodes the line
+  program of that CU. Decoded CUs are remembered for later lookups.
+  """
+  def __init__(self, dwarf_info, exclude = ()):
+    self.dwarf_info = dwarf_info
+    self.exclude = exclude
+    self.aranges = dwarf_info.get_aranges()
+    # CU offset -> LineTable
+    self.tables = {}
+    # LineTable mapping addresses to CU offsets, built on first use
+    # when .debug_aranges does not cover an address.
+    self.cu_index = None
+    # CUs whose address ranges could not be determined
+    self.unranged = []
+
+  def cu_ranges(self, CU):
+    """
+    Return a list of (start, end) address ranges covered by the given
+    CU, or None when these cannot be determined.
+    """
+    from elftools.dwarf.ranges import BaseAddressEntry
+
+    top = CU.get_top_DIE()
+    attrs = top.attributes
+    if 'DW_AT_ranges' in attrs:
+      # This handles both .debug_ranges and the DWARF 5 .debug_rnglists
+      # (pyelftools already resolves DW_FORM_rnglistx to an offset)
+      range_lists = self.dwarf_info.range_lists()
+      if range_lists is None:
+        return None
+      base = attrs['DW_AT_low_pc'].value if 'DW_AT_low_pc' in attrs else 0
+      result = []
+      for entry in range_lists.get_range_list_at_offset(attrs['DW_AT_ranges'].value, cu = CU):
+        if isinstance(entry, BaseAddressEntry):
+          base = entry.base_address
+        elif entry.is_absolute:
+          result.append((entry.begin_offset, entry.end_offset))
+        else:
+          result.append((base + entry.begin_offset, base + entry.end_offset))
+      return result
+    if 'DW_AT_low_pc' in attrs and 'DW_AT_high_pc' in attrs:
+      low = attrs['DW_AT_low_pc'].value
+      high = attrs['DW_AT_high_pc']
+      if high.form == 'DW_FORM_addr':
+        return [(low, high.value)]
+      # Since DWARF4, high_pc can be an offset from low_pc
+      return [(low, low + high.value)]
+    return None
+
+  def build_cu_index(self):
+    ranges = []
+    for CU in self.dwarf_info.iter_CUs():
+      cu_ranges = self.cu_ranges(CU)
+      if cu_ranges is None:
+        self.unranged.append(CU.cu_offset)
         continue
+      for start, end in cu_ranges:
+        ranges.append((start, end, CU.cu_offset))
+    self.cu_index = LineTable.from_ranges(ranges)
+
+  def table_for_cu(self, offset):
+    table = self.tables.get(offset)
+    if table is None:
+      with profiling.phase('line_table'):
+        CU = self.dwarf_info.get_CU_at(offset)
+        table = LineTable.from_ranges(exclude_ranges(cu_line_ranges(self.dwarf_info, CU), self.exclude))
+      self.tables[offset] = table
+    return table
 
-      # Record the line number of the previous state for all
-      # addresses up to this next state (possibly the
-      # end_sequence).
-      if prevstate:
-        filename = lineprog['file_entry'][prevstate.file - 1].name
-        line = prevstate.line
-        # Rather than keeping a single entry for the range of
-        # addresses fo this line, we add an entry for each
-        # address separately. This produces a bigger cache (150k
-        # vs 50k entries for a production Arduino STM32 sketch),
-        # but also makes querying a lot simpler (and probably
-        # faster). There does not seem to be a signficant
-        # slowdown in generating the cache (which is dominated
-        # by the DWARF info parsing anyway).
-        # TODO: Some of these ranges are big (sometimes > 100
-        # bytes attributed to a single line). It seems these big
-        # ranges are data encoded in the text section, which is
-        # common on ARM. These data runs could be detected and
-        # skipped using special entries in the symbol table, see
-        # https://sourceware.org/bugzilla/show_bug.cgi?id=10263#c1
-        # https://developer.arm.com/docs/ihi0044/latest
-        for addr in range(prevstate.address, entry.state.address):
-          cache[addr] = (filename, line)
-
-      prevstate = entry.state
+  def get(self, addr, default = None):
+    offset = None
+    if self.aranges and self.aranges.entries:
+      offset = self.aranges.cu_offset_at_addr(addr)
+    if offset is None:
+      if self.cu_index is None:
+        self.build_cu_index()
+      offset = self.cu_index.get(addr)
+
+    if offset is not None:
+      location = self.table_for_cu(offset).get(addr)
+      if location is not None:
+        return location
+
+    # Last resort: Look in the CUs without address ranges
+    for offset in self.unranged:
+      location = self.table_for_cu(offset).get(addr)
+      if location is not None:
+        return location
+    return default
+
+  def __getitem__(self, addr):
+    location = self.get(addr)
+    if location is None:
+      raise KeyError(addr)
+    return location
+
+  def __contains__(self, addr):
+    return self.get(addr) is not None
+
+def cu_line_ranges(dwarf_info, CU):
+  """
+  Decode the line program of the given CU. Yields a (start, end,
+  (filename, line)) tuple for each range of addresses.
+  """
+  lineprog = dwarf_info.line_program_for_CU(CU)
+  if lineprog is None:
+    return
+  profiling.count('cus_decoded')
+  rows = 0
+  prevstate = None
+  ignore_this_sequence = False
+  for entry in lineprog.get_entries():
+    # DWARF lineinfo is a sequence of instructions, some of
+    # which build internal registers, and some which output a
+    # new state based on those internal registers. We're only
+    # interested in the resulting states, so ignore everything
+    # else.
+    if entry.state is None:
+      continue
+    rows += 1
+
+    # Each resulting state maps a source line to an address,
+    # annotated with some extra info which are not so
+    # interesting to us. The only flag which is interesting is
+    # the end_sequence flag, which indicates that this address
+    # is one-past-the-end of the current sequence of consecutive
+    # addresses.
+
+    if not prevstate and entry.state.address == 0:
+      # For code that was optimized away at link time, the
+      # linker typically emits sequences starting at address 0
+      # rather than removing them. Since these addresses make
+      # no sense, ignore them.
+      ignore_this_sequence = True
+
+    if ignore_this_sequence:
+      # Ignore the sequence up to and including the next
+      # end_sequence
       if entry.state.end_sequence:
-        # This ends the current sequence, so do not use it as
-        # prevstate for the next, unrelated, state.
-        prevstate = None
-  return cache
+        ignore_this_sequence = False
+      continue
+
+    # Record the line number of the previous state for all
+    # addresses up to this next state (possibly the
+    # end_sequence).
+    if prevstate:
+      filename = lineprog['file_entry'][prevstate.file - 1].name
+      line = prevstate.line
+      # Some of these ranges are big (sometimes > 100 bytes
+      # attributed to a single line). It seems these big ranges
+      # are data encoded in the text section, which is common on
+      # ARM. These data runs are detected using special entries
+      # in the symbol table and removed by exclude_ranges, see
+      # https://sourceware.org/bugzilla/show_bug.cgi?id=10263#c1
+      # https://developer.arm.com/docs/ihi0044/latest
+      yield (prevstate.address, entry.state.address, (filename, line))
+
+    prevstate = entry.state
+    if entry.state.end_sequence:
+      # This ends the current sequence, so do not use it as
+      # prevstate for the next, unrelated, state.
+      prevstate = None
+  profiling.count('line_rows', rows)
+
+def exclude_ranges(ranges, exclude):
+  """
+  Yields the given (start, end, location) ranges, leaving out the parts
+  that overlap any of the (start, end) ranges in exclude (which must be
+  sorted and not overlap).
+  """
+  if not exclude:
+    yield from ranges
+    return
+
+  exclude_starts = [start for start, end in exclude]
+  for start, end, location in ranges:
+    i = max(0, bisect_right(exclude_starts, start) - 1)
+    while start < end and i < len(exclude):
+      exclude_start, exclude_end = exclude[i]
+      i += 1
+      if exclude_end <= start:
+        continue
+      if exclude_start >= end:
+        break
+      if exclude_start > start:
+        yield (start, exclude_start, location)
+      start = exclude_end
+    if start < end:
+      yield (start, end, location)
+
+def get_addr_to_line_map(elf, lazy = False, exclude = ()):
+  """
+  Decode the DWARF line programs in the given elf file into a LineTable
+  mapping addresses to (filename, line) tuples. Addresses in any of
+  the (start, end) ranges in exclude (e.g. data in the text section)
+  are left out.
+
+  If lazy is True, a LazyLineTable is returned instead, which only
+  decodes the line programs of the CUs that are actually looked up.
+  """
+  dwarf_info = elf.get_dwarf_info()
+  if lazy:
+    return LazyLineTable(dwarf_info, exclude)
+
+  # Go over all the line programs in the DWARF information
+  ranges = []
+  for CU in dwarf_info.iter_CUs():
+    ranges.extend(exclude_ranges(cu_line_ranges(dwarf_info, CU), exclude))
+  return LineTable.from_ranges(ranges)
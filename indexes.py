@@ -0,0 +1,229 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import bisect
+from array import array
+from collections import namedtuple
+
+CallInfo = namedtuple('CallInfo', ['mnemonic', 'call_addr', 'callee_addr'])
+
+class UnwoundFrames(list):
+  """
+  List of (stack address, CallInfo) tuples found by following the chain
+  of stack frames. scanned is the set of stack addresses of the frames
+  that were found by scanning the stack instead, where the chain could
+  not be followed.
+  """
+  def __init__(self, frames = (), scanned = ()):
+    super().__init__(frames)
+    self.scanned = set(scanned)
+
+# Stored in place of a callee address for indirect calls
+NO_ADDR = 0xFFFFFFFF
+
+class SymbolIndex:
+  """
+  Maps instruction addresses to the names of the functions containing
+  them.
+
+  This stores the sorted function start and end addresses in parallel
+  arrays, with an index into a list of interned names, so it needs only
+  a few bytes per function on top of the names themselves. Lookups use
+  bisect. When demangled is True, the names are already demangled.
+  skipped is a list of (message, name) tuples for the function symbols
+  that were left out (see main.process_symtab).
+  """
+  def __init__(self, starts, ends, name_ids, names, demangled = False, skipped = ()):
+    self.starts = starts
+    self.ends = ends
+    self.name_ids = name_ids
+    self.names = names
+    self.demangled = demangled
+    self.skipped = list(skipped)
+
+  @classmethod
+  def from_symdict(cls, symdict, skipped = ()):
+    """
+    Build an index from a sorted dictionary mapping function addresses
+    to symbols and the list of skipped symbols (see main.process_symtab).
+    """
+    starts = array('I')
+    ends = array('I')
+    name_ids = array('I')
+    names = []
+    interned = {}
+    for addr, sym in symdict.items():
+      name_id = interned.get(sym.name)
+      if name_id is None:
+        name_id = interned[sym.name] = len(names)
+        names.append(sym.name)
+      starts.append(addr)
+      ends.append(addr + sym['st_size'])
+      name_ids.append(name_id)
+    return cls(starts, ends, name_ids, names, skipped = skipped)
+
+  @classmethod
+  def from_ranges(cls, ranges, demangled = False):
+    """
+    Build an index from (start, end, name) tuples, in any order.
+    Overlapping ranges (e.g. aliases) are dropped, keeping the first
+    one by address.
+    """
+    starts = array('I')
+    ends = array('I')
+    name_ids = array('I')
+    names = []
+    interned = {}
+    for start, end, name in sorted(ranges):
+      if starts and start < ends[-1]:
+        continue
+      name_id = interned.get(name)
+      if name_id is None:
+        name_id = interned[name] = len(names)
+        names.append(name)
+      starts.append(start)
+      ends.append(end)
+      name_ids.append(name_id)
+    return cls(starts, ends, name_ids, names, demangled)
+
+  def __len__(self):
+    return len(self.starts)
+
+  def find(self, addr):
+    """
+    Return the position of the function containing addr, or -1.
+    """
+    i = bisect.bisect_right(self.starts, addr) - 1
+    if i < 0 or addr >= self.ends[i]:
+      return -1
+    return i
+
+  def containing(self, addr):
+    """
+    Return the name of the function containing addr, or None.
+    """
+    i = self.find(addr)
+    if i < 0:
+      return None
+    return self.names[self.name_ids[i]]
+
+  def get(self, addr):
+    """
+    Return the name of the function starting at addr, or None.
+    """
+    i = bisect.bisect_left(self.starts, addr)
+    if i == len(self.starts) or self.starts[i] != addr:
+      return None
+    return self.names[self.name_ids[i]]
+
+class CallsiteIndex:
+  """
+  Maps return addresses to CallInfo tuples, like a (read-only) dict.
+
+  This stores the sorted return addresses in an array, with parallel
+  arrays for the call address, callee address (NO_ADDR for indirect
+  calls) and an index into a list of interned mnemonics. CallInfo tuples
+  are only created when looked up, so only a few bytes are needed per
+  call instruction. Lookups use bisect.
+  """
+  def __init__(self, returns, calls, callees, mnemonic_ids, mnemonics):
+    self.returns = returns
+    self.calls = calls
+    self.callees = callees
+    self.mnemonic_ids = mnemonic_ids
+    self.mnemonics = mnemonics
+
+  @classmethod
+  def from_dict(cls, callsites):
+    """
+    Build an index from a dictionary mapping return addresses to
+    CallInfo tuples (see the find_callsites arch methods).
+    """
+    returns = array('I')
+    calls = array('I')
+    callees = array('I')
+    mnemonic_ids = array('H')
+    mnemonics = []
+    interned = {}
+    for ret in sorted(callsites):
+      call = callsites[ret]
+      mnemonic_id = interned.get(call.mnemonic)
+      if mnemonic_id is None:
+        mnemonic_id = interned[call.mnemonic] = len(mnemonics)
+        mnemonics.append(call.mnemonic)
+      returns.append(ret)
+      calls.append(call.call_addr)
+      callees.append(NO_ADDR if call.callee_addr is None else call.callee_addr)
+      mnemonic_ids.append(mnemonic_id)
+    return cls(returns, calls, callees, mnemonic_ids, mnemonics)
+
+  def __len__(self):
+    return len(self.returns)
+
+  def __iter__(self):
+    return iter(self.returns)
+
+  def find(self, ret):
+    """ Return the position of the given return address, or -1. """
+    # Pointers decoded from a memory dump can be anything, including
+    # values that do not fit in the array
+    if ret is None or not 0 <= ret < NO_ADDR:
+      return -1
+    i = bisect.bisect_left(self.returns, ret)
+    if i == len(self.returns) or self.returns[i] != ret:
+      return -1
+    return i
+
+  def __contains__(self, ret):
+    return self.find(ret) >= 0
+
+  def call_info(self, i):
+    """ Return the CallInfo at the given position. """
+    callee = self.callees[i]
+    return CallInfo(mnemonic=self.mnemonics[self.mnemonic_ids[i]], call_addr=self.calls[i],
+                    callee_addr=None if callee == NO_ADDR else callee)
+
+  def __getitem__(self, ret):
+    i = self.find(ret)
+    if i < 0:
+      raise KeyError(ret)
+    return self.call_info(i)
+
+  def get(self, ret, default = None):
+    i = self.find(ret)
+    if i < 0:
+      return default
+    return self.call_info(i)
+
+  def items(self):
+    for i, ret in enumerate(self.returns):
+      yield ret, self.call_info(i)
+
+__all__ = ('SymbolIndex', 'CallsiteIndex', 'UnwoundFrames')
@@ -29,50 +29,54 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import io
+import os
 import sys
+import glob
 import argparse
-import subprocess
-import sortedcontainers
-from intelhex import IntelHex
 from collections import namedtuple
-from elftools.elf.elffile import ELFFile
 
 import dwarf
+import cache
+import indexes
+from indexes import CallInfo
+import profiling
+import demangle as demangling
 
-cppfilt = 'c++filt'
+# Note that heavier modules (elftools, intelhex, numpy, capstone, etc.)
+# and the modules for the other modes (buckets, rtos, sidecar and
+# variables) are only imported when they are needed, so this module can
+# be imported quickly.
 
-CallInfo = namedtuple('CallInfo', ['mnemonic', 'call_addr', 'callee_addr'])
+demangler = demangling.Demangler()
 
 def demangle(name):
   """ Demangle the given name """
-  return subprocess.check_output([cppfilt, name]).decode('utf8').strip()
+  return demangler.demangle(name)
 
-def address_to_containing_function(symdict, address):
+def symbol_name(symbols, name):
+  """ Return the demangled version of a name from the given SymbolIndex. """
+  if symbols.demangled:
+    return name
+  return demangle(name)
+
+def address_to_containing_function(symbols, address):
   """
   Convert an instruction address to the demangled name of the function
   that contains the instruction.
   """
-  candidate_index = symdict.bisect(address)
-  if candidate_index == 0:
-    # Address is before first function
-    return 'unknown function'
-  # -1 to get the symbol that starts *before* the given address
-  candidate = symdict[symdict.keys()[candidate_index - 1]]
-
-  start = candidate['st_value']
-  end = start + candidate['st_size']
-
-  if start <= address < end:
-    return demangle(candidate.name)
+  name = symbols.containing(address)
+  if name is not None:
+    return symbol_name(symbols, name)
   return 'unknown function'
 
-def address_to_function(symdict, address):
+def address_to_function(symbols, address):
   """
   Convert a function address to the demangled name of that function.
   """
-  sym = symdict.get(address, None)
-  if sym:
-    return demangle(sym.name)
+  name = symbols.get(address)
+  if name is not None:
+    return symbol_name(symbols, name)
   else:
     return 'unknown function at 0x{:06x}'.format(address)
 
@@ -89,121 +93,843 @@ def address_to_location(addr_to_line, addr):
 
 def process_symtab(elf, arch):
   """
-  Yields a sorted dictionary containing the function symbols in the
-  .text section, indexed by their starting address.
+  Returns a sorted dictionary containing the function symbols in the
+  .text section, indexed by their starting address, and a list of
+  (message, name) tuples for the function symbols that were skipped
+  (see print_skipped).
   """
+  import sortedcontainers
+
   symtab = elf.get_section_by_name('.symtab')
   result = sortedcontainers.SortedDict()
+  skipped = []
 
   for sym in symtab.iter_symbols():
     if (sym['st_info']['type'] == 'STT_FUNC'):
       if sym['st_size'] <= 0:
-        print("Skipping zero-size function: " + demangle(sym.name))
+        skipped.append(("Skipping zero-size function: ", sym.name))
         continue
 
       if sym['st_shndx'] == 0:
-        print("Skipping undefined function: " + demangle(sym.name))
+        skipped.append(("Skipping undefined function: ", sym.name))
         continue
 
       section = elf.get_section(sym['st_shndx']).name
       if section != '.text':
-        print("Skipping function in section other than .text: {} in {}".format(section, demangle(sym.name)))
+        skipped.append(("Skipping function in section other than .text: {} in ".format(section), sym.name))
         continue
 
       addr = arch.sym_to_addr(sym)
 
       result[addr] = sym
-  return result
 
-def generate_frame(symdict, stack_addr, addr_to_line, call):
-  caller = address_to_containing_function(symdict, call.call_addr)
-  if isinstance(stack_addr, str):
-    stack_addr_str = stack_addr
-  else:
-    stack_addr_str = "0x{:06x}".format(stack_addr)
+  profiling.count('symbols_kept', len(result))
+  profiling.count('symbols_skipped', len(skipped))
+  return result, skipped
 
-  sys.stdout.write("{} contains 0x{:06x}: {} in {}".format(stack_addr_str, call.call_addr, call.mnemonic, caller))
+def print_skipped(skipped):
+  """
+  Print the messages for the skipped symbols returned by process_symtab.
+  These are stored along with the analysis results, so they are printed
+  on every run, not just when the analysis is not cached.
+  """
+  # Demangle all names in one go
+  demangler.prefetch(name for msg, name in skipped)
+  for msg, name in skipped:
+    print(msg + demangle(name))
 
-  location = address_to_location(addr_to_line, call.call_addr)
-  if location:
-    sys.stdout.write(" at {}".format(location))
+class Frame(namedtuple('Frame', ['stack_addr', 'mnemonic', 'call_addr', 'function', 'location', 'callee_addr', 'callee',
+                                 'scanned'], defaults = (False,))):
+  """
+  A single frame in a stacktrace. stack_addr is the address of the
+  return address on the stack (or a string like 'isr-return'),
+  function, location and callee are descriptive strings (location and
+  callee can be None). scanned is True for a frame that was found by
+  scanning the stack where unwinding failed.
+  """
+  __slots__ = ()
 
+  def __str__(self):
+    if isinstance(self.stack_addr, str):
+      stack_addr_str = self.stack_addr
+    else:
+      stack_addr_str = "0x{:06x}".format(self.stack_addr)
+
+    result = "{} contains 0x{:06x}: {} in {}".format(stack_addr_str, self.call_addr, self.mnemonic, self.function)
+
+    if self.location:
+      result += " at {}".format(self.location)
+
+    if self.callee:
+      result += " called {}".format(self.callee)
+
+    if self.scanned:
+      result += " (scanned)"
+
+    return result
+
+def make_frame(symbols, stack_addr, addr_to_line, call, scanned = False):
+  """ Return a Frame describing the given call. """
+  callee = None
   if call.callee_addr:
-    callee = address_to_function(symdict, call.callee_addr)
-    sys.stdout.write(" called {}".format(callee))
+    callee = address_to_function(symbols, call.callee_addr)
+
+  return Frame(stack_addr=stack_addr, mnemonic=call.mnemonic, call_addr=call.call_addr,
+               function=address_to_containing_function(symbols, call.call_addr),
+               location=address_to_location(addr_to_line, call.call_addr),
+               callee_addr=call.callee_addr, callee=callee, scanned=scanned)
+
+def format_frame(symbols, stack_addr, addr_to_line, call, scanned = False):
+  """ Return a line of text describing a single stack frame. """
+  return str(make_frame(symbols, stack_addr, addr_to_line, call, scanned))
 
-  sys.stdout.write("\n")
+def generate_frame(symbols, stack_addr, addr_to_line, call, scanned = False):
+  sys.stdout.write(format_frame(symbols, stack_addr, addr_to_line, call, scanned) + "\n")
 
-def generate_stacktrace(elf, memory, arch, sp, isr_ret, align):
+def analyze_elf(elf, arch, lazy_lines = False):
   """
-  Generate a stacktrace on stdout from looking at the given memory dump
-  and elf file.
+  Do the (slow) analysis of the elf file that is needed to generate
+  stacktraces. Returns a (symbols, callsites, addr_to_line) tuple, with
+  a SymbolIndex and CallsiteIndex.
   """
-  addr_to_line = dwarf.get_addr_to_line_map(elf)
-  symdict = process_symtab(elf, arch)
-  addrlen = arch.get_addrlen()
+  with profiling.phase('line_table'):
+    addr_to_line = dwarf.get_addr_to_line_map(elf, lazy = lazy_lines, exclude = arch.get_data_regions(elf))
+  with profiling.phase('symtab'):
+    symdict, skipped = process_symtab(elf, arch)
 
   # All call instructions in the program
-  callsites = arch.find_callsites(elf, symdict)
+  with profiling.phase('callsites'):
+    callsites = arch.find_callsites(elf, symdict)
+  profiling.count('callsites_found', len(callsites))
+
+  # Only compact versions of the results are kept, the symbols and
+  # CallInfo objects take a lot of memory for big programs
+  with profiling.phase('index'):
+    symbols = indexes.SymbolIndex.from_symdict(symdict, skipped)
+    callsites = indexes.CallsiteIndex.from_dict(callsites)
+
+  return symbols, callsites, addr_to_line
+
+def import_numpy():
+  """ Return the numpy module, or None when it is not installed. """
+  try:
+    import numpy
+  except ImportError:
+    # Optional, only needed for faster stack analysis
+    return None
+  return numpy
+
+def callsite_array(callsites):
+  """
+  Return a sorted numpy array of the return addresses in the given
+  CallsiteIndex (or dictionary). For a CallsiteIndex, this is a view
+  on its array of return addresses, so nothing is copied.
+  """
+  import numpy
+  if hasattr(callsites, 'returns'):
+    return numpy.frombuffer(callsites.returns, dtype=numpy.uint32)
+  return numpy.array(sorted(callsites), dtype=numpy.int64)
+
+def find_stack_frames(callsites, memory, arch, sp, align):
+  """
+  Find all addrlen-sized pointers in the given memory dump that match a
+  call instruction (e.g. are likely a return address on the stack).
+  Returns a list of (stack address, CallInfo) tuples.
+  """
+  addrlen = arch.get_addrlen()
+  numpy = import_numpy()
+  frames = []
+
+  with profiling.phase('stack_scan'):
+    # Process each contiguous block of memory at once, sliding a window
+    # over it
+    for start, end in memory.segments():
+      data = memory.gets(start, end - start)
+      first = start
+      if sp is not None and first < sp:
+        first = sp
+      # Round up to alignment
+      first += -first % align
+
+      if numpy is not None:
+        # Decode all candidate pointers at once and match them against
+        # the sorted return addresses
+        ptrs = arch.decode_ptrs(data, first - start, align)
+        profiling.count('stack_windows', len(ptrs))
+        matches = numpy.nonzero(numpy.isin(ptrs, callsite_array(callsites)))[0]
+        for index, ptr in zip(matches.tolist(), ptrs[matches].tolist()):
+          frames.append((first + index * align, callsites[ptr]))
+        continue
+
+      addrs = range(first, end - addrlen + 1, align)
+      profiling.count('stack_windows', len(addrs))
+      for addr in addrs:
+        offset = addr - start
+        ptr = arch.decode_ptr(data[offset:offset + addrlen])
+        if ptr in callsites:
+          frames.append((addr, callsites[ptr]))
+  return frames
+
+def stack_frames(analysis, memory, arch, sp, isr_ret, align, unwind = False):
+  """
+  Return a list of (stack address, CallInfo) tuples for the return
+  addresses in the given memory dump. When unwind is True (and the
+  architecture supports it), this follows the chain of stack frames,
+  otherwise all data on the stack that looks like a return address is
+  used (see find_stack_frames).
+  """
+  symbols, callsites, addr_to_line = analysis
+  if unwind and hasattr(arch, 'unwind'):
+    with profiling.phase('unwind'):
+      frames = arch.unwind(symbols, callsites, memory, sp, isr_ret)
+    # None means the elf file lacks the info needed for unwinding
+    if frames is not None:
+      return frames
+  return find_stack_frames(callsites, memory, arch, sp, align)
+
+def prefetch_names(symbols, frames, isr_ret):
+  """
+  Demangle all function names needed for the given frames in one go.
+  """
+  if symbols.demangled:
+    return
+  names = []
+  for addr, call in frames:
+    names.append(symbols.containing(call.call_addr))
+    if call.callee_addr:
+      names.append(symbols.get(call.callee_addr))
+  if isr_ret:
+    names.append(symbols.containing(isr_ret))
+  demangler.prefetch(name for name in names if name is not None)
+
+def print_stacktrace(analysis, frames, isr_ret):
+  """
+  Print a stacktrace on stdout for the given frames, as returned by
+  stack_frames. When the frames were unwound, frames found by scanning
+  are marked as such.
+  """
+  symbols, callsites, addr_to_line = analysis
+  with profiling.phase('output'):
+    prefetch_names(symbols, frames, isr_ret)
+
+    print("Stacktrace follows (most recent call first)")
+
+    if isr_ret:
+      isr_call = CallInfo(mnemonic='interrupt', call_addr=isr_ret, callee_addr=None)
+      generate_frame(symbols, 'isr-return', addr_to_line, isr_call)
+
+    scanned = getattr(frames, 'scanned', ())
+    for addr, call in frames:
+      generate_frame(symbols, addr, addr_to_line, call, addr in scanned)
+
+def generate_stacktrace(analysis, memory, arch, sp, isr_ret, align, unwind = False):
+  """
+  Generate a stacktrace on stdout from looking at the given memory dump
+  and elf analysis results.
+  """
+  frames = stack_frames(analysis, memory, arch, sp, isr_ret, align, unwind)
+  print_stacktrace(analysis, frames, isr_ret)
+
+def expand_dump_paths(specs):
+  """
+  Expand the memory dump arguments into a list of files. Each argument
+  can be a file, a directory (all .hex files inside are used) or a glob
+  pattern. The result is sorted within each argument, so the output
+  order is deterministic. Raises FileNotFoundError when a directory or
+  pattern matches no files.
+  """
+  paths = []
+  for spec in specs:
+    if os.path.isdir(spec):
+      matches = sorted(glob.glob(os.path.join(spec, '*.hex')))
+    elif glob.has_magic(spec):
+      matches = sorted(glob.glob(spec))
+    else:
+      paths.append(spec)
+      continue
+    if not matches:
+      raise FileNotFoundError("No memory dumps found in {}".format(spec))
+    paths += matches
+  return paths
+
+# State shared with the batch worker processes. This is set up before
+# the pool is created, so forked workers inherit it rather than having
+# it pickled for every dump.
+batch_state = None
+
+# Below this many bytes of task stacks in a dump, the stacks are not
+# scanned in parallel, since starting the worker processes would take
+# longer than it saves.
+parallel_min_stack_bytes = 1 << 20
+
+def scan_dump(path):
+  """
+  Read and scan a single memory dump for batch mode. Returns a (frames,
+  error) tuple.
+  """
+  from intelhex import IntelHex
+  analysis, arch, sp, isr_ret, align, unwind = batch_state
+  try:
+    memory = IntelHex(path)
+  except Exception as e:
+    return None, str(e)
+  return stack_frames(analysis, memory, arch, sp, isr_ret, align, unwind), None
+
+def worker_pool(jobs):
+  """
+  Create a pool of jobs (default: number of CPUs) workers to process
+  dumps or stacks with batch_state.
+  """
+  import multiprocessing
+  import multiprocessing.pool
+
+  # Workers are forked, so they share the analysis results without
+  # copying (the arch object cannot be pickled anyway). Where fork is
+  # not available, fall back to threads.
+  if 'fork' in multiprocessing.get_all_start_methods():
+    return multiprocessing.get_context('fork').Pool(jobs)
+  return multiprocessing.pool.ThreadPool(jobs)
+
+def scan_dumps(analysis, paths, arch, sp, isr_ret, align, jobs, unwind = False):
+  """
+  Read and scan a list of memory dumps in parallel. Yields a (path,
+  frames, error) tuple for each dump, in the order of the given paths.
+  """
+  global batch_state
+  batch_state = (analysis, arch, sp, isr_ret, align, unwind)
+
+  with worker_pool(jobs) as pool:
+    for path, (frames, error) in zip(paths, pool.imap(scan_dump, paths, chunksize=8)):
+      yield path, frames, error
+
+def generate_batch_stacktraces(analysis, paths, arch, sp, isr_ret, align, jobs, unwind = False):
+  """
+  Generate stacktraces for a list of memory dumps. The dumps are read and
+  scanned in parallel, but the traces are printed in the order of the
+  given paths.
+  """
+  for path, frames, error in scan_dumps(analysis, paths, arch, sp, isr_ret, align, jobs, unwind):
+    print("==> {} <==".format(path))
+    if error:
+      print("Failed to read memory dump: {}".format(error))
+    else:
+      print_stacktrace(analysis, frames, isr_ret)
+    print()
+
+def scan_task(task):
+  """
+  Scan the stack of a single task for generate_task_stacktraces.
+  """
+  analysis, arch, memory, align, unwind = batch_state
+  # Only look at the stack of this task, not at the stacks above it
+  stack = memory[task.sp:task.end] if task.end is not None else memory[task.sp:]
+  return stack_frames(analysis, stack, arch, task.sp, task.resume, align, unwind)
 
-  print("Stacktrace follows (most recent call first)")
+def generate_task_stacktraces(analysis, memory, arch, tasks, align, jobs, unwind = False):
+  """
+  Generate a stacktrace for each of the given rtos.Tasks in a memory
+  dump. Big stacks are scanned in parallel, but the traces are printed
+  in the order of the given tasks.
+  """
+  global batch_state
+  batch_state = (analysis, arch, memory, align, unwind)
+
+  parallel = False
+  if jobs != 1 and len(tasks) > 1:
+    memory_end = memory.maxaddr() + 1
+    stack_bytes = sum((task.end if task.end is not None else memory_end) - task.sp for task in tasks)
+    parallel = stack_bytes >= parallel_min_stack_bytes
+  if parallel:
+    # The workers are forked for each dump, since they need its memory
+    pool = worker_pool(jobs)
+    results = pool.imap(scan_task, tasks)
+  else:
+    pool = None
+    results = map(scan_task, tasks)
 
+  try:
+    for task, frames in zip(tasks, results):
+      if task.end is not None:
+        stack = "0x{:x}-0x{:x}".format(task.start, task.end)
+      else:
+        stack = "from 0x{:x}".format(task.start)
+      print("==> Task {} (stack {}, sp 0x{:x}{}) <==".format(
+        task.name, stack, task.sp, ", running" if task.current else ""))
+      print_stacktrace(analysis, frames, task.resume)
+      print()
+  finally:
+    if pool is not None:
+      pool.terminate()
+
+def print_variables(index, memory):
+  """
+  Print the value of every global variable in the given memory dump.
+  """
+  found = index.decode(memory)
+  demangler.prefetch(var.name for var in found)
+  for var in found:
+    desc = '{} byte{}'.format(var.size, '' if var.size == 1 else 's')
+    if var.type:
+      desc = '{}, {}'.format(var.type, desc)
+    line = "0x{:06x} {} ({}) = {}".format(var.addr, symbol_name(index.symbols, var.name), desc, var.value)
+    if var.partial:
+      line += " (partial)"
+    print(line)
+
+def generate_variables(elf, arch, paths):
+  """
+  Print the values of the global variables in each of the given
+  (full RAM) memory dumps.
+  """
+  from intelhex import IntelHex
+  import variables
+
+  with profiling.phase('variables'):
+    index = variables.VariableIndex.from_elf(elf, arch)
+  profiling.count('variables', len(index))
+
+  for path in paths:
+    if len(paths) > 1:
+      print("==> {} <==".format(path))
+    try:
+      with profiling.phase('read_dump'):
+        memory = IntelHex(path)
+    except Exception as e:
+      print("Failed to read memory dump: {}".format(e))
+    else:
+      with profiling.phase('decode_variables'):
+        print_variables(index, memory)
+    if len(paths) > 1:
+      print()
+
+def trace_signature(symbols, frames, isr_ret, isr = True, offsets = False, all_frames = False):
+  """
+  Return the signature of a stacktrace, to group traces of the same
+  crash: A list of the names of the functions in the trace, most recent
+  first. With isr, the function containing isr_ret is included, with
+  offsets the offset of each call in its function is added to the name.
+  Unless all_frames is True, frames that are likely bogus (i.e. they
+  call a function other than the one containing the next more recent
+  frame) are left out.
+  """
+  def describe(addr):
+    name = address_to_containing_function(symbols, addr)
+    index = symbols.find(addr)
+    if offsets and index >= 0:
+      name += '+0x{:x}'.format(addr - symbols.starts[index])
+    return name, symbols.starts[index] if index >= 0 else None
+
+  prefetch_names(symbols, frames, isr_ret)
+  signature = []
+  # Start of the function that the next frame should have called
+  expected = None
   if isr_ret:
-    isr_call = CallInfo(mnemonic='interrupt', call_addr=isr_ret, callee_addr=None)
-    generate_frame(symdict, 'isr-return', addr_to_line, isr_call)
-
-  # Find all addrlen-sized pointers in the stack that match a call
-  # instruction (e.g. are likely a return address on the stack)
-  addresses = memory.addresses()
-  for addr in addresses:
-    if sp is not None and addr < sp:
+    name, expected = describe(isr_ret)
+    if isr:
+      signature.append(name)
+
+  for addr, call in frames:
+    if (not all_frames and expected is not None and call.callee_addr is not None and
+        call.callee_addr != expected and symbols.get(call.callee_addr) is not None):
+      # Probably a stale return address from an earlier call
       continue
+    name, expected = describe(call.call_addr)
+    signature.append(name)
+  return signature
 
-    if addr % align == 0 and all(addr + i in addresses for i in range(addrlen)):
-      ptr = arch.decode_ptr(memory.tobinstr(start=addr, size=addrlen))
-      if ptr in callsites:
-        generate_frame(symdict, addr, addr_to_line, callsites[ptr])
+def generate_buckets(analysis, paths, arch, sp, isr_ret, align, jobs, index, top,
+                     unwind = False, signature_options = None):
+  """
+  Add the given memory dumps to a buckets.BucketIndex, skipping dumps
+  that were added before, and print the top biggest buckets. The dumps
+  are grouped by their trace_signature (passing signature_options).
+  """
+  import time
+
+  new = []
+  for path in paths:
+    path = os.path.abspath(path)
+    try:
+      st = os.stat(path)
+    except OSError as e:
+      print("Failed to read memory dump: {}".format(e))
+      continue
+    if not index.is_indexed(path, st.st_mtime, st.st_size):
+      new.append((path, st))
+
+  symbols = analysis[0]
+  with profiling.phase('buckets'):
+    scanned = scan_dumps(analysis, [path for path, st in new], arch, sp, isr_ret, align, jobs, unwind)
+    for count, ((path, st), (_, frames, error)) in enumerate(zip(new, scanned), 1):
+      signature = None
+      if error:
+        print("Failed to read memory dump {}: {}".format(path, error))
+      else:
+        signature = trace_signature(symbols, frames, isr_ret, **(signature_options or {}))
+      index.add(path, st.st_mtime, st.st_size, signature)
+      # Commit regularly, so an interrupted run does not lose everything
+      if count % 1000 == 0:
+        index.commit()
+    index.commit()
+
+  def timestamp(t):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(t))
+
+  buckets, dumps, unreadable = index.totals()
+  print("Added {} new dumps, {} dumps in {} buckets ({} unreadable)".format(len(new), dumps, buckets, unreadable))
+  for rank, (bucket, signature, count, first_seen, last_seen, examples) in enumerate(index.top(top), 1):
+    print()
+    print("#{} {}: {} dumps, first seen {}, last seen {}".format(
+          rank, bucket, count, timestamp(first_seen), timestamp(last_seen)))
+    for name in signature:
+      print("    " + name)
+    for path in examples:
+      print("  e.g. " + path)
+
+class UnsupportedArchError(Exception):
+  pass
+
+def open_elf(path):
+  """
+  Open the given elf file and set up the architecture-specific code for
+  it. Returns an (ELFFile, arch) tuple.
+  """
+  from elftools.elf.elffile import ELFFile
+
+  # Note that file is kept open, ELFFile reads from it on the fly.
+  elf = ELFFile(open(path, 'rb'))
+
+  if elf['e_machine'] == 'EM_AVR':
+    import avr
+    arch = avr.ArchAvr(elf)
+  elif elf['e_machine'] == 'EM_ARM':
+    import arm
+    arch = arm.ArchArm(elf)
+  else:
+    raise UnsupportedArchError("Unsupported elf file architecture (machine id: {}, flags: 0x{:X})".format(elf['e_machine'], elf['e_flags']))
+  return elf, arch
+
+def load_analysis(path, elf, arch, analysis_cache = None, lazy_lines = False):
+  """
+  Return the analysis results for the given elf file (see analyze_elf),
+  from the given AnalysisCache if possible.
+  """
+  analysis = None
+  if analysis_cache:
+    with profiling.phase('cache_load'):
+      key = cache.elf_hash(path)
+      analysis = analysis_cache.load(key)
+    profiling.count('cache_misses' if analysis is None else 'cache_hits')
+
+  if analysis is None:
+    if analysis_cache and hasattr(arch, 'function_cache'):
+      # Reuse the calls found in functions that are unchanged since an
+      # earlier analyzed version of the program
+      arch.function_cache = analysis_cache.functions
+    analysis = analyze_elf(elf, arch, lazy_lines)
+    if analysis_cache:
+      with profiling.phase('cache_store'):
+        # Save the function cache first, so its size counts when store
+        # evicts old files
+        analysis_cache.functions.save()
+        analysis_cache.store(key, *analysis)
+  elif analysis[2] is None:
+    # Cached without line table, decode lazily from the elf
+    analysis = (analysis[0], analysis[1], dwarf.get_addr_to_line_map(elf, lazy = True, exclude = arch.get_data_regions(elf)))
+  print_skipped(analysis[0].skipped)
+  return analysis
+
+def export_sidecar(path, elf_path, elf, arch, analysis):
+  """
+  Write the given analysis results to a sidecar file (see
+  sidecar.write_sidecar), which can be used instead of the elf file
+  later. A lazily decoded line table is fully decoded first.
+  """
+  import sidecar
+
+  symbols, callsites, addr_to_line = analysis
+  if not isinstance(addr_to_line, dwarf.LineTable):
+    with profiling.phase('line_table'):
+      addr_to_line = dwarf.get_addr_to_line_map(elf, exclude = arch.get_data_regions(elf))
+
+  if not symbols.demangled:
+    demangler.prefetch(symbols.names)
+  with profiling.phase('export'):
+    sidecar.write_sidecar(path, (symbols, callsites, addr_to_line), arch,
+                          lambda name: symbol_name(symbols, name), cache.elf_hash(elf_path))
+
+class Analyzer:
+  """
+  Analyzes memory dumps against a single elf file. The elf file is
+  analyzed once when constructing, after which any number of memory
+  dumps can be analyzed quickly:
+
+      analyzer = Analyzer('program.elf')
+      for frame in analyzer.stacktrace('dump.hex', sp=0x21AC):
+        print(frame)
+  """
+  def __init__(self, path, analysis_cache = None, lazy_lines = False):
+    self.path = path
+    self.elf, self.arch = open_elf(path)
+    self.analysis = load_analysis(path, self.elf, self.arch, analysis_cache, lazy_lines)
+
+  @classmethod
+  def from_sidecar(cls, path):
+    """
+    Create an Analyzer from a sidecar file (see export_sidecar) rather
+    than an elf file. This does not need elftools or capstone, but
+    unwinding is not supported.
+    """
+    import sidecar
+
+    analyzer = cls.__new__(cls)
+    analyzer.path = path
+    analyzer.elf = None
+    analyzer.analysis, analyzer.arch = sidecar.load_sidecar(path)
+    return analyzer
+
+  def find_frames(self, memory, *, sp = None, isr_return = None, unaligned = False, unwind = False):
+    """
+    Return the (stack address, CallInfo) tuples for all likely return
+    addresses in the given memory dump. See stacktrace for arguments.
+    """
+    if not hasattr(memory, 'segments'):
+      from intelhex import IntelHex
+      memory = IntelHex(memory)
+
+    align = 1 if unaligned else self.arch.get_alignment()
+    return stack_frames(self.analysis, memory, self.arch, sp, isr_return, align, unwind)
+
+  def stacktrace(self, memory, *, sp = None, isr_return = None, unaligned = False, unwind = False):
+    """
+    Return a list of Frame objects (most recent call first) for the
+    given memory dump. memory can be an IntelHex object, or a filename or
+    file object to read Intel hex data from. sp, isr_return, unaligned
+    and unwind (keyword-only) work like the corresponding commandline
+    options.
+    """
+    symbols, callsites, addr_to_line = self.analysis
+    frames = self.find_frames(memory, sp = sp, isr_return = isr_return, unaligned = unaligned, unwind = unwind)
+    prefetch_names(symbols, frames, isr_return)
+
+    result = []
+    if isr_return:
+      isr_call = CallInfo(mnemonic='interrupt', call_addr=isr_return, callee_addr=None)
+      result.append(make_frame(symbols, 'isr-return', addr_to_line, isr_call))
+    scanned = getattr(frames, 'scanned', ())
+    for addr, call in frames:
+      result.append(make_frame(symbols, addr, addr_to_line, call, addr in scanned))
+    return result
+
+def generate_log_stacktraces(analysis, paths, arch, sp, isr_ret, align, unwind = False):
+  """
+  Generate stacktraces for all memory dumps found in the given console
+  logs. Logs are processed as a stream, printing each trace as soon as
+  the dump is complete. The SP and return address printed with each dump
+  are used, unless overridden by sp and isr_ret.
+  """
+  import consolelog
+
+  for path in paths:
+    if path == '-':
+      stream = io.TextIOWrapper(sys.stdin.buffer, errors='replace')
+      name = '<stdin>'
+    else:
+      stream = open(path, errors='replace')
+      name = path
+
+    with stream:
+      for dump in consolelog.iter_dumps(stream):
+        print("==> {}:{} <==".format(name, dump.line))
+        if not dump.complete:
+          print("Warning: Dump is incomplete, trace might be missing frames")
+        dump_sp = sp if sp is not None else dump.sp
+        dump_isr_ret = isr_ret if isr_ret is not None else dump.isr_return
+        generate_stacktrace(analysis, dump.memory, arch, dump_sp, dump_isr_ret, align, unwind)
+        print()
+        sys.stdout.flush()
 
 def main():
   parser = argparse.ArgumentParser(description = 'Analyze AVR memory dumps')
   parser.add_argument('--isr-return', help='ISR return (byte) address to prepend to the trace', metavar='0x123', type=lambda x: int(x, 0))
   parser.add_argument('--elf', help='Compiled elf file')
+  parser.add_argument('--sidecar', help='Sidecar file written by --export, to use instead of the elf file', metavar='FILE')
+  parser.add_argument('--export', help='Write the analysis of the elf file to the given sidecar file, which contains just what is needed to generate stacktraces (memory dumps are optional with this option)', metavar='FILE')
   parser.add_argument('--cppfilt', help='Path to c++filt command')
   parser.add_argument('--unaligned', action='store_true', help='Ignore alignment of stack values, might produce a more complete trace')
   parser.add_argument('--sp', help='Stack pointer, only analyze data from this (byte) address upwards (useful when hex file contains a full memory dump)', metavar='0x123', type=lambda x: int(x, 0))
-  parser.add_argument('memory', help='Memory dump file')
+  parser.add_argument('--cache-dir', help='Directory to cache elf analysis results in (default: {})'.format(cache.default_cache_dir()))
+  parser.add_argument('--cache-size', help='Maximum total size of the analysis cache in MiB (default: 256)', type=int, default=256)
+  parser.add_argument('--lazy-lines', action='store_true', help='Only decode line number info for the compilation units that are actually needed, rather than all of them up front')
+  parser.add_argument('--no-cache', action='store_true', help='Do not read or write cached elf analysis results')
+  parser.add_argument('--jobs', '-j', help='Number of parallel processes to use when disassembling large ARM files or analyzing multiple memory dumps (default: number of CPUs)', type=int)
+  parser.add_argument('--log', action='store_true', help='Treat the memory arguments as raw console logs (- for stdin) containing any number of dumps as printed by dump_memory.h, including SP and return address')
+  parser.add_argument('--unwind', action='store_true', help='Follow the chain of stack frames using the frame size of each function (from the prologue on AVR, from the call frame information on ARM), rather than using all data on the stack that looks like a return address')
+  parser.add_argument('--buckets', help='Rather than printing a trace for each memory dump, group the dumps by their crash signature (the functions in the trace) into the given index (an SQLite database, created when needed) and print the biggest groups. Dumps that are already in the index are skipped', metavar='DB')
+  parser.add_argument('--top', help='Number of groups to print with --buckets (default: 10)', type=int, default=10)
+  parser.add_argument('--signature-no-isr', action='store_true', help='Leave the function containing the ISR return address out of the crash signature')
+  parser.add_argument('--signature-offsets', action='store_true', help='Include the offset of each call in its function in the crash signature')
+  parser.add_argument('--signature-all-frames', action='store_true', help='Include frames in the crash signature that are likely bogus (calling a different function than the next more recent frame)')
+  parser.add_argument('--task', action='append', help='Rather than scanning a single stack, scan the given stack range of an RTOS task (with an optional name for the output) and print a trace for each task. Can be given multiple times. The task containing --sp is considered the running task, --isr-return applies to that task only', metavar='[NAME=]0x100-0x200')
+  parser.add_argument('--rtos', choices=['freertos'], help='Rather than scanning a single stack, find the stack of each task by walking the task lists of the given RTOS in a full RAM dump and print a trace for each task. --sp and --isr-return apply to the running task only')
+  parser.add_argument('--variables', action='store_true', help='Rather than printing a stacktrace, print the value of every global variable in the memory dump(s), which should contain all of RAM (using the type info from the elf file when available)')
+  parser.add_argument('--profile', action='store_true', help='Print the time spent in each phase of the analysis and other statistics on stderr')
+  parser.add_argument('--profile-json', help='Write the time spent in each phase of the analysis and other statistics as JSON to the given file (- for stdout)', metavar='FILE')
+  parser.add_argument('memory', nargs='*', help='Memory dump file(s). Directories (containing .hex files) and glob patterns are also accepted, to analyze multiple dumps at once')
   args = parser.parse_args()
 
-  if not args.elf:
+  if not args.elf and not args.sidecar:
     sys.stderr.write("Need elf file to generate stack trace\nb")
     sys.exit(1)
 
-  # Store cppfilt option
-  global cppfilt
-  if args.cppfilt:
-    cppfilt = args.cppfilt
+  if args.export and not args.elf:
+    parser.error('--export needs an elf file')
 
-  # Note that file is kept open, ELFFile reads from it on the fly.
-  elf = ELFFile(open(args.elf, 'rb'))
+  if not args.memory and not args.export:
+    parser.error('the following arguments are required: memory')
 
-  if elf['e_machine'] == 'EM_AVR':
-    import avr
-    arch = avr.ArchAvr(elf)
-  elif elf['e_machine'] == 'EM_ARM':
-    import arm
-    arch = arm.ArchArm(elf)
+  if args.buckets and args.log:
+    parser.error('--buckets cannot be used with --log')
+
+  if args.variables and not args.elf:
+    parser.error('--variables needs an elf file')
+
+  if args.variables and (args.log or args.buckets or args.export):
+    parser.error('--variables cannot be used with --log, --buckets or --export')
+
+  if args.task and args.rtos:
+    parser.error('--task cannot be used with --rtos')
+
+  if (args.task or args.rtos) and (args.log or args.buckets or args.variables):
+    parser.error('--task and --rtos cannot be used with --log, --buckets or --variables')
+
+  if args.rtos and not args.elf:
+    parser.error('--rtos needs an elf file')
+
+  if args.task or args.rtos:
+    import rtos
+
+    try:
+      tasks = [rtos.parse_task_range(spec) for spec in args.task or ()]
+    except rtos.TaskError as e:
+      parser.error(str(e))
+
+  # Console logs are read as they are, other memory arguments can be
+  # directories or patterns
+  paths = []
+  if not args.log:
+    try:
+      paths = expand_dump_paths(args.memory)
+    except FileNotFoundError as e:
+      sys.stderr.write("{}\n".format(e))
+      sys.exit(1)
+
+  # Store cppfilt option
+  if args.cppfilt:
+    demangler.cppfilt = args.cppfilt
+
+  if args.profile or args.profile_json:
+    profiling.profiler.enabled = True
+
+  if args.elf:
+    try:
+      with profiling.phase('open_elf'):
+        elf, arch = open_elf(args.elf)
+    except UnsupportedArchError as e:
+      sys.stderr.write("{}\n".format(e))
+      sys.exit(1)
+
+    if hasattr(arch, 'jobs'):
+      arch.jobs = args.jobs
+
+    if args.variables:
+      # Variables are decoded from the elf file directly
+      analysis = None
+    else:
+      analysis_cache = None
+      if not args.no_cache:
+        analysis_cache = cache.AnalysisCache(args.cache_dir, args.cache_size << 20)
+      analysis = load_analysis(args.elf, elf, arch, analysis_cache, args.lazy_lines)
+
+    if args.export:
+      export_sidecar(args.export, args.elf, elf, arch, analysis)
   else:
-    sys.stderr.write("Unsupported elf file architecture (machine id: {}, flags: 0x{:X})\n".format(elf['e_machine'], elf['e_flags']))
-    sys.exit(1)
+    import sidecar
 
-  # Read memory file
-  memory = IntelHex(args.memory)
+    try:
+      with profiling.phase('load_sidecar'):
+        analysis, arch = sidecar.load_sidecar(args.sidecar)
+    except (OSError, ValueError, sidecar.SidecarError) as e:
+      sys.stderr.write("Failed to load sidecar file: {}\n".format(e))
+      sys.exit(1)
 
   if args.unaligned:
     align = 1
   else:
     align = arch.get_alignment()
 
-  generate_stacktrace(elf, memory, arch, args.sp, args.isr_return, align)
-
-main()
+  if not args.memory:
+    pass
+  elif args.variables:
+    generate_variables(elf, arch, paths)
+  elif args.buckets:
+    signature_options = {
+      'isr': not args.signature_no_isr,
+      'offsets': args.signature_offsets,
+      'all_frames': args.signature_all_frames,
+    }
+    import buckets
+
+    try:
+      index = buckets.BucketIndex(args.buckets, signature_options)
+    except buckets.BucketError as e:
+      sys.stderr.write("{}\n".format(e))
+      sys.exit(1)
+    try:
+      generate_buckets(analysis, paths, arch, args.sp, args.isr_return, align,
+                       args.jobs, index, args.top, args.unwind, signature_options)
+    finally:
+      index.close()
+  elif args.task or args.rtos:
+    from intelhex import IntelHex
+    if args.rtos:
+      # The symbols and structure layout are the same for every dump
+      try:
+        freertos = rtos.FreeRTOS(elf, arch)
+      except rtos.TaskError as e:
+        sys.stderr.write("{}\n".format(e))
+        sys.exit(1)
+    for path in paths:
+      if len(paths) > 1:
+        print("==> {} <==".format(path))
+      with profiling.phase('read_dump'):
+        memory = IntelHex(path)
+      if args.rtos:
+        with profiling.phase('find_tasks'):
+          tasks = freertos.tasks(analysis[0], memory, args.sp, args.isr_return)
+      else:
+        tasks = rtos.mark_current(tasks, args.sp, args.isr_return)
+      generate_task_stacktraces(analysis, memory, arch, tasks, align, args.jobs, args.unwind)
+  elif args.log:
+    generate_log_stacktraces(analysis, args.memory, arch, args.sp, args.isr_return, align, args.unwind)
+  else:
+    if len(paths) == 1 and paths[0] == args.memory[0]:
+      # Read memory file
+      from intelhex import IntelHex
+      with profiling.phase('read_dump'):
+        memory = IntelHex(paths[0])
+      generate_stacktrace(analysis, memory, arch, args.sp, args.isr_return, align, args.unwind)
+    else:
+      generate_batch_stacktraces(analysis, paths, arch, args.sp, args.isr_return, align, args.jobs, args.unwind)
+
+  if args.profile:
+    sys.stdout.flush()
+    sys.stderr.write(profiling.profiler.format())
+  if args.profile_json == '-':
+    sys.stdout.write(profiling.profiler.format_json())
+  elif args.profile_json:
+    with open(args.profile_json, 'w') as f:
+      f.write(profiling.profiler.format_json())
+
+if __name__ == '__main__':
+  main()
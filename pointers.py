@@ -0,0 +1,98 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+
+# Decoding of return addresses on the stack. These do not depend on the
+# elf file, so they are shared by the architecture-specific code (e.g.
+# avr.ArchAvr) and sidecar files, which are used without elftools or
+# capstone. numpy is only imported by the vectorized versions.
+
+def decode_avr_ptr(bytestr):
+  """
+  Decode an AVR return address (a big-endian word address) into a byte
+  address.
+  """
+  wordptr = int.from_bytes(bytestr, byteorder = 'big')
+
+  # Memory contains word addresses, convert to byte addresses
+  return wordptr * 2
+
+def decode_avr_ptrs(data, first, step, addrlen):
+  """
+  Vectorized version of decode_avr_ptr: Decode the addrlen-sized
+  fragments starting at offset first, first + step, etc. in data into
+  a numpy array of return addresses. Requires numpy.
+  """
+  import numpy
+  buf = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int64)
+  count = len(buf) - addrlen + 1
+  if count <= first:
+    return numpy.zeros(0, dtype=numpy.int64)
+
+  # Combine shifted views of the data into big-endian pointers
+  wordptr = numpy.zeros(count, dtype=numpy.int64)
+  for i in range(addrlen):
+    wordptr = wordptr << 8 | buf[i:i + count]
+
+  # Memory contains word addresses, convert to byte addresses
+  return wordptr[first::step] * 2
+
+def decode_arm_ptr(bytestr):
+  """
+  Decode an ARM return address (4 bytes, little-endian).
+  """
+  ptr = int.from_bytes(bytestr, byteorder = 'little')
+  # Clear lower bit, which is used to select between ARM/thumb mode
+  return ptr & ~0x1
+
+def decode_arm_ptrs(data, first, step):
+  """
+  Vectorized version of decode_arm_ptr: Decode the 4-byte fragments
+  starting at offset first, first + step, etc. in data into a numpy
+  array of return addresses. Requires numpy.
+  """
+  import numpy
+  if step % 4 == 0:
+    # Aligned, so just view the data as an array of words
+    end = first + (len(data) - first) // 4 * 4
+    ptrs = numpy.frombuffer(data[first:end], dtype='<u4')[::step // 4]
+  else:
+    buf = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.uint32)
+    count = len(buf) - 3
+    if count <= first:
+      return numpy.zeros(0, dtype=numpy.int64)
+    # Combine shifted views of the data into little-endian pointers
+    ptrs = buf[0:count] | buf[1:count + 1] << 8 | buf[2:count + 2] << 16 | buf[3:count + 3] << 24
+    ptrs = ptrs[first::step]
+
+  # Clear lower bit, which is used to select between ARM/thumb mode
+  return ptrs.astype(numpy.int64) & ~0x1
+
+__all__ = ('decode_avr_ptr', 'decode_avr_ptrs', 'decode_arm_ptr', 'decode_arm_ptrs')
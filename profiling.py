@@ -0,0 +1,156 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import sys
+import time
+import json
+import contextlib
+from collections import OrderedDict
+
+class Profiler:
+  """
+  Collects the wall and CPU time spent in each phase of the analysis,
+  along with counters for the amount of work done (e.g. instructions
+  decoded). Phases can be nested, a nested phase is recorded under the
+  name of its parent (e.g. "symtab/demangle") and its time is included
+  in the parent's time.
+
+  When disabled (the default), phase and count do nothing, so they can
+  be left in the code at very little cost. This is not thread-safe, it
+  is meant for profiling a single commandline run.
+  """
+  def __init__(self):
+    self.enabled = False
+    # Phase path -> [calls, wall time, cpu time]
+    self.phases = OrderedDict()
+    self.counters = OrderedDict()
+    self.stack = []
+    self.start = time.perf_counter()
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    self.stack.append(name)
+    path = '/'.join(self.stack)
+    if path not in self.phases:
+      # Insert now, so parents are listed before their children
+      self.phases[path] = [0, 0.0, 0.0]
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+      yield
+    finally:
+      stats = self.phases[path]
+      stats[0] += 1
+      stats[1] += time.perf_counter() - wall
+      stats[2] += time.process_time() - cpu
+      self.stack.pop()
+
+  def count(self, name, n = 1):
+    self.counters[name] = self.counters.get(name, 0) + n
+
+  def as_dict(self):
+    """ Return the results as a dictionary, suitable for JSON output. """
+    self_rss, children_rss, children_cpu = resource_usage()
+    return {
+      'total_wall': time.perf_counter() - self.start,
+      'total_cpu': time.process_time(),
+      'children_cpu': children_cpu,
+      'peak_rss': self_rss,
+      'peak_rss_children': children_rss,
+      'phases': OrderedDict((path, {'calls': calls, 'wall': wall, 'cpu': cpu})
+                            for path, (calls, wall, cpu) in self.phases.items()),
+      'counters': OrderedDict(self.counters),
+    }
+
+  def format(self):
+    """ Return the results as human-readable text. """
+    result = self.as_dict()
+    lines = ["Profile (nested phases are included in their parent):"]
+    lines.append("  {:<32} {:>9} {:>9} {:>7}".format('phase', 'wall (s)', 'cpu (s)', 'calls'))
+    for path, stats in result['phases'].items():
+      name = '  ' * path.count('/') + path.rsplit('/', 1)[-1]
+      lines.append("  {:<32} {:>9.3f} {:>9.3f} {:>7}".format(name, stats['wall'], stats['cpu'], stats['calls']))
+    lines.append("  {:<32} {:>9.3f} {:>9.3f}".format('total', result['total_wall'], result['total_cpu']))
+    if result['children_cpu'] is not None:
+      lines.append("  {:<32} {:>9} {:>9.3f}".format('child processes', '', result['children_cpu']))
+
+    if result['counters']:
+      lines.append("Counters:")
+      for name, value in result['counters'].items():
+        lines.append("  {:<32} {:>9}".format(name, value))
+
+    if result['peak_rss'] is not None:
+      lines.append("Peak RSS: {:.1f} MiB (child processes: {:.1f} MiB)".format(
+        result['peak_rss'] / 2**20, result['peak_rss_children'] / 2**20))
+    return '\n'.join(lines) + '\n'
+
+  def format_json(self):
+    return json.dumps(self.as_dict(), indent = 2) + '\n'
+
+def resource_usage():
+  """
+  Return the peak RSS (in bytes) of this process and of its (finished)
+  child processes, and the CPU time used by child processes. These are
+  None when this is not supported by the platform.
+  """
+  try:
+    import resource
+  except ImportError:
+    # Not available on Windows
+    return None, None, None
+
+  own = resource.getrusage(resource.RUSAGE_SELF)
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  # ru_maxrss is in KiB on Linux, but in bytes on macOS
+  scale = 1 if sys.platform == 'darwin' else 1024
+  return (own.ru_maxrss * scale, children.ru_maxrss * scale,
+          children.ru_utime + children.ru_stime)
+
+# Reused for all phases while profiling is disabled
+null_phase = contextlib.nullcontext()
+
+# The global profiler, enabled by the --profile option
+profiler = Profiler()
+
+def phase(name):
+  """
+  Return a context manager that records the time spent in the with
+  block as the given phase.
+  """
+  if not profiler.enabled:
+    return null_phase
+  return profiler.phase(name)
+
+def count(name, n = 1):
+  """ Add n to the given counter. """
+  if profiler.enabled:
+    profiler.count(name, n)
+
+__all__ = ('Profiler', 'profiler', 'phase', 'count')
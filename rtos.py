@@ -0,0 +1,230 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import re
+from collections import namedtuple
+
+import variables
+
+# A task stack to scan: name is a label for the output, start and end
+# are the (byte) addresses of the stack area (end is exclusive, None
+# for the end of the memory segment), sp is the address to start
+# scanning from, resume is the address the task will resume at (like
+# --isr-return) and current is True for the task that was running when
+# the dump was made.
+Task = namedtuple('Task', ['name', 'start', 'end', 'sp', 'resume', 'current'])
+
+class TaskError(Exception):
+  pass
+
+def parse_task_range(spec):
+  """
+  Parse a --task argument of the form [NAME=]START-END into a Task.
+  """
+  match = re.fullmatch(r'(?:(.*)=)?(\w+)-(\w+)', spec)
+  if match is None:
+    raise TaskError("Invalid task stack range: {} (expected [NAME=]START-END)".format(spec))
+  name, start, end = match.groups()
+  try:
+    start = int(start, 0)
+    end = int(end, 0)
+  except ValueError:
+    raise TaskError("Invalid task stack range: {} (expected [NAME=]START-END)".format(spec))
+  if end <= start:
+    raise TaskError("Invalid task stack range: {} (end is not after start)".format(spec))
+  if not name:
+    name = '0x{:x}-0x{:x}'.format(start, end)
+  return Task(name=name, start=start, end=end, sp=start, resume=None, current=False)
+
+def mark_current(tasks, sp, isr_ret):
+  """
+  Mark the task whose stack contains sp (if any) as the running task,
+  starting its scan at sp and resuming at isr_ret.
+  """
+  if sp is None:
+    return tasks
+  return [task._replace(sp=sp, resume=isr_ret, current=True) if task.start <= sp < task.end else task
+          for task in tasks]
+
+def read_bytes(memory, addr, size):
+  """ Read bytes from the memory dump, or return None if they are not in the dump. """
+  from intelhex import NotEnoughDataError
+  try:
+    return memory.gets(addr, size)
+  except NotEnoughDataError:
+    return None
+
+class FreeRTOSLayout:
+  """
+  Offsets and sizes of the FreeRTOS structures needed to find the tasks.
+  The defaults are for a 32-bit port without MPU support; when the elf
+  file has debug info, the actual offsets are used instead.
+  """
+  ptrlen = 4
+  # List_t
+  list_size = 20
+  list_end = 8
+  # ListItem_t and MiniListItem_t
+  item_next = 4
+  item_owner = 12
+  # TCB_t
+  tcb_top_of_stack = 0
+  tcb_stack = 48
+  tcb_name = 52
+  tcb_name_len = 16
+  tcb_end_of_stack = None
+
+  @classmethod
+  def from_elf(cls, elf):
+    layout = cls()
+    structs = variables.struct_members(elf, ('tskTaskControlBlock', 'xLIST', 'xLIST_ITEM'))
+    if len(structs) < 3:
+      return layout
+    tcb = structs['tskTaskControlBlock']
+    lst = structs['xLIST']
+    item = structs['xLIST_ITEM']
+    try:
+      layout.ptrlen = tcb['pxTopOfStack'].size
+      layout.list_size = lst[None].size
+      layout.list_end = lst['xListEnd'].offset
+      layout.item_next = item['pxNext'].offset
+      layout.item_owner = item['pvOwner'].offset
+      layout.tcb_top_of_stack = tcb['pxTopOfStack'].offset
+      layout.tcb_stack = tcb['pxStack'].offset
+      layout.tcb_name = tcb['pcTaskName'].offset
+      layout.tcb_name_len = tcb['pcTaskName'].size
+    except KeyError:
+      # Unknown FreeRTOS version, use the defaults
+      return cls()
+    if 'pxEndOfStack' in tcb:
+      layout.tcb_end_of_stack = tcb['pxEndOfStack'].offset
+    return layout
+
+class FreeRTOS:
+  """
+  Finds the tasks in a FreeRTOS memory dump by walking the task lists
+  (pxReadyTasksLists, the delayed, pending and suspended lists) starting
+  from their symbols, with pxCurrentTCB as the running task.
+  """
+  # Task lists, in the order tasks are reported
+  list_symbols = ('pxReadyTasksLists', 'xPendingReadyList', 'xDelayedTaskList1',
+                  'xDelayedTaskList2', 'xSuspendedTaskList', 'xTasksWaitingTermination')
+
+  # Limit on the number of items in a list, in case it is corrupted
+  max_list_items = 1024
+
+  def __init__(self, elf, arch):
+    self.arch = arch
+    self.symbols = {name: (start, end) for start, end, name in variables.object_ranges(elf, arch)}
+    if 'pxCurrentTCB' not in self.symbols:
+      raise TaskError("No pxCurrentTCB symbol found, is this a FreeRTOS program?")
+    self.layout = FreeRTOSLayout.from_elf(elf)
+    self.byteorder = 'little' if elf.little_endian else 'big'
+
+  def read_ptr(self, memory, addr):
+    data = read_bytes(memory, addr, self.layout.ptrlen)
+    if data is None:
+      return None
+    return int.from_bytes(data, self.byteorder)
+
+  def list_owners(self, memory, addr):
+    """ Yield the owners (TCB addresses) of the items in the list at addr. """
+    layout = self.layout
+    list_end = addr + layout.list_end
+    item = self.read_ptr(memory, list_end + layout.item_next)
+    seen = set()
+    while item and item != list_end and item not in seen and len(seen) < self.max_list_items:
+      seen.add(item)
+      owner = self.read_ptr(memory, item + layout.item_owner)
+      if owner:
+        yield owner
+      item = self.read_ptr(memory, item + layout.item_next)
+
+  def task_control_blocks(self, memory):
+    """ Return the addresses of all TCBs found in the task lists. """
+    tcbs = []
+    current = self.read_ptr(memory, self.symbols['pxCurrentTCB'][0])
+    if current:
+      tcbs.append(current)
+    for name in self.list_symbols:
+      if name not in self.symbols:
+        continue
+      # pxReadyTasksLists is an array with a list for each priority
+      start, end = self.symbols[name]
+      for addr in range(start, end - self.layout.list_size + 1, self.layout.list_size):
+        for tcb in self.list_owners(memory, addr):
+          if tcb not in tcbs:
+            tcbs.append(tcb)
+    return tcbs, current
+
+  def tasks(self, symbols, memory, sp = None, isr_ret = None):
+    """
+    Return a list of Tasks for the given memory dump. sp and isr_ret
+    apply to the running task (the saved stack pointer of the running
+    task is not up to date).
+    """
+    layout = self.layout
+    tcbs, current = self.task_control_blocks(memory)
+
+    found = []
+    for tcb in tcbs:
+      top = self.read_ptr(memory, tcb + layout.tcb_top_of_stack)
+      stack = self.read_ptr(memory, tcb + layout.tcb_stack)
+      if top is None or stack is None:
+        continue
+      name = read_bytes(memory, tcb + layout.tcb_name, layout.tcb_name_len) or b''
+      name = name.split(b'\0', 1)[0].decode('latin1') or '0x{:x}'.format(tcb)
+      end = None
+      if layout.tcb_end_of_stack is not None:
+        end_of_stack = self.read_ptr(memory, tcb + layout.tcb_end_of_stack)
+        if end_of_stack is not None:
+          end = end_of_stack + layout.ptrlen
+      found.append([name, tcb, stack, top, end])
+
+    # Without pxEndOfStack, a stack ends where the next stack or TCB
+    # starts (both are usually allocated from the same heap)
+    boundaries = sorted(addr for task in found for addr in task[1:3])
+
+    result = []
+    for name, tcb, stack, top, end in found:
+      task_sp = top
+      resume = None
+      if tcb == current:
+        if sp is not None and stack <= sp and (end is None or sp < end):
+          task_sp = sp
+        resume = isr_ret
+      elif hasattr(self.arch, 'task_resume_addr'):
+        resume = self.arch.task_resume_addr(symbols, memory, top)
+      if end is None:
+        end = next((addr for addr in boundaries if addr > task_sp), None)
+      result.append(Task(name=name, start=stack, end=end, sp=task_sp, resume=resume, current=tcb == current))
+    return result
+
+__all__ = ('Task', 'TaskError', 'parse_task_range', 'mark_current', 'FreeRTOS')
@@ -0,0 +1,63 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import io
+import mmap
+
+# Section flag for compressed contents (see the ELF gABI)
+SHF_COMPRESSED = 0x800
+
+def section_view(section):
+  """
+  Return the contents of the given elftools section as a memoryview.
+  When possible, this maps the elf file into memory rather than reading
+  (and copying) the whole section like section.data() does, so slices
+  passed to the decoders do not copy anything either. The mapping is
+  copy-on-write, so the view is writable (which capstone needs to avoid
+  copying) without affecting the file.
+  """
+  if section['sh_type'] == 'SHT_NOBITS' or section['sh_flags'] & SHF_COMPRESSED:
+    return memoryview(section.data())
+
+  try:
+    fileno = section.stream.fileno()
+    mapped = mmap.mmap(fileno, 0, access = mmap.ACCESS_COPY)
+  except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+    # Not a real file (e.g. BytesIO), or it cannot be mapped
+    return memoryview(section.data())
+
+  offset = section['sh_offset']
+  size = section['sh_size']
+  if offset + size > len(mapped):
+    # Truncated file, let elftools deal with it
+    return memoryview(section.data())
+  return memoryview(mapped)[offset:offset + size]
+
+__all__ = ('section_view',)
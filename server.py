@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import io
+import os
+import sys
+import json
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cache
+from main import Analyzer, demangler
+
+def buffer_size(values):
+  """ Return the size in bytes of an array (or other buffer) of numbers. """
+  return memoryview(values).nbytes
+
+def estimate_size(analysis):
+  """
+  Return an estimate of the memory used by the given analysis results,
+  in bytes: the sizes of the arrays in the indexes, plus the Python
+  objects for the names and line locations they refer to. Objects that
+  are shared (e.g. interned strings) are counted anyway, so this is only
+  meant to enforce a memory budget approximately.
+  """
+  symbols, callsites, addr_to_line = analysis
+  size = sum(buffer_size(values) for values in (symbols.starts, symbols.ends, symbols.name_ids))
+  size += sys.getsizeof(symbols.names) + sum(sys.getsizeof(name) for name in symbols.names)
+  size += sum(buffer_size(values) for values in (callsites.returns, callsites.calls,
+                                                 callsites.callees, callsites.mnemonic_ids))
+  # A lazily decoded line table grows while it is used, only count a
+  # fully decoded one
+  if hasattr(addr_to_line, 'starts'):
+    size += sum(buffer_size(values) for values in (addr_to_line.starts, addr_to_line.ends, addr_to_line.locs))
+    size += sys.getsizeof(addr_to_line.locations)
+    filenames = set()
+    for location in addr_to_line.locations:
+      size += sys.getsizeof(location) + sys.getsizeof(location[1])
+      filenames.add(location[0])
+    size += sum(sys.getsizeof(filename) for filename in filenames)
+  return size
+
+class Firmware:
+  """ An Analyzer for a single elf file, kept in memory. """
+  def __init__(self, path, mtime, analyzer):
+    self.path = path
+    self.mtime = mtime
+    self.analyzer = analyzer
+    self.size = estimate_size(analyzer.analysis)
+
+class FirmwareRegistry:
+  """
+  Keeps the analysis results of multiple elf files in memory. When the
+  total (estimated) size exceeds the given budget, the least recently
+  used elf files are dropped. This class is thread-safe.
+  """
+  def __init__(self, budget, analysis_cache = None):
+    self.budget = budget
+    self.analysis_cache = analysis_cache
+    self.firmwares = OrderedDict()
+    self.lock = threading.Lock()
+    # Per-path locks, so an elf file is never loaded twice in parallel
+    self.load_locks = {}
+
+  def get(self, path):
+    """
+    Return the Firmware for the given elf file, loading (or reloading,
+    when the file was changed) it when needed.
+    """
+    path = os.path.realpath(path)
+    mtime = os.stat(path).st_mtime
+
+    with self.lock:
+      firmware = self.firmwares.get(path)
+      if firmware and firmware.mtime == mtime:
+        self.firmwares.move_to_end(path)
+        return firmware
+      load_lock = self.load_locks.setdefault(path, threading.Lock())
+
+    with load_lock:
+      # Maybe another thread loaded it while we were waiting
+      with self.lock:
+        firmware = self.firmwares.get(path)
+        if firmware and firmware.mtime == mtime:
+          self.firmwares.move_to_end(path)
+          return firmware
+
+      analyzer = Analyzer(path, self.analysis_cache)
+      firmware = Firmware(path, mtime, analyzer)
+
+      with self.lock:
+        self.firmwares[path] = firmware
+        self.firmwares.move_to_end(path)
+        self.evict()
+      return firmware
+
+  def evict(self):
+    """ Drop least recently used firmwares until within budget. """
+    total = sum(f.size for f in self.firmwares.values())
+    # Always keep the most recently used one, even if it is too big
+    while total > self.budget and len(self.firmwares) > 1:
+      path, firmware = self.firmwares.popitem(last = False)
+      total -= firmware.size
+      sys.stderr.write("Dropped {} from memory\n".format(path))
+
+  def loaded(self):
+    with self.lock:
+      return [{'elf': f.path, 'size': f.size} for f in self.firmwares.values()]
+
+def frame_to_dict(frame):
+  """ Convert a Frame into a JSON-serializable dict. """
+  return dict(frame._asdict(), text = str(frame))
+
+class RequestHandler(BaseHTTPRequestHandler):
+  """
+  Handles requests:
+
+   - POST /trace?elf=path&sp=0x123&isr_return=0x456&unaligned=1&unwind=1, with
+     an Intel hex memory dump as the body. The elf parameter can be
+     omitted when only a single elf file is loaded. Returns the trace as
+     JSON.
+   - GET /firmware, returns the elf files currently loaded.
+  """
+  registry = None
+
+  def send_json(self, code, data):
+    body = json.dumps(data, indent = 2).encode('utf8') + b'\n'
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    if urlparse(self.path).path == '/firmware':
+      self.send_json(200, self.registry.loaded())
+    else:
+      self.send_json(404, {'error': 'Not found'})
+
+  def do_POST(self):
+    url = urlparse(self.path)
+    if url.path != '/trace':
+      self.send_json(404, {'error': 'Not found'})
+      return
+
+    query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    try:
+      path = query.get('elf')
+      if path is None:
+        loaded = self.registry.loaded()
+        if len(loaded) != 1:
+          raise ValueError("Need elf parameter")
+        path = loaded[0]['elf']
+      sp = int(query['sp'], 0) if 'sp' in query else None
+      isr_ret = int(query['isr_return'], 0) if 'isr_return' in query else None
+      unaligned = query.get('unaligned', '0') not in ('', '0', 'false')
+      unwind = query.get('unwind', '0') not in ('', '0', 'false')
+      firmware = self.registry.get(path)
+      frames = firmware.analyzer.stacktrace(io.StringIO(body.decode('ascii')), sp = sp, isr_return = isr_ret,
+                                            unaligned = unaligned, unwind = unwind)
+    except Exception as e:
+      self.send_json(400, {'error': str(e)})
+      return
+
+    self.send_json(200, {'elf': firmware.path, 'frames': [frame_to_dict(f) for f in frames]})
+
+  def address_string(self):
+    # Unix sockets have no client address
+    if isinstance(self.client_address, tuple):
+      return super().address_string()
+    return 'unix'
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+  def server_bind(self):
+    if os.path.exists(self.server_address):
+      os.unlink(self.server_address)
+    super().server_bind()
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Serve stacktraces for memory dumps over HTTP, keeping elf analysis results in memory')
+  parser.add_argument('--host', help='Address to listen on (default: 127.0.0.1)', default='127.0.0.1')
+  parser.add_argument('--port', help='Port to listen on (default: 8765)', type=int, default=8765)
+  parser.add_argument('--unix', help='Listen on the given unix socket path instead of TCP', metavar='PATH')
+  parser.add_argument('--preload', help='Elf file(s) to load at startup', nargs='*', default=[], metavar='ELF')
+  parser.add_argument('--memory-budget', help='Approximate amount of memory to use for elf analysis results in MiB (default: 1024)', type=int, default=1024)
+  parser.add_argument('--cppfilt', help='Path to c++filt command')
+  parser.add_argument('--cache-dir', help='Directory to cache elf analysis results in (default: {})'.format(cache.default_cache_dir()))
+  parser.add_argument('--cache-size', help='Maximum total size of the analysis cache in MiB (default: 256)', type=int, default=256)
+  parser.add_argument('--no-cache', action='store_true', help='Do not read or write cached elf analysis results')
+  args = parser.parse_args()
+
+  if args.cppfilt:
+    demangler.cppfilt = args.cppfilt
+
+  analysis_cache = None
+  if not args.no_cache:
+    analysis_cache = cache.AnalysisCache(args.cache_dir, args.cache_size << 20)
+
+  registry = FirmwareRegistry(args.memory_budget << 20, analysis_cache)
+  for path in args.preload:
+    registry.get(path)
+
+  RequestHandler.registry = registry
+  if args.unix:
+    server = ThreadingUnixHTTPServer(args.unix, RequestHandler)
+  else:
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+
+  sys.stderr.write("Listening on {}\n".format(args.unix or "{}:{}".format(args.host, args.port)))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main()
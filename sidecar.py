@@ -0,0 +1,272 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import sys
+import json
+import mmap
+from array import array
+
+import dwarf
+import indexes
+import pointers
+
+# Bump this whenever the layout or meaning of the file changes, so old
+# files are rejected rather than misinterpreted.
+SIDECAR_VERSION = 1
+MAGIC = b'AMAS'
+
+# Arrays are stored little-endian, each starting at a multiple of this
+ALIGNMENT = 8
+
+class SidecarError(Exception):
+  pass
+
+class StringTable:
+  """
+  Read-only list of strings, stored as a blob of concatenated UTF-8
+  encoded strings and an array of offsets into it (with one extra
+  offset for the end of the last string). Strings are only decoded when
+  accessed. When text is False, bytes are returned instead.
+  """
+  def __init__(self, blob, offsets, text = True):
+    self.blob = blob
+    self.offsets = offsets
+    self.text = text
+
+  @staticmethod
+  def encode(strings):
+    """ Return a (blob, offsets) tuple for the given strings. """
+    blob = bytearray()
+    offsets = array('I', [0])
+    for string in strings:
+      blob += string.encode('utf8') if isinstance(string, str) else string
+      offsets.append(len(blob))
+    return bytes(blob), offsets
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    if not 0 <= i < len(self):
+      raise IndexError(i)
+    value = bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+    return value.decode('utf8') if self.text else value
+
+class LocationTable:
+  """
+  Read-only list of (filename, line) tuples, as used in the locations
+  of a dwarf.LineTable, stored as parallel arrays.
+  """
+  def __init__(self, paths, path_ids, lines):
+    self.paths = paths
+    self.path_ids = path_ids
+    self.lines = lines
+
+  def __len__(self):
+    return len(self.lines)
+
+  def __getitem__(self, i):
+    return (self.paths[self.path_ids[i]], self.lines[i])
+
+class SidecarArch:
+  """
+  Stand-in for the architecture-specific code (e.g. ArchAvr), providing
+  just what is needed to find return addresses in a memory dump, based
+  on the parameters stored in a sidecar file.
+  """
+  def __init__(self, name, addrlen, alignment):
+    if name not in ('avr', 'arm'):
+      raise SidecarError("Unsupported architecture in sidecar file: {}".format(name))
+    self.name = name
+    self.addrlen = addrlen
+    self.alignment = alignment
+
+  def get_addrlen(self):
+    """ Return the length of a return address on the stack. """
+    return self.addrlen
+
+  def get_alignment(self):
+    """ Return the alignment of a return address on the stack. """
+    return self.alignment
+
+  def decode_ptr(self, bytestr):
+    """
+    Decode a given stack fragment of size addrlen into a return address.
+    """
+    if self.name == 'avr':
+      return pointers.decode_avr_ptr(bytestr)
+    return pointers.decode_arm_ptr(bytestr)
+
+  def decode_ptrs(self, data, first, step):
+    """
+    Vectorized version of decode_ptr (see the pointers module).
+    Requires numpy.
+    """
+    if self.name == 'avr':
+      return pointers.decode_avr_ptrs(data, first, step, self.addrlen)
+    return pointers.decode_arm_ptrs(data, first, step)
+
+def write_sidecar(path, analysis, arch, demangle, elf_hash = None):
+  """
+  Write the given analysis results (see main.analyze_elf, with a
+  complete LineTable) and parameters of the given arch to a sidecar
+  file. Function names are stored demangled, using the given demangle
+  function.
+  """
+  symbols, callsites, addr_to_line = analysis
+
+  name_blob, name_offsets = StringTable.encode(demangle(name) for name in symbols.names)
+  path_ids = {}
+  loc_paths = array('I')
+  loc_lines = array('I')
+  for filename, line in addr_to_line.locations:
+    loc_paths.append(path_ids.setdefault(filename, len(path_ids)))
+    loc_lines.append(line)
+  path_blob, path_offsets = StringTable.encode(path_ids)
+
+  arrays = [
+    ('sym_starts', symbols.starts),
+    ('sym_ends', symbols.ends),
+    ('sym_name_ids', symbols.name_ids),
+    ('sym_names', name_blob),
+    ('sym_name_offsets', name_offsets),
+    ('call_returns', callsites.returns),
+    ('call_calls', callsites.calls),
+    ('call_callees', callsites.callees),
+    ('call_mnemonic_ids', callsites.mnemonic_ids),
+    ('line_starts', addr_to_line.starts),
+    ('line_ends', addr_to_line.ends),
+    ('line_locs', addr_to_line.locs),
+    ('loc_paths', loc_paths),
+    ('loc_lines', loc_lines),
+    ('paths', path_blob),
+    ('path_offsets', path_offsets),
+  ]
+
+  header = {
+    'arch': {
+      'name': arch.name,
+      'addrlen': arch.get_addrlen(),
+      'alignment': arch.get_alignment(),
+    },
+    'elf_sha256': elf_hash,
+    'mnemonics': callsites.mnemonics,
+    'arrays': {},
+  }
+
+  # Array offsets are relative to the end of the header, so they do not
+  # depend on the (JSON-encoded) size of the header itself
+  blobs = []
+  offset = 0
+  for name, data in arrays:
+    if isinstance(data, array):
+      typecode = data.typecode
+      if sys.byteorder != 'little':
+        data = array(typecode, data)
+        data.byteswap()
+      data = data.tobytes()
+    else:
+      typecode = 'B'
+    padding = -offset % ALIGNMENT
+    blobs.append(b'\0' * padding)
+    offset += padding
+    header['arrays'][name] = (offset, len(data), typecode)
+    blobs.append(data)
+    offset += len(data)
+
+  header_data = json.dumps(header, sort_keys = True).encode('utf8')
+  header_data += b' ' * (-(len(header_data) + 12) % ALIGNMENT)
+
+  with open(path, 'wb') as f:
+    f.write(MAGIC)
+    f.write(SIDECAR_VERSION.to_bytes(4, 'little'))
+    f.write(len(header_data).to_bytes(4, 'little'))
+    f.write(header_data)
+    for blob in blobs:
+      f.write(blob)
+
+def load_sidecar(path):
+  """
+  Load a sidecar file written by write_sidecar. The file is memory
+  mapped, and only parsed on demand. Returns an (analysis, arch) tuple,
+  where analysis is a (SymbolIndex, CallsiteIndex, LineTable) tuple and
+  arch a SidecarArch.
+  """
+  with open(path, 'rb') as f:
+    # Check the fixed part of the header before mapping, since empty
+    # files cannot be mapped
+    start = f.read(12)
+    if not start.startswith(MAGIC):
+      raise SidecarError("Not a sidecar file: {}".format(path))
+    if len(start) < 12:
+      raise SidecarError("Truncated sidecar file: {}".format(path))
+    version = int.from_bytes(start[4:8], 'little')
+    if version != SIDECAR_VERSION:
+      raise SidecarError("Unsupported sidecar file version {} (expected {}): {}".format(version, SIDECAR_VERSION, path))
+    mapped = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+  header_len = int.from_bytes(start[8:12], 'little')
+  base = 12 + header_len
+  if base > len(mapped):
+    raise SidecarError("Truncated sidecar file: {}".format(path))
+  try:
+    header = json.loads(mapped[12:base].decode('utf8'))
+    header['arch'], header['arrays'], header['mnemonics']
+  except (ValueError, TypeError, KeyError) as e:
+    raise SidecarError("Corrupt sidecar file header ({}): {}".format(e, path))
+  view = memoryview(mapped)
+
+  def get(name):
+    offset, length, typecode = header['arrays'][name]
+    if base + offset + length > len(mapped):
+      raise SidecarError("Truncated sidecar file: {}".format(path))
+    data = view[base + offset:base + offset + length]
+    if typecode == 'B':
+      return data
+    if sys.byteorder != 'little':
+      values = array(typecode, data)
+      values.byteswap()
+      return values
+    return data.cast(typecode)
+
+  names = StringTable(get('sym_names'), get('sym_name_offsets'))
+  symbols = indexes.SymbolIndex(get('sym_starts'), get('sym_ends'), get('sym_name_ids'),
+                                names, demangled = True)
+  callsites = indexes.CallsiteIndex(get('call_returns'), get('call_calls'), get('call_callees'),
+                                    get('call_mnemonic_ids'), header['mnemonics'])
+  paths = StringTable(get('paths'), get('path_offsets'), text = False)
+  locations = LocationTable(paths, get('loc_paths'), get('loc_lines'))
+  addr_to_line = dwarf.LineTable(get('line_starts'), get('line_ends'), get('line_locs'), locations)
+
+  params = header['arch']
+  arch = SidecarArch(params['name'], params['addrlen'], params['alignment'])
+  return (symbols, callsites, addr_to_line), arch
+
+__all__ = ('SidecarError', 'write_sidecar', 'load_sidecar')
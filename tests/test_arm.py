@@ -0,0 +1,179 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+
+import sys
+import struct
+import threading
+
+from intelhex import IntelHex
+
+import arm
+import main
+import synthelf
+
+def check_parallel(paths, expected):
+  results = [None] * len(paths)
+  errors = []
+  def load(i):
+    try:
+      results[i] = dict(main.Analyzer(paths[i]).analysis[1].items())
+    except Exception as e:
+      errors.append(e)
+  threads = [threading.Thread(target = load, args = (i,)) for i in range(len(paths))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert not errors
+  assert results == expected
+
+def test_threads_disassemble_independently(tmp_path):
+  # Analyzing different elf files in parallel threads (as the server
+  # does) must give the same results as analyzing each on its own
+  paths = []
+  for seed in (1, 2):
+    program = synthelf.arm_program(functions = 300, text_size = 48 << 10, rows = 100, seed = seed)
+    path = tmp_path / 'program{}.elf'.format(seed)
+    path.write_bytes(program.elf)
+    paths.append(str(path))
+
+  expected = [dict(main.Analyzer(path).analysis[1].items()) for path in paths]
+
+  # Switch threads often, to make interleaving likely
+  interval = sys.getswitchinterval()
+  sys.setswitchinterval(1e-6)
+  try:
+    for attempt in range(3):
+      check_parallel(paths, expected)
+  finally:
+    sys.setswitchinterval(interval)
+
+# A small Thumb program with call frame information (in .debug_frame
+# only, without any other debug info):
+#
+#  leaf: movs r0, #1; bx lr                    (no frame)
+#  mid:  push {r4, lr}; sub sp, #16; bl leaf; add sp, #16; pop {r4, pc}
+#  top:  push {r4, lr}; bl mid; pop {r4, pc}
+#  main: push {r4, lr}; bl top; pop {r4, pc}
+LEAF, MID, TOP, MAIN, END = 0x100, 0x108, 0x114, 0x120, 0x128
+
+def cfi_program():
+  text = bytearray(END)
+  def code(addr, *halfwords):
+    struct.pack_into('<{}H'.format(len(halfwords)), text, addr, *halfwords)
+  code(LEAF, 0x2001, 0x4770, 0xbf00, 0xbf00)
+  code(MID, 0xb510, 0xb084, *synthelf.thumb_bl(MID + 4, LEAF), 0xb004, 0xbd10)
+  code(TOP, 0xb510, *synthelf.thumb_bl(TOP + 2, MID), 0xbd10, 0xbf00, 0xbf00)
+  code(MAIN, 0xb510, *synthelf.thumb_bl(MAIN + 2, TOP), 0xbd10)
+
+  DW_CFA_advance_loc, DW_CFA_offset = 0x40, 0x80
+  DW_CFA_def_cfa, DW_CFA_def_cfa_offset = 0x0c, 0x0e
+  def entry(body):
+    body += bytes(-len(body) % 4)
+    return struct.pack('<I', len(body)) + body
+  # CIE: version 1, no augmentation, code alignment 1, data alignment
+  # -4, return address in lr, CFA = sp
+  frame = entry(struct.pack('<IB', 0xffffffff, 1) + b'\0' + bytes([1, 0x7c, 14, DW_CFA_def_cfa, 13, 0]))
+  # push {r4, lr}: CFA = sp + 8, lr at CFA - 4, r4 at CFA - 8
+  push = bytes([DW_CFA_advance_loc | 2, DW_CFA_def_cfa_offset, 8, DW_CFA_offset | 14, 1, DW_CFA_offset | 4, 2])
+  for start, end, instructions in ((LEAF, MID, b''),
+                                   (MID, TOP, push + bytes([DW_CFA_advance_loc | 2, DW_CFA_def_cfa_offset, 24])),
+                                   (TOP, MAIN, push), (MAIN, END, push)):
+    frame += entry(struct.pack('<III', 0, start, end - start) + instructions)
+
+  sections = [
+    ('.text', synthelf.SHT_PROGBITS, synthelf.SHF_ALLOC | synthelf.SHF_EXECINSTR, 0, bytes(text)),
+    ('.ARM.attributes', synthelf.SHT_ARM_ATTRIBUTES, 0, 0, synthelf.arm_attributes()),
+    ('.debug_frame', synthelf.SHT_PROGBITS, 0, 0, frame),
+  ]
+  symbols = [(name, addr | 1, end - addr, synthelf.STT_FUNC, synthelf.STB_GLOBAL, 1)
+             for name, addr, end in (('leaf', LEAF, MID), ('mid', MID, TOP), ('top', TOP, MAIN), ('main', MAIN, END))]
+  return synthelf.build_elf(synthelf.EM_ARM, 0x05000000, sections, symbols)
+
+def cfi_dump():
+  """
+  Return a memory dump (and its lowest address) of the stack after an
+  interrupt in leaf, called from mid, top and main. mid has locals that
+  look like return addresses.
+  """
+  words = []
+  def push(*values):
+    words[:0] = values
+  push(0x44444444, 0x11111111)          # main: push {r4, lr}
+  push(0x44444444, (MAIN + 6) | 1)      # top: push {r4, lr}
+  push(0x44444444, (TOP + 6) | 1)       # mid: push {r4, lr}
+  push((MID + 8) | 1, 0, (TOP + 6) | 1, 0)  # mid: sub sp, #16
+  # Exception frame: r0-r3, r12, lr, pc and xPSR
+  push(0, 1, 2, 3, 12, (MID + 8) | 1, LEAF + 2, 0x01000000)
+  push(0x77777777, 0xfffffff9)          # Exception handler: push {r4, lr}
+  start = 0x20000400 - len(words) * 4
+  memory = IntelHex()
+  memory.frombytes(b''.join(struct.pack('<I', w) for w in words), start)
+  return memory, start
+
+def test_cfi_index(tmp_path):
+  path = tmp_path / 'cfi.elf'
+  path.write_bytes(cfi_program())
+  elf, arch = main.open_elf(str(path))
+  index = arch.get_cfi_index()
+  assert index.starts == [LEAF, MID, TOP, MAIN]
+
+  # Leaf function: CFA = sp, lr not saved
+  row = index.lookup(LEAF + 2)
+  assert (row.cfa_reg, row.cfa_offset, row.offsets) == (arm.DWARF_REG_SP, 0, {})
+  # After push {r4, lr} and sub sp, #16
+  row = index.lookup(MID + 4)
+  assert (row.cfa_reg, row.cfa_offset) == (arm.DWARF_REG_SP, 24)
+  assert row.offsets == {arm.DWARF_REG_LR: -4, 4: -8}
+  assert index.saved_lr_row(MID).offsets[arm.DWARF_REG_LR] == -4
+
+def test_cfi_unwind(tmp_path):
+  path = tmp_path / 'cfi.elf'
+  path.write_bytes(cfi_program())
+  analyzer = main.Analyzer(str(path))
+  memory, start = cfi_dump()
+  isr_return = LEAF + 2
+
+  # Scanning finds the fake return addresses in the locals of mid too
+  scanned = analyzer.find_frames(memory, sp = start, isr_return = isr_return)
+  assert len(scanned) == 5
+
+  frames = analyzer.find_frames(memory, sp = start, isr_return = isr_return, unwind = True)
+  exception_frame = start + 8
+  mid_frame = exception_frame + 32 + 16
+  assert [(addr, call.call_addr, call.callee_addr) for addr, call in frames] == [
+    # lr in the exception frame (leaf does not save it)
+    (exception_frame + 20, MID + 4, LEAF),
+    # lr saved by mid, past its locals (CFA offset 24)
+    (mid_frame + 4, TOP + 2, MID),
+    # lr saved by top
+    (mid_frame + 12, MAIN + 2, TOP),
+  ]
@@ -0,0 +1,223 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+
+
+import io
+import random
+import struct
+
+import pytest
+from elftools.elf.elffile import ELFFile
+from intelhex import IntelHex
+
+import avr
+import main
+import synthelf
+
+# A small avr5 program with different function prologues, called in a
+# chain from main:
+#  leaf:   nop; ret                            (no frame)
+#  pushf:  push r16; push r17; call leaf       (2 byte frame)
+#  framef: push r28; push r29; in r28, SPL; in r29, SPH; sbiw r28, 4;
+#          in r0, SREG; cli; out SPH, r29; out SREG, r0; out SPL, r28;
+#          call pushf                          (6 byte frame)
+#  odd:    push r16; out SPL, r24; call framef (unrecognized)
+#  main:   call odd
+LEAF, PUSHF, FRAMEF, ODD, MAIN, END = 0x100, 0x110, 0x130, 0x160, 0x170, 0x180
+
+def call(target):
+  return [0x940e, target // 2]
+
+def prologue_program():
+  text = bytearray(END)
+  def code(addr, *words):
+    struct.pack_into('<{}H'.format(len(words)), text, addr, *words)
+  code(LEAF, 0x0000, 0x9508)
+  code(PUSHF, 0x930f, 0x931f, *call(LEAF), 0x911f, 0x910f, 0x9508)
+  code(FRAMEF, 0x93cf, 0x93df, 0xb7cd, 0xb7de, 0x9724, 0xb60f, 0x94f8, 0xbfde, 0xbe0f, 0xbfcd,
+       *call(PUSHF), 0x9508)
+  code(ODD, 0x930f, 0xbf8d, *call(FRAMEF), 0x9508)
+  code(MAIN, *call(ODD), 0xcfff)
+
+  sections = [('.text', synthelf.SHT_PROGBITS, synthelf.SHF_ALLOC | synthelf.SHF_EXECINSTR, 0, bytes(text))]
+  symbols = [(name, addr, end - addr, synthelf.STT_FUNC, synthelf.STB_GLOBAL, 1)
+             for name, addr, end in (('leaf', LEAF, PUSHF), ('pushf', PUSHF, FRAMEF), ('framef', FRAMEF, ODD),
+                                     ('odd', ODD, MAIN), ('main', MAIN, END))]
+  return synthelf.build_elf(synthelf.EM_AVR, 5, sections, symbols)
+
+def ret(addr):
+  # Return addresses are big-endian word addresses
+  return (addr // 2).to_bytes(2, 'big')
+
+# Stack after an interrupt in leaf, from the lowest address up. The
+# saved registers in the frames look like return addresses.
+STACK = 0x800
+stack = [
+  b'\x11\x22\x33',            # Registers saved by the ISR
+  ret(LEAF + 2),              # ISR return address
+  ret(PUSHF + 8),             # 0x805
+  ret(MAIN + 4),              # pushf: r17, r16
+  ret(FRAMEF + 0x18),         # 0x809
+  ret(PUSHF + 8) + ret(FRAMEF + 0x18) + ret(ODD + 8),  # framef: locals, r29, r28
+  ret(ODD + 8),               # 0x811
+  b'\xff',                    # odd: r16
+  ret(MAIN + 4),              # 0x814
+  bytes(4),
+]
+
+def open_program(tmp_path):
+  path = tmp_path / 'prologue.elf'
+  path.write_bytes(prologue_program())
+  return main.Analyzer(str(path))
+
+def stack_dump():
+  memory = IntelHex()
+  memory.frombytes(b''.join(stack), STACK)
+  return memory
+
+def test_analyze_prologue(tmp_path):
+  analyzer = open_program(tmp_path)
+  text = analyzer.elf.get_section_by_name('.text').data()
+  assert avr.analyze_prologue(text, LEAF, PUSHF, 2) == []
+  # Push only
+  assert avr.analyze_prologue(text, PUSHF, FRAMEF, 2) == [(PUSHF + 2, 1), (PUSHF + 4, 2)]
+  # Frame pointer, the frame is complete once SPL is written
+  steps = avr.analyze_prologue(text, FRAMEF, ODD, 2)
+  assert steps[:2] == [(FRAMEF + 2, 1), (FRAMEF + 4, 2)]
+  assert steps[-1] == (FRAMEF + 20, 6)
+  # Unrecognized
+  assert avr.analyze_prologue(text, ODD, MAIN, 2) is None
+
+  symbols = analyzer.analysis[0]
+  assert analyzer.arch.frame_size(symbols, PUSHF + 4, PUSHF + 8) == 2
+  assert analyzer.arch.frame_size(symbols, FRAMEF + 0x14, FRAMEF + 0x18) == 6
+  assert analyzer.arch.frame_size(symbols, ODD + 4, ODD + 8) is None
+
+def test_unwind(tmp_path):
+  analyzer = open_program(tmp_path)
+  callsites = analyzer.analysis[1]
+  expected = [(0x805, callsites[PUSHF + 8]), (0x809, callsites[FRAMEF + 0x18]),
+              (0x811, callsites[ODD + 8]), (0x814, callsites[MAIN + 4])]
+
+  # Scanning finds the saved registers as well
+  frames = analyzer.find_frames(stack_dump(), isr_return = LEAF + 2)
+  assert (0x807, callsites[MAIN + 4]) in frames
+
+  frames = analyzer.find_frames(stack_dump(), isr_return = LEAF + 2, unwind = True)
+  assert frames == expected
+  # The frame of odd is unknown, so its caller is found by scanning
+  assert frames.scanned == {0x814}
+
+  trace = [str(frame) for frame in analyzer.stacktrace(stack_dump(), isr_return = LEAF + 2, unwind = True)]
+  assert trace[-2] == "0x000811 contains 0x000164: call in odd called framef"
+  assert trace[-1] == "0x000814 contains 0x000170: call in main called odd (scanned)"
+
+  # Without the ISR return address, the first frame is found by scanning
+  frames = analyzer.find_frames(stack_dump(), unwind = True)
+  assert frames == expected
+  assert frames.scanned == {0x805, 0x814}
+
+def reference_callsites(data, ranges):
+  calls = {}
+  for start, end in sorted(ranges):
+    avr.find_function_callsites(data, start, end, calls)
+  return calls
+
+def test_callsites_numpy_synthetic():
+  pytest.importorskip('numpy')
+  for avr6 in (False, True):
+    program = synthelf.avr_program(functions = 300, text_size = 24 << 10, rows = 100, avr6 = avr6)
+    elf = ELFFile(io.BytesIO(program.elf))
+    data = elf.get_section_by_name('.text').data()
+    ranges = [(start, start + size) for start, size in program.functions]
+    calls = avr.find_callsites_numpy(data, ranges)
+    assert calls == reference_callsites(data, ranges)
+    # rcall targets wrap around the flash size, which the generator does
+    # not bother with
+    assert {ret: call[:2] for ret, call in calls.items()} == {ret: call[:2] for ret, call in program.calls.items()}
+
+def test_callsites_numpy_long_instructions():
+  pytest.importorskip('numpy')
+  rng = random.Random(1)
+  # call, jmp, lds and sts, with second words that are valid first words
+  # of calls and long instructions as well, so decoding at the wrong
+  # word finds different instructions
+  long_words = [0x940e, 0x940c, 0x9000, 0x9200, 0x95fe]
+  other_words = [0xd005, 0x9509, 0x9519, 0xd000, 0x0000, 0xe0f0]
+  words = []
+  while len(words) < 4000:
+    if rng.random() < 0.8:
+      words += [rng.choice(long_words) | rng.randrange(2), rng.choice(long_words + other_words)]
+    else:
+      words.append(rng.choice(other_words))
+  data = struct.pack('<{}H'.format(len(words)), *words)
+
+  ranges = []
+  addr = 0
+  while addr < len(data) - 64:
+    size = rng.randrange(2, 64, 2)
+    ranges.append((addr, addr + size))
+    addr += size
+  # Functions that start at an odd address or overlap the previous one
+  ranges += [(0x101, 0x141), (0x200, 0x260), (0x210, 0x230), (len(data) - 8, len(data))]
+
+  for some in (ranges[:1], ranges[:50], ranges):
+    assert avr.find_callsites_numpy(data, some) == reference_callsites(data, some)
+
+def linear_decode(data, candidates):
+  """ The original linear search decode, as a reference. """
+  opcode = int.from_bytes(data[0:2], byteorder='little')
+  for info, mask in candidates:
+    if opcode & ~mask == info.opcode:
+      raw = hex(int.from_bytes(data[0:info.length], byteorder='big'))
+      words = [int.from_bytes(data[i*2:i*2+2], byteorder='little') for i in range(info.length//2)]
+      return info, raw, [avr.decode_operand(words, info, operand) for operand in info.operands]
+  return avr.unknown_instruction, 0, []
+
+def test_decode_all_opcodes():
+  for call_only in (False, True):
+    candidates = []
+    for info in avr.call_and_long_instructions if call_only else avr.instructions:
+      mask = 0
+      for operand in info.operands:
+        mask |= operand.mask
+      candidates.append((info, mask))
+
+    for opcode in range(0x10000):
+      # The second word is only used by long instructions, pick one
+      # that varies with the opcode
+      data = struct.pack('<HH', opcode, opcode ^ 0xa5c3)
+      ins = avr.decode_instruction(data, 0, call_only = call_only)
+      info, raw, operands = linear_decode(data, candidates)
+      assert ins.info is info, hex(opcode)
+      assert ins.operands == operands, hex(opcode)
+      if not call_only:
+        assert ins.raw == raw, hex(opcode)
@@ -0,0 +1,70 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+
+import buckets
+
+def open_index(tmp_path):
+  return buckets.BucketIndex(str(tmp_path / 'buckets.db'), {'depth': 3})
+
+def get_bucket(index, signature):
+  for bucket in index.top(10):
+    if bucket[1] == signature:
+      return bucket[2:]
+  return None
+
+def test_signature_change(tmp_path):
+  index = open_index(tmp_path)
+  index.add('a', 10, 100, ['foo'])
+  index.add('b', 20, 100, ['foo'])
+  index.add('c', 30, 100, ['foo'])
+  index.add('d', 40, 100, ['foo'])
+  assert get_bucket(index, ['foo']) == (4, 10, 40, ['a', 'b', 'c'])
+
+  # A dump that changed moves to its new bucket
+  index.add('a', 50, 100, ['bar'])
+  assert get_bucket(index, ['foo']) == (3, 20, 40, ['b', 'c', 'd'])
+  assert get_bucket(index, ['bar']) == (1, 50, 50, ['a'])
+  index.add('d', 60, 100, ['bar'])
+  assert get_bucket(index, ['foo']) == (2, 20, 30, ['b', 'c'])
+  assert get_bucket(index, ['bar']) == (2, 50, 60, ['a', 'd'])
+
+  # Emptied buckets are not listed, but can be reused
+  index.add('b', 70, 100, None)
+  index.add('c', 80, 100, ['bar'])
+  assert get_bucket(index, ['foo']) is None
+  assert index.totals() == (1, 3, 1)
+  index.add('b', 90, 100, ['foo'])
+  assert get_bucket(index, ['foo']) == (1, 90, 90, ['b'])
+
+  # Readding with the same signature keeps a single example
+  index.add('b', 95, 100, ['foo'])
+  assert get_bucket(index, ['foo']) == (1, 95, 95, ['b'])
+  index.close()
@@ -0,0 +1,163 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+
+import marshal
+import os
+import sys
+import threading
+from array import array
+
+import cache
+import dwarf
+import indexes
+from indexes import CallInfo
+
+def make_analysis():
+  symbols = indexes.SymbolIndex(array('I', [0x100, 0x200]), array('I', [0x180, 0x260]),
+                                array('I', [0, 1]), ['foo', '_Z3barv'],
+                                skipped = [("Skipping zero-size function: ", 'empty')])
+  callsites = indexes.CallsiteIndex.from_dict({
+    0x104: CallInfo('call', 0x100, 0x200),
+    0x210: CallInfo('icall', 0x20e, None),
+  })
+  addr_to_line = dwarf.LineTable(array('I', [0x100]), array('I', [0x110]), array('I', [0]), [('foo.c', 12)])
+  return symbols, callsites, addr_to_line
+
+def check_analysis(analysis):
+  symbols, callsites, addr_to_line = analysis
+  assert list(symbols.starts) == [0x100, 0x200]
+  assert list(symbols.ends) == [0x180, 0x260]
+  assert symbols.names == ['foo', '_Z3barv']
+  assert symbols.containing(0x210) == '_Z3barv'
+  assert symbols.skipped == [("Skipping zero-size function: ", 'empty')]
+  assert dict(callsites.items()) == {
+    0x104: CallInfo('call', 0x100, 0x200),
+    0x210: CallInfo('icall', 0x20e, None),
+  }
+  assert list(addr_to_line.starts) == [0x100]
+  assert addr_to_line.locations == [('foo.c', 12)]
+
+def test_encode_decode_roundtrip():
+  data = cache.encode_analysis(*make_analysis())
+  # Must survive marshalling
+  check_analysis(cache.decode_analysis(marshal.loads(marshal.dumps(data))))
+
+def test_store_load(tmp_path):
+  analysis_cache = cache.AnalysisCache(str(tmp_path))
+  assert analysis_cache.load('key') is None
+  analysis_cache.store('key', *make_analysis())
+  check_analysis(analysis_cache.load('key'))
+
+def test_version_mismatch(tmp_path):
+  analysis_cache = cache.AnalysisCache(str(tmp_path))
+  analysis_cache.store('key', *make_analysis())
+  path = analysis_cache.path('key')
+  with open(path, 'r+b') as f:
+    f.seek(4)
+    f.write((cache.CACHE_VERSION - 1).to_bytes(2, 'little'))
+  assert analysis_cache.load('key') is None
+
+def test_bad_magic(tmp_path):
+  analysis_cache = cache.AnalysisCache(str(tmp_path))
+  analysis_cache.store('key', *make_analysis())
+  path = analysis_cache.path('key')
+  with open(path, 'r+b') as f:
+    f.write(b'XXXX')
+  assert analysis_cache.load('key') is None
+
+def test_truncated(tmp_path):
+  analysis_cache = cache.AnalysisCache(str(tmp_path))
+  analysis_cache.store('key', *make_analysis())
+  path = analysis_cache.path('key')
+  with open(path, 'r+b') as f:
+    f.truncate(20)
+  assert analysis_cache.load('key') is None
+
+def decode_functions(functions):
+  # One call at the start of each function, to the function itself
+  return [[(start + 4, 'call', start, start)] for start, code, mode in functions]
+
+def make_functions(first, count):
+  return [(0x1000 + i * 0x100, i.to_bytes(4, 'little') * 8, 'thumb') for i in range(first, first + count)]
+
+def test_function_cache_threads(tmp_path):
+  function_cache = cache.FunctionCache(str(tmp_path))
+  errors = []
+  def worker(n):
+    try:
+      for i in range(20):
+        functions = make_functions((n * 20 + i) * 10, 10) + make_functions(0, 10)
+        assert function_cache.callsites(functions, decode_functions) == decode_functions(functions)
+        function_cache.save()
+    except Exception as e: # pylint: disable=broad-except
+      errors.append(e)
+
+  interval = sys.getswitchinterval()
+  sys.setswitchinterval(1e-6)
+  try:
+    threads = [threading.Thread(target = worker, args = (n,)) for n in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+  finally:
+    sys.setswitchinterval(interval)
+
+  assert not errors
+  assert len(function_cache.entries) == 4 * 20 * 10
+  reloaded = cache.FunctionCache(str(tmp_path))
+  functions = make_functions(0, 800)
+  assert reloaded.callsites(functions, lambda missing: 1 / 0) == decode_functions(functions)
+
+def test_function_cache_max_size(tmp_path):
+  function_cache = cache.FunctionCache(str(tmp_path), max_size = 4096)
+  functions = make_functions(0, 5000)
+  function_cache.callsites(functions, decode_functions)
+  function_cache.save()
+  assert os.path.getsize(function_cache.path) <= 4096
+  # The most recently used entries are kept
+  assert 0 < len(function_cache.entries) < 5000
+  assert function_cache.key('thumb', functions[-1][1]) in function_cache.entries
+
+def test_evict_counts_function_cache(tmp_path):
+  analysis_cache = cache.AnalysisCache(str(tmp_path), max_size = 1 << 20)
+  function_cache = analysis_cache.functions
+  function_cache.callsites(make_functions(0, 5000), decode_functions)
+  function_cache.save()
+  size = os.path.getsize(function_cache.path)
+  assert size <= analysis_cache.max_size // 2
+
+  analysis_cache.max_size = size
+  os.utime(function_cache.path, (0, 0))
+  analysis_cache.store('key', *make_analysis())
+  # The function cache was the least recently used file
+  assert not os.path.exists(function_cache.path)
+  check_analysis(analysis_cache.load('key'))
@@ -0,0 +1,135 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+
+import io
+
+from intelhex import IntelHex
+
+import consolelog
+
+def hex_records(start, data):
+  """ Return the Intel hex records for data, including the end record. """
+  ih = IntelHex()
+  ih.frombytes(data, offset = start)
+  out = io.StringIO()
+  ih.write_hex_file(out)
+  return out.getvalue().splitlines()
+
+STACK = bytes(range(0x40, 0x80))
+IO = bytes(range(0x20))
+
+def avr_dump(sp, isr_return, stack = STACK):
+  """ The output of dumpMemory() on AVR, as a list of lines. """
+  return ([
+    'SP = 0x{:X}'.format(sp),
+    'Return = 0x{:X} (byte address)'.format(isr_return),
+    'IO registers:',
+  ] + hex_records(0, IO) + [
+    'Stack:',
+  ] + hex_records(sp + 1, stack) + [
+    'Dump complete',
+  ])
+
+def parse(lines):
+  return list(consolelog.iter_dumps(io.StringIO(''.join(line + '\n' for line in lines))))
+
+def stack_data(dump):
+  start, end = dump.memory.minaddr(), dump.memory.maxaddr() + 1
+  return start, dump.memory.tobinstr(start, end - 1)
+
+def test_interleaved_noise():
+  lines = avr_dump(0x21af, 0x1234)
+  # Log output before and after the dump, and between the header lines
+  # and in the IO section (which is not kept), with CRLF line endings
+  # and trailing whitespace as a serial console would give
+  lines = (['Booting...', 'ready', 'Return = 0x9999'] + lines[:2] + ['Temperature: 21C'] +
+           lines[2:4] + ['ADC overflow'] + lines[4:] + ['Booting...'])
+  dumps = list(consolelog.iter_dumps(io.StringIO(''.join(line + ' \r\n' for line in lines))))
+  assert len(dumps) == 1
+  dump = dumps[0]
+  assert (dump.line, dump.sp, dump.isr_return, dump.complete) == (4, 0x21af, 0x1234, True)
+  assert stack_data(dump) == (0x21b0, STACK)
+
+def test_without_dump_complete():
+  # ARM does not print "Dump complete" or an IO section, the end record
+  # ends the dump
+  lines = ['SP = 0x20001F00', 'Return = 0x8000ABC (byte address)', 'Stack:']
+  lines += hex_records(0x20001f00, STACK) + ['Some later output']
+  dump, = parse(lines)
+  assert (dump.sp, dump.isr_return, dump.complete) == (0x20001f00, 0x8000abc, True)
+  assert stack_data(dump) == (0x20001f00, STACK)
+
+def test_cut_off_at_eof():
+  lines = avr_dump(0x21af, 0x1234)
+  stack_start = lines.index('Stack:') + 1
+  # Cut after two complete stack records
+  dump, = parse(lines[:stack_start + 2])
+  assert (dump.sp, dump.isr_return, dump.complete) == (0x21af, 0x1234, False)
+  assert stack_data(dump) == (0x21b0, STACK[:32])
+
+  # Cut in the middle of a record, the partial record is dropped
+  partial = lines[stack_start + 2][:20]
+  dump, = parse(lines[:stack_start + 2] + [partial])
+  assert not dump.complete
+  assert stack_data(dump) == (0x21b0, STACK[:32])
+
+  # Cut before the stack section, there is no memory at all
+  dump, = parse(lines[:3])
+  assert (dump.sp, dump.complete, len(dump.memory)) == (0x21af, False, 0)
+
+def test_back_to_back():
+  first = avr_dump(0x21af, 0x1234)
+  second = avr_dump(0x218f, 0x5678, STACK[::-1])
+  dumps = parse(first + second)
+  assert [(d.line, d.sp, d.isr_return, d.complete) for d in dumps] == [
+    (1, 0x21af, 0x1234, True),
+    (len(first) + 1, 0x218f, 0x5678, True),
+  ]
+  assert stack_data(dumps[0]) == (0x21b0, STACK)
+  assert stack_data(dumps[1]) == (0x2190, STACK[::-1])
+
+  # A reset during the first dump, immediately followed by a new dump
+  stack_start = first.index('Stack:') + 1
+  dumps = parse(first[:stack_start + 1] + second)
+  assert [(d.sp, d.complete) for d in dumps] == [(0x21af, False), (0x218f, True)]
+  assert stack_data(dumps[0]) == (0x21b0, STACK[:16])
+  assert stack_data(dumps[1]) == (0x2190, STACK[::-1])
+
+def test_parser_feed():
+  # Dumps are returned as soon as the line completing them (the end
+  # record, before "Dump complete") is fed
+  parser = consolelog.DumpParser()
+  lines = avr_dump(0x21af, 0x1234)
+  results = [parser.feed(line, i) for i, line in enumerate(lines, 1)]
+  assert all(result == [] for result in results[:-2] + results[-1:])
+  dump, = results[-2]
+  assert dump.complete
+  assert parser.finish() == []
@@ -0,0 +1,97 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+
+
+import os
+import sys
+import threading
+
+import demangle
+
+def fake_cppfilt(tmp_path, lines = None):
+  """
+  Create a c++filt replacement that uppercases each line, and exits
+  after the given number of lines (if not None).
+  """
+  path = tmp_path / 'cppfilt'
+  path.write_text('#!{}\n'.format(sys.executable) +
+                  'import sys\n'
+                  'count = 0\n'
+                  'for line in sys.stdin:\n'
+                  '  if count == {}:\n'.format(lines) +
+                  '    break\n'
+                  '  sys.stdout.write(line.upper())\n'
+                  '  sys.stdout.flush()\n'
+                  '  count += 1\n')
+  os.chmod(str(path), 0o755)
+  return str(path)
+
+def test_single_process(tmp_path):
+  demangler = demangle.Demangler(fake_cppfilt(tmp_path))
+  demangler.prefetch(['_Z1av', '_Z1bv', '_Z1av'])
+  process = demangler.process
+  assert demangler.demangle('_Z1av') == '_Z1AV'
+  assert demangler.demangle('_Z1cv') == '_Z1CV'
+  demangler.prefetch(['_Z1dv', ''])
+  assert demangler.demangle('') == ''
+  assert demangler.process is process
+  demangler.close()
+  assert demangler.process is None
+
+def test_threads(tmp_path):
+  demangler = demangle.Demangler(fake_cppfilt(tmp_path), cache_size = 16)
+  errors = []
+  def worker(n):
+    try:
+      for i in range(50):
+        name = '_Z{}f{}v'.format(n, i % 20)
+        demangler.prefetch([name, '_Zcommon'])
+        assert demangler.demangle(name) == name.upper()
+    except Exception as e: # pylint: disable=broad-except
+      errors.append(e)
+  threads = [threading.Thread(target = worker, args = (n,)) for n in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  demangler.close()
+  assert not errors
+
+def test_cppfilt_stops(tmp_path, capsys):
+  demangler = demangle.Demangler(fake_cppfilt(tmp_path, lines = 2))
+  demangler.prefetch(['_Z1av', '_Z1bv', '_Z1cv', '_Z1dv'])
+  assert "stopped unexpectedly" in capsys.readouterr().err
+  # Names that were not demangled are left as they are
+  assert [demangler.demangle(name) for name in ('_Z1av', '_Z1bv', '_Z1cv', '_Z1dv')] == \
+    ['_Z1AV', '_Z1BV', '_Z1cv', '_Z1dv']
+  # A new process is started for the next names
+  assert demangler.demangle('_Z1ev') == '_Z1EV'
+  demangler.close()
@@ -0,0 +1,99 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+
+
+import io
+
+from elftools.elf.elffile import ELFFile
+
+import dwarf
+import synthelf
+
+def open_elf(sections):
+  return ELFFile(io.BytesIO(synthelf.build_elf(synthelf.EM_ARM, 0x05000000, sections, [])))
+
+def debug_sections(info, abbrev, line, rnglists = None):
+  sections = [
+    ('.debug_info', synthelf.SHT_PROGBITS, 0, 0, info),
+    ('.debug_abbrev', synthelf.SHT_PROGBITS, 0, 0, abbrev),
+    ('.debug_line', synthelf.SHT_PROGBITS, 0, 0, line),
+  ]
+  if rnglists is not None:
+    sections.append(('.debug_rnglists', synthelf.SHT_PROGBITS, 0, 0, rnglists))
+  return sections
+
+def check_lazy(elf, addrs):
+  eager = dwarf.get_addr_to_line_map(elf)
+  lazy = dwarf.get_addr_to_line_map(elf, lazy = True)
+  assert isinstance(lazy, dwarf.LazyLineTable)
+  for addr in addrs:
+    assert lazy.get(addr) == eager.get(addr)
+    assert (addr in lazy) == (addr in eager)
+  return eager, lazy
+
+def test_line_table():
+  elf = open_elf(debug_sections(*synthelf.build_dwarf([
+    ('a.c', 0x100, 0x120, [(0x100, 3), (0x104, 5), (0x110, 4)]),
+    ('b.c', 0x120, 0x130, [(0x120, 10), (0x128, 12)]),
+  ])))
+  table = dwarf.get_addr_to_line_map(elf)
+  assert table.get(0xfe) is None
+  assert table[0x100] == (b'a.c', 3)
+  assert table[0x103] == (b'a.c', 3)
+  assert table[0x104] == (b'a.c', 5)
+  assert table[0x11f] == (b'a.c', 4)
+  assert table[0x128] == (b'b.c', 12)
+  assert 0x130 not in table
+  check_lazy(elf, range(0xf0, 0x140))
+
+def test_lazy_synthetic_program():
+  program = synthelf.avr_program(functions = 200, text_size = 16 << 10, rows = 2000)
+  elf = ELFFile(io.BytesIO(program.elf))
+  eager, lazy = check_lazy(elf, range(0, program.text_start + program.text_size, 7))
+  assert len(eager) > 0
+
+def test_lazy_rnglists():
+  # DWARF 5 CUs with code in multiple sections, covered by DW_AT_ranges,
+  # without .debug_aranges
+  elf = open_elf(debug_sections(*synthelf.build_dwarf5([
+    ('a.c', [(0x100, 0x120), (0x200, 0x210)], [(0x100, 3), (0x110, 4), (0x200, 20), (0x208, 21)]),
+    ('b.c', [(0x120, 0x200)], [(0x120, 10), (0x180, 11)]),
+    ('c.c', [(0x210, 0x240), (0x300, 0x310)], [(0x210, 30), (0x300, 40)]),
+  ])))
+  eager, lazy = check_lazy(elf, [0x208])
+  assert lazy.unranged == []
+  # Only the CU covering the address was decoded
+  assert list(lazy.tables) == [elf.get_dwarf_info().get_CU_at(0).cu_offset]
+
+  eager, lazy = check_lazy(elf, range(0xf0, 0x320))
+  assert eager[0x1ff] == (b'b.c', 11)
+  assert eager[0x305] == (b'c.c', 40)
+  assert lazy.unranged == []
@@ -0,0 +1,71 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+
+import pytest
+
+import main
+
+def test_expand_dump_paths(tmp_path):
+  for name in ('b.hex', 'a.hex', 'c.txt'):
+    (tmp_path / name).write_text('')
+  directory = str(tmp_path)
+  assert main.expand_dump_paths([directory]) == [str(tmp_path / 'a.hex'), str(tmp_path / 'b.hex')]
+  assert main.expand_dump_paths([directory + '/*.txt']) == [str(tmp_path / 'c.txt')]
+  # Plain files are passed on as they are, even when missing
+  assert main.expand_dump_paths(['missing.hex']) == ['missing.hex']
+
+def test_expand_dump_paths_no_match(tmp_path):
+  with pytest.raises(FileNotFoundError):
+    main.expand_dump_paths([str(tmp_path / '*.hex')])
+  with pytest.raises(FileNotFoundError):
+    main.expand_dump_paths([str(tmp_path)])
+
+def test_analyzer_keyword_arguments(tmp_path):
+  import synthelf
+  program = synthelf.arm_program(functions = 50, text_size = 8 << 10, rows = 200)
+  path = tmp_path / 'program.elf'
+  path.write_bytes(program.elf)
+  dump = synthelf.stack_dump(program, 0x20000000, 1024, frames = 8)
+
+  analyzer = main.Analyzer(str(path))
+  isr_return = program.functions[3][0] + 4
+  frames = analyzer.find_frames(dump.hex, isr_return = isr_return, sp = 0x20000100)
+  assert frames and all(addr >= 0x20000100 for addr, call in frames)
+  trace = analyzer.stacktrace(dump.hex, isr_return = isr_return, sp = 0x20000100)
+  assert trace[0].stack_addr == 'isr-return'
+  assert [frame.stack_addr for frame in trace[1:]] == [addr for addr, call in frames]
+
+  # Everything but the memory dump is keyword-only, since both methods
+  # used to take these in a different order
+  with pytest.raises(TypeError):
+    analyzer.find_frames(dump.hex, 0x20000100)
+  with pytest.raises(TypeError):
+    analyzer.stacktrace(dump.hex, 0x20000100)
@@ -0,0 +1,53 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+
+import random
+
+import pointers
+
+def test_vectorized_matches_scalar():
+  rng = random.Random(1)
+  data = bytes(rng.randrange(256) for _ in range(101))
+  for first in (0, 1, 3):
+    for step in (1, 2, 4):
+      for addrlen in (2, 3):
+        offsets = range(first, len(data) - addrlen + 1, step)
+        assert list(pointers.decode_avr_ptrs(data, first, step, addrlen)) == \
+          [pointers.decode_avr_ptr(data[i:i + addrlen]) for i in offsets]
+      offsets = range(first, len(data) - 3, step)
+      assert list(pointers.decode_arm_ptrs(data, first, step)) == \
+        [pointers.decode_arm_ptr(data[i:i + 4]) for i in offsets]
+
+def test_decode():
+  # Word address 0x1234, big-endian
+  assert pointers.decode_avr_ptr(b'\x12\x34') == 0x2468
+  # Thumb bit is cleared
+  assert pointers.decode_arm_ptr(b'\x2d\x01\x00\x08') == 0x0800012c
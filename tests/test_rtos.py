@@ -0,0 +1,181 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+
+
+import sys
+import struct
+
+from intelhex import IntelHex
+
+import indexes
+import main
+import rtos
+import synthelf
+
+# FreeRTOS data, using the default (32-bit, no MPU) layout of
+# rtos.FreeRTOSLayout: a List_t is uxNumberOfItems, pxIndex and
+# xListEnd (xItemValue, pxNext, pxPrevious), a ListItem_t is
+# xItemValue, pxNext, pxPrevious, pvOwner and pvContainer.
+CURRENT_TCB = 0x20000000
+READY_LISTS = 0x20000004    # Two priorities
+DELAYED_LIST = 0x2000002c
+SUSPENDED_LIST = 0x20000040
+DATA_END = 0x20000054
+
+# TCB address -> (name, pxStack, pxTopOfStack)
+TCBS = {
+  0x20001000: ('main', 0x20002000, 0x20002100),
+  0x20001100: ('worker', 0x20002400, 0x20002500),
+  0x20001200: ('idle', 0x20002800, 0x20002900),
+  0x20001300: ('blocked', 0x20002c00, 0x20002d00),
+}
+
+# A function a suspended task can resume in
+TASK_FUNC, TASK_FUNC_END = 0x100, 0x120
+
+def freertos_program():
+  sections = [
+    ('.text', synthelf.SHT_PROGBITS, synthelf.SHF_ALLOC | synthelf.SHF_EXECINSTR, 0, bytes(TASK_FUNC_END)),
+    ('.ARM.attributes', synthelf.SHT_ARM_ATTRIBUTES, 0, 0, synthelf.arm_attributes()),
+    ('.data', synthelf.SHT_PROGBITS, synthelf.SHF_ALLOC | synthelf.SHF_WRITE, CURRENT_TCB,
+     bytes(DATA_END - CURRENT_TCB)),
+  ]
+  symbols = [('task_func', TASK_FUNC | 1, TASK_FUNC_END - TASK_FUNC, synthelf.STT_FUNC, synthelf.STB_GLOBAL, 1)]
+  for name, addr, size in (('pxCurrentTCB', CURRENT_TCB, 4), ('pxReadyTasksLists', READY_LISTS, 40),
+                           ('xDelayedTaskList1', DELAYED_LIST, 20), ('xSuspendedTaskList', SUSPENDED_LIST, 20)):
+    symbols.append((name, addr, size, synthelf.STT_OBJECT, synthelf.STB_GLOBAL, 3))
+  return synthelf.build_elf(synthelf.EM_ARM, 0x05000000, sections, symbols)
+
+def freertos_dump():
+  memory = IntelHex()
+  def put(addr, *words):
+    memory.puts(addr, struct.pack('<{}I'.format(len(words)), *words))
+  def put_list(addr, *tcbs, loop = False):
+    # Link the xStateListItem (at offset 4) of each TCB, ending at
+    # xListEnd, or at the first item when loop is True
+    end = addr + 8
+    items = [tcb + 4 for tcb in tcbs]
+    last = items[0] if loop else end
+    put(addr, len(items), end, 0xffffffff, items[0] if items else end, items[-1] if items else end)
+    for i, item in enumerate(items):
+      put(item, 0, items[i + 1] if i + 1 < len(items) else last, 0, tcbs[i], addr)
+
+  for tcb, (name, stack, top) in TCBS.items():
+    put(tcb, top)
+    put(tcb + 48, stack)
+    memory.puts(tcb + 52, name.encode('ascii').ljust(16, b'\0'))
+    memory.puts(stack, bytes(0x200))
+  put(CURRENT_TCB, 0x20001000)
+  put_list(READY_LISTS, 0x20001200)
+  put_list(READY_LISTS + 20, 0x20001000, 0x20001100)
+  put_list(DELAYED_LIST)
+  # A corrupted list, where the last item links back to the first
+  put_list(SUSPENDED_LIST, 0x20001300, 0x20001100, loop = True)
+  # The worker was suspended in task_func: r4-r11, then an exception
+  # frame with r0-r3, r12, lr, pc and xPSR
+  put(0x20002500 + 32, 0, 1, 2, 3, 12, 0xffffffff, (TASK_FUNC + 8) | 1, 0x01000000)
+  return memory
+
+def test_freertos_tasks(tmp_path):
+  path = tmp_path / 'freertos.elf'
+  path.write_bytes(freertos_program())
+  elf, arch = main.open_elf(str(path))
+  symbols = indexes.SymbolIndex.from_ranges([(TASK_FUNC, TASK_FUNC_END, 'task_func')])
+  freertos = rtos.FreeRTOS(elf, arch)
+  memory = freertos_dump()
+
+  # The walk stops when the list loops back on itself
+  assert list(freertos.list_owners(memory, SUSPENDED_LIST)) == [0x20001300, 0x20001100]
+  assert list(freertos.list_owners(memory, DELAYED_LIST)) == []
+
+  tasks = freertos.tasks(symbols, memory, sp = 0x20002080, isr_ret = 0x10a)
+  assert tasks == [
+    # Stacks end where the next stack starts (there is no pxEndOfStack)
+    rtos.Task(name='main', start=0x20002000, end=0x20002400, sp=0x20002080, resume=0x10a, current=True),
+    rtos.Task(name='idle', start=0x20002800, end=0x20002c00, sp=0x20002900, resume=None, current=False),
+    rtos.Task(name='worker', start=0x20002400, end=0x20002800, sp=0x20002500, resume=TASK_FUNC + 8, current=False),
+    rtos.Task(name='blocked', start=0x20002c00, end=None, sp=0x20002d00, resume=None, current=False),
+  ]
+
+def test_task_stacktraces(tmp_path, capsys, monkeypatch):
+  path = tmp_path / 'freertos.elf'
+  path.write_bytes(freertos_program())
+  analyzer = main.Analyzer(str(path))
+  memory = freertos_dump()
+  tasks = rtos.FreeRTOS(analyzer.elf, analyzer.arch).tasks(analyzer.analysis[0], memory)
+
+  # A few small stacks are scanned without worker processes
+  def worker_pool(jobs):
+    raise AssertionError("Worker pool created")
+  monkeypatch.setattr(main, 'worker_pool', worker_pool)
+  capsys.readouterr()
+  main.generate_task_stacktraces(analyzer.analysis, memory, analyzer.arch, tasks, 4, None)
+  serial = capsys.readouterr().out
+  assert serial.count('==> Task ') == 4
+  assert "==> Task worker (stack 0x20002400-0x20002800, sp 0x20002500) <==" in serial
+
+  monkeypatch.undo()
+  monkeypatch.setattr(main, 'parallel_min_stack_bytes', 0)
+  main.generate_task_stacktraces(analyzer.analysis, memory, analyzer.arch, tasks, 4, 2)
+  assert capsys.readouterr().out == serial
+
+def test_freertos_missing_symbols(tmp_path):
+  path = tmp_path / 'freertos.elf'
+  path.write_bytes(synthelf.build_elf(synthelf.EM_ARM, 0x05000000, [
+    ('.ARM.attributes', synthelf.SHT_ARM_ATTRIBUTES, 0, 0, synthelf.arm_attributes()),
+  ], []))
+  elf, arch = main.open_elf(str(path))
+  try:
+    rtos.FreeRTOS(elf, arch)
+  except rtos.TaskError:
+    pass
+  else:
+    assert False, "TaskError not raised"
+
+def test_rtos_error_once(tmp_path, capsys, monkeypatch):
+  path = tmp_path / 'program.elf'
+  path.write_bytes(synthelf.build_elf(synthelf.EM_ARM, 0x05000000, [
+    ('.text', synthelf.SHT_PROGBITS, synthelf.SHF_ALLOC | synthelf.SHF_EXECINSTR, 0, bytes(TASK_FUNC_END)),
+    ('.ARM.attributes', synthelf.SHT_ARM_ATTRIBUTES, 0, 0, synthelf.arm_attributes()),
+  ], [('task_func', TASK_FUNC | 1, TASK_FUNC_END - TASK_FUNC, synthelf.STT_FUNC, synthelf.STB_GLOBAL, 1)]))
+  dumps = []
+  for name in ('a.hex', 'b.hex'):
+    dumps.append(str(tmp_path / name))
+    freertos_dump().write_hex_file(dumps[-1])
+
+  monkeypatch.setattr(sys, 'argv', ['main.py', '--no-cache', '--elf', str(path), '--rtos', 'freertos'] + dumps)
+  try:
+    main.main()
+  except SystemExit as e:
+    assert e.code == 1
+  else:
+    assert False, "SystemExit not raised"
+  assert capsys.readouterr().err.count("No pxCurrentTCB symbol found") == 1
@@ -0,0 +1,130 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+
+
+import io
+import json
+import threading
+import http.client
+
+import server
+import synthelf
+
+def write_programs(tmp_path, count):
+  paths = []
+  for seed in range(1, count + 1):
+    program = synthelf.arm_program(functions = 50, text_size = 8 << 10, rows = 100, seed = seed)
+    path = tmp_path / 'program{}.elf'.format(seed)
+    path.write_bytes(program.elf)
+    paths.append((str(path), program))
+  return paths
+
+def test_registry_eviction(tmp_path, capsys):
+  (path1, _), (path2, _) = write_programs(tmp_path, 2)
+  # Room for either of the two, but not for both
+  sizes = [server.FirmwareRegistry(1 << 30).get(path).size for path in (path1, path2)]
+  registry = server.FirmwareRegistry(max(sizes) + min(sizes) // 2)
+
+  first = registry.get(path1)
+  assert registry.get(path1) is first
+  assert [f['elf'] for f in registry.loaded()] == [path1]
+  registry.get(path2)
+  assert [f['elf'] for f in registry.loaded()] == [path2]
+  assert "Dropped {}".format(path1) in capsys.readouterr().err
+
+  # Loaded again when needed, dropping the least recently used one
+  assert registry.get(path1) is not first
+  assert [f['elf'] for f in registry.loaded()] == [path1]
+
+def test_registry_keeps_recently_used(tmp_path):
+  (path1, _), (path2, _), (path3, _) = write_programs(tmp_path, 3)
+  sizes = [server.FirmwareRegistry(1 << 30).get(path).size for path in (path1, path2, path3)]
+  # Room for two of the three
+  registry = server.FirmwareRegistry(sum(sizes) - min(sizes) // 2)
+  registry.get(path1)
+  registry.get(path2)
+  registry.get(path1)
+  registry.get(path3)
+  assert sorted(f['elf'] for f in registry.loaded()) == sorted([path1, path3])
+
+def test_estimate_size(tmp_path):
+  (path, _), = write_programs(tmp_path, 1)
+  analysis = server.FirmwareRegistry(1 << 30).get(path).analyzer.analysis
+  symbols, callsites, addr_to_line = analysis
+  # At least the arrays: 3 per symbol and 4 per callsite
+  assert server.estimate_size(analysis) > len(symbols) * 12 + len(callsites) * 14
+
+def request(port, method, url, body = None):
+  connection = http.client.HTTPConnection('127.0.0.1', port)
+  try:
+    connection.request(method, url, body)
+    response = connection.getresponse()
+    return response.status, json.loads(response.read().decode('utf8'))
+  finally:
+    connection.close()
+
+def test_handlers(tmp_path):
+  (path, program), = write_programs(tmp_path, 1)
+  registry = server.FirmwareRegistry(1 << 30)
+  class Handler(server.RequestHandler):
+    def log_message(self, *args):
+      pass
+  Handler.registry = registry
+
+  httpd = server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+  thread = threading.Thread(target = httpd.serve_forever)
+  thread.start()
+  try:
+    port = httpd.server_address[1]
+    assert request(port, 'GET', '/firmware') == (200, [])
+
+    dump = synthelf.stack_dump(program, 0x20000000, 1024, frames = 8)
+    body = io.StringIO()
+    dump.hex.write_hex_file(body)
+    status, result = request(port, 'POST', '/trace?elf={}&sp=0x20000000'.format(path), body.getvalue())
+    assert status == 200
+    assert result['elf'] == path
+    found = {(frame['stack_addr'], frame['call_addr']) for frame in result['frames']}
+    for slot, ret_addr in dump.planted:
+      assert (slot, program.calls[ret_addr][1]) in found
+    assert all(frame['text'].startswith('0x') for frame in result['frames'])
+
+    # Only one elf file is loaded, so it can be omitted
+    assert request(port, 'POST', '/trace', body.getvalue()) == (200, result)
+    status, loaded = request(port, 'GET', '/firmware')
+    assert status == 200 and [f['elf'] for f in loaded] == [path]
+
+    assert request(port, 'POST', '/trace?sp=bogus', body.getvalue())[0] == 400
+    assert request(port, 'GET', '/other')[0] == 404
+  finally:
+    httpd.shutdown()
+    httpd.server_close()
+    thread.join()
@@ -0,0 +1,85 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+
+import pytest
+
+import main
+import sidecar
+import synthelf
+
+def export(tmp_path, program):
+  elf_path = str(tmp_path / 'program.elf')
+  with open(elf_path, 'wb') as f:
+    f.write(program.elf)
+  analyzer = main.Analyzer(elf_path)
+  sidecar_path = str(tmp_path / 'program.sc')
+  main.export_sidecar(sidecar_path, elf_path, analyzer.elf, analyzer.arch, analyzer.analysis)
+  return analyzer, sidecar_path
+
+@pytest.mark.parametrize('program, start', [
+  (synthelf.arm_program(functions = 100, text_size = 16 << 10, rows = 500), 0x20000000),
+  (synthelf.avr_program(functions = 100, text_size = 8 << 10, rows = 500), 0x800100),
+  (synthelf.avr_program(functions = 100, text_size = 8 << 10, rows = 500, avr6 = True), 0x800200),
+])
+def test_round_trip(tmp_path, program, start):
+  analyzer, path = export(tmp_path, program)
+  loaded = main.Analyzer.from_sidecar(path)
+  assert loaded.arch.get_addrlen() == analyzer.arch.get_addrlen()
+  assert loaded.arch.get_alignment() == analyzer.arch.get_alignment()
+
+  dump = synthelf.stack_dump(program, start, 2048, frames = 16)
+  frames = analyzer.find_frames(dump.hex)
+  assert len(frames) >= 16
+  assert loaded.find_frames(dump.hex) == frames
+  sp = start + 1024
+  assert loaded.find_frames(dump.hex, sp = sp, unaligned = True) == analyzer.find_frames(dump.hex, sp = sp, unaligned = True)
+  assert [str(frame) for frame in loaded.stacktrace(dump.hex)] == [str(frame) for frame in analyzer.stacktrace(dump.hex)]
+
+def test_load_errors(tmp_path):
+  program = synthelf.arm_program(functions = 50, text_size = 8 << 10, rows = 200)
+  analyzer, path = export(tmp_path, program)
+  with open(path, 'rb') as f:
+    data = f.read()
+
+  def check(contents, message):
+    broken = tmp_path / 'broken.sc'
+    broken.write_bytes(contents)
+    with pytest.raises(sidecar.SidecarError, match = message):
+      sidecar.load_sidecar(str(broken))
+
+  check(b'', 'Not a sidecar file')
+  check(b'\x7fELF' + data[4:], 'Not a sidecar file')
+  version = (sidecar.SIDECAR_VERSION + 1).to_bytes(4, 'little')
+  check(data[:4] + version + data[8:], r'Unsupported sidecar file version {} \(expected {}\)'.format(sidecar.SIDECAR_VERSION + 1, sidecar.SIDECAR_VERSION))
+  header_len = int.from_bytes(data[8:12], 'little')
+  for size in (6, 12, 12 + header_len // 2, 12 + header_len + 8, len(data) - 1):
+    check(data[:size], 'Truncated sidecar file')
+  check(data[:12] + b'{' * header_len + data[12 + header_len:], 'Corrupt sidecar file header')
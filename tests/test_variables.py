@@ -0,0 +1,193 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+
+from intelhex import IntelHex
+
+import main
+import synthelf
+import variables
+
+# DWARF constants used below
+DW_TAG = dict(compile_unit = 0x11, base_type = 0x24, typedef = 0x16, structure_type = 0x13,
+              member = 0x0d, array_type = 0x01, subrange_type = 0x21, variable = 0x34)
+DW_AT_location, DW_AT_name, DW_AT_byte_size, DW_AT_upper_bound = 0x02, 0x03, 0x0b, 0x2f
+DW_AT_count, DW_AT_data_member_location, DW_AT_encoding, DW_AT_type = 0x37, 0x38, 0x3e, 0x49
+DW_FORM_data1, DW_FORM_string, DW_FORM_ref4, DW_FORM_exprloc = 0x0b, 0x08, 0x13, 0x18
+DW_OP_addr = 0x03
+
+# Abbreviation code -> (tag, has children, attributes)
+ABBREVS = {
+  1: ('compile_unit', True, [(DW_AT_name, DW_FORM_string)]),
+  2: ('base_type', False, [(DW_AT_name, DW_FORM_string), (DW_AT_byte_size, DW_FORM_data1), (DW_AT_encoding, DW_FORM_data1)]),
+  3: ('typedef', False, [(DW_AT_name, DW_FORM_string), (DW_AT_type, DW_FORM_ref4)]),
+  4: ('structure_type', True, [(DW_AT_name, DW_FORM_string), (DW_AT_byte_size, DW_FORM_data1)]),
+  5: ('member', False, [(DW_AT_name, DW_FORM_string), (DW_AT_type, DW_FORM_ref4), (DW_AT_data_member_location, DW_FORM_data1)]),
+  6: ('array_type', True, [(DW_AT_type, DW_FORM_ref4)]),
+  7: ('subrange_type', False, [(DW_AT_upper_bound, DW_FORM_data1)]),
+  8: ('subrange_type', False, [(DW_AT_count, DW_FORM_data1)]),
+  9: ('variable', False, [(DW_AT_name, DW_FORM_string), (DW_AT_type, DW_FORM_ref4), (DW_AT_location, DW_FORM_exprloc)]),
+}
+
+# (label, abbreviation code, attribute values), None ends the children
+# of the previous DIE with children. Types refer to other DIEs by label.
+DIES = [
+  (None, 1, ['vars.c']),
+  ('int', 2, ['int', 2, variables.DW_ATE_signed]),
+  ('uchar', 2, ['unsigned char', 1, variables.DW_ATE_unsigned_char]),
+  ('ushort', 2, ['unsigned int', 2, variables.DW_ATE_unsigned]),
+  ('char', 2, ['char', 1, variables.DW_ATE_signed_char]),
+  ('uint8_t', 3, ['uint8_t', 'uchar']),
+  ('uint16_t', 3, ['uint16_t', 'ushort']),
+  ('point', 4, ['point', 6]),
+  (None, 5, ['x', 'int', 0]),
+  (None, 5, ['y', 'int', 2]),
+  (None, 5, ['flags', 'uint8_t', 4]),
+  None,
+  ('samples_t', 6, ['uint16_t']),
+  (None, 7, [3]),
+  None,
+  ('name_t', 6, ['char']),
+  (None, 8, [8]),
+  None,
+  ('matrix_t', 6, ['uint8_t']),
+  (None, 7, [1]),
+  (None, 8, [3]),
+  None,
+  (None, 9, ['origin', 'point', 0x800100]),
+  (None, 9, ['samples', 'samples_t', 0x800106]),
+  (None, 9, ['name', 'name_t', 0x80010e]),
+  (None, 9, ['matrix', 'matrix_t', 0x800116]),
+  (None, 9, ['counter', 'int', 0x80011c]),
+  None,
+]
+
+# Data symbols: (name, address, size)
+OBJECTS = [('origin', 0x800100, 6), ('samples', 0x800106, 8), ('name', 0x80010e, 8),
+           ('matrix', 0x800116, 6), ('counter', 0x80011c, 2)]
+
+def build_debug_info(address_size = 4):
+  """ Return (.debug_info, .debug_abbrev) contents for DIES (DWARF 4). """
+  abbrev = bytearray()
+  for code, (tag, children, attributes) in ABBREVS.items():
+    abbrev += synthelf.uleb128(code) + synthelf.uleb128(DW_TAG[tag]) + bytes([children])
+    for attribute, form in attributes:
+      abbrev += synthelf.uleb128(attribute) + synthelf.uleb128(form)
+    abbrev += b'\0\0'
+  abbrev += b'\0'
+
+  def encode(labels):
+    data = bytearray()
+    for die in DIES:
+      if die is None:
+        data.append(0)
+        continue
+      label, code, values = die
+      if label is not None:
+        # DIE offsets are relative to the start of the unit header
+        labels[label] = 11 + len(data)
+      data += synthelf.uleb128(code)
+      for (attribute, form), value in zip(ABBREVS[code][2], values):
+        if form == DW_FORM_string:
+          data += value.encode('ascii') + b'\0'
+        elif form == DW_FORM_data1:
+          data.append(value)
+        elif form == DW_FORM_ref4:
+          data += labels.get(value, 0).to_bytes(4, 'little')
+        elif form == DW_FORM_exprloc:
+          data += bytes([1 + address_size, DW_OP_addr]) + value.to_bytes(address_size, 'little')
+    return data
+
+  # Encode twice, the second time with all labels known
+  labels = {}
+  encode(labels)
+  dies = encode(labels)
+  unit = (4).to_bytes(2, 'little') + (0).to_bytes(4, 'little') + bytes([address_size]) + dies
+  return len(unit).to_bytes(4, 'little') + unit, bytes(abbrev)
+
+def open_program(tmp_path):
+  info, abbrev = build_debug_info()
+  sections = [
+    ('.text', synthelf.SHT_PROGBITS, synthelf.SHF_ALLOC | synthelf.SHF_EXECINSTR, 0, b'\x08\x95' * 16),
+    ('.data', synthelf.SHT_PROGBITS, synthelf.SHF_ALLOC | synthelf.SHF_WRITE, 0x800100, bytes(0x1e)),
+    ('.debug_info', synthelf.SHT_PROGBITS, 0, 0, info),
+    ('.debug_abbrev', synthelf.SHT_PROGBITS, 0, 0, abbrev),
+  ]
+  symbols = [(name, addr, size, synthelf.STT_OBJECT, synthelf.STB_GLOBAL, 2) for name, addr, size in OBJECTS]
+  path = tmp_path / 'vars.elf'
+  path.write_bytes(synthelf.build_elf(synthelf.EM_AVR, 5, sections, symbols))
+  return main.open_elf(str(path))
+
+RAM = bytes([
+  0xfe, 0xff, 0x2c, 0x01, 0x05, 0x00,              # origin = {-2, 300, 5}
+  0x01, 0x00, 0x02, 0x00, 0x00, 0x01, 0xff, 0xff,  # samples = {1, 2, 256, 65535}
+]) + b'hello\0xx' + bytes([1, 2, 3, 4, 5, 6]) + (-5).to_bytes(2, 'little', signed = True)
+
+def test_types(tmp_path):
+  elf, arch = open_program(tmp_path)
+  types = variables.variable_types(elf, arch)
+  assert types == {
+    0x100: variables.TypeInfo('struct point', 6, 'other', None, None),
+    0x106: variables.TypeInfo('uint16_t[4]', 8, 'other', variables.DW_ATE_unsigned, None),
+    0x10e: variables.TypeInfo('char[8]', 8, 'other', variables.DW_ATE_signed_char, None),
+    0x116: variables.TypeInfo('uint8_t[2][3]', 6, 'other', variables.DW_ATE_unsigned_char, None),
+    0x11c: variables.TypeInfo('int', 2, 'base', variables.DW_ATE_signed, None),
+  }
+
+def test_struct_members(tmp_path):
+  elf, arch = open_program(tmp_path)
+  Member = variables.Member
+  assert variables.struct_members(elf, ['point', 'missing']) == {
+    'point': {None: Member(0, 6), 'x': Member(0, 2), 'y': Member(2, 2), 'flags': Member(4, 1)},
+  }
+
+def test_decode(tmp_path):
+  elf, arch = open_program(tmp_path)
+  index = variables.VariableIndex.from_elf(elf, arch)
+  assert len(index) == len(OBJECTS)
+
+  memory = IntelHex()
+  memory.frombytes(RAM, offset = 0x100)
+  values = [(v.addr, v.size, v.name, v.type, v.value, v.partial) for v in index.decode(memory)]
+  assert values == [
+    (0x100, 6, 'origin', 'struct point', 'fe ff 2c 01 05 00', False),
+    (0x106, 8, 'samples', 'uint16_t[4]', '01 00 02 00 00 01 ff ff', False),
+    (0x10e, 8, 'name', 'char[8]', "'hello'", False),
+    (0x116, 6, 'matrix', 'uint8_t[2][3]', '01 02 03 04 05 06', False),
+    (0x11c, 2, 'counter', 'int', '-5', False),
+  ]
+
+  # Only part of the array and the start of the string in the dump
+  memory = IntelHex()
+  memory.frombytes(RAM[0xa:0x11], offset = 0x10a)
+  values = [(v.name, v.value, v.partial) for v in index.decode(memory)]
+  assert values == [('samples', '00 01 ff ff', True), ('name', '68 65 6c', True)]
+  assert index.containing(0x10a) == ('samples', 4)
+  assert index.containing(0x122) is None
@@ -0,0 +1,338 @@
+"""
+Copyright 2017 3devo (www.3devo.eu)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software without
+   specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+
+import bisect
+import struct
+from collections import namedtuple
+
+import indexes
+
+# Section flags (see the ELF gABI)
+SHF_WRITE = 0x1
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+
+# DWARF base type encodings
+DW_ATE_boolean = 0x2
+DW_ATE_float = 0x4
+DW_ATE_signed = 0x5
+DW_ATE_signed_char = 0x6
+DW_ATE_unsigned = 0x7
+DW_ATE_unsigned_char = 0x8
+
+DW_OP_addr = 0x03
+
+# Decoded DWARF type of a variable: name is a C-like description, kind
+# is 'base', 'pointer', 'enum' or 'other' (arrays, structs, etc.),
+# encoding is the DW_ATE_* encoding of base types and enumerators maps
+# values to names for enums.
+TypeInfo = namedtuple('TypeInfo', ['name', 'size', 'kind', 'encoding', 'enumerators'])
+
+# Value of a variable in a memory dump. value is a string, partial is
+# True when only part of the variable is in the dump.
+Variable = namedtuple('Variable', ['addr', 'size', 'name', 'type', 'value', 'partial'])
+
+# Number of bytes shown for variables without a (supported) type
+max_raw_bytes = 16
+
+def object_ranges(elf, arch):
+  """
+  Yields (start, end, name) tuples for the data objects (STT_OBJECT
+  symbols) in writable, allocated sections (.data, .bss, .noinit,
+  etc.), using data memory addresses.
+  """
+  symtab = elf.get_section_by_name('.symtab')
+  if symtab is None:
+    return
+
+  sections = set()
+  for i, section in enumerate(elf.iter_sections()):
+    flags = section['sh_flags']
+    if flags & (SHF_WRITE | SHF_ALLOC) == SHF_WRITE | SHF_ALLOC and not flags & SHF_EXECINSTR:
+      sections.add(i)
+
+  for sym in symtab.iter_symbols():
+    if sym['st_info']['type'] != 'STT_OBJECT' or sym['st_size'] <= 0:
+      continue
+    if sym['st_shndx'] not in sections:
+      continue
+    addr = arch.data_addr(sym['st_value'])
+    if addr is not None:
+      yield (addr, addr + sym['st_size'], sym.name)
+
+def die_type(die):
+  """ Return the DIE of the type of the given DIE, or None. """
+  if 'DW_AT_type' not in die.attributes:
+    return None
+  return die.get_DIE_from_attribute('DW_AT_type')
+
+def describe_type(die, address_size):
+  """ Return a TypeInfo for the given type DIE (None means void). """
+  name = None
+  # Skip qualifiers and typedefs, keeping the first name
+  while die is not None and die.tag in ('DW_TAG_typedef', 'DW_TAG_const_type', 'DW_TAG_volatile_type'):
+    if name is None and 'DW_AT_name' in die.attributes:
+      name = die.attributes['DW_AT_name'].value.decode('utf8', 'replace')
+    die = die_type(die)
+
+  if die is None:
+    return TypeInfo(name or 'void', 0, 'other', None, None)
+
+  size = die.attributes['DW_AT_byte_size'].value if 'DW_AT_byte_size' in die.attributes else None
+  own_name = None
+  if 'DW_AT_name' in die.attributes:
+    own_name = die.attributes['DW_AT_name'].value.decode('utf8', 'replace')
+
+  if die.tag == 'DW_TAG_base_type':
+    return TypeInfo(name or own_name, size, 'base', die.attributes['DW_AT_encoding'].value, None)
+  elif die.tag == 'DW_TAG_pointer_type':
+    target = die_type(die)
+    target_name = describe_type(target, address_size).name if target is not None else 'void'
+    return TypeInfo(name or target_name + ' *', size or address_size, 'pointer', None, None)
+  elif die.tag == 'DW_TAG_enumeration_type':
+    enumerators = {}
+    for child in die.iter_children():
+      if child.tag == 'DW_TAG_enumerator':
+        enumerators[child.attributes['DW_AT_const_value'].value] = child.attributes['DW_AT_name'].value.decode('utf8', 'replace')
+    return TypeInfo(name or 'enum ' + (own_name or '<anonymous>'), size, 'enum', None, enumerators)
+  elif die.tag == 'DW_TAG_array_type':
+    elem = describe_type(die_type(die), address_size)
+    dims = ''
+    count = 1
+    for child in die.iter_children():
+      if child.tag == 'DW_TAG_subrange_type':
+        if 'DW_AT_count' in child.attributes:
+          n = child.attributes['DW_AT_count'].value
+        elif 'DW_AT_upper_bound' in child.attributes:
+          n = child.attributes['DW_AT_upper_bound'].value + 1
+        else:
+          n = None
+        if n is None or count is None:
+          count = None
+        else:
+          count *= n
+        dims += '[{}]'.format('' if n is None else n)
+    if size is None and count is not None and elem.size is not None:
+      size = count * elem.size
+    return TypeInfo(name or elem.name + dims, size, 'other', elem.encoding, None)
+
+  prefixes = {
+    'DW_TAG_structure_type': 'struct ',
+    'DW_TAG_union_type': 'union ',
+    'DW_TAG_class_type': 'class ',
+  }
+  return TypeInfo(name or prefixes.get(die.tag, '') + (own_name or '<anonymous>'), size, 'other', None, None)
+
+def variable_types(elf, arch):
+  """
+  Return a dictionary mapping data memory addresses of global variables
+  to their TypeInfo, from the DWARF info in the given elf file. Only
+  variables declared at file scope are included.
+  """
+  types = {}
+  if not elf.has_dwarf_info():
+    return types
+
+  dwarf_info = elf.get_dwarf_info()
+  for CU in dwarf_info.iter_CUs():
+    address_size = CU['address_size']
+    for die in CU.get_top_DIE().iter_children():
+      if die.tag != 'DW_TAG_variable' or 'DW_AT_location' not in die.attributes:
+        continue
+      location = die.attributes['DW_AT_location']
+      expr = location.value
+      if (location.form not in ('DW_FORM_exprloc', 'DW_FORM_block1', 'DW_FORM_block') or
+          len(expr) != 1 + address_size or expr[0] != DW_OP_addr):
+        continue
+      addr = arch.data_addr(int.from_bytes(bytes(expr[1:]), 'little' if elf.little_endian else 'big'))
+      if addr is None:
+        continue
+
+      # The type can be on the declaration
+      decl = die
+      if 'DW_AT_type' not in die.attributes and 'DW_AT_specification' in die.attributes:
+        decl = die.get_DIE_from_attribute('DW_AT_specification')
+      if 'DW_AT_type' in decl.attributes:
+        types[addr] = describe_type(die_type(decl), address_size)
+  return types
+
+# Offset and size of a structure member
+Member = namedtuple('Member', ['offset', 'size'])
+
+def member_offset(die):
+  """ Return the offset of the given member DIE in its structure, or None. """
+  if 'DW_AT_data_member_location' not in die.attributes:
+    return 0
+  value = die.attributes['DW_AT_data_member_location'].value
+  if isinstance(value, int):
+    return value
+  # DWARF 2 style location expression: DW_OP_plus_uconst <uleb128>
+  if value and value[0] == 0x23:
+    offset = shift = 0
+    for b in value[1:]:
+      offset |= (b & 0x7f) << shift
+      shift += 7
+      if not b & 0x80:
+        return offset
+  return None
+
+def struct_members(elf, names):
+  """
+  Return a dictionary mapping each of the given structure names that is
+  found in the DWARF info to a dictionary mapping member names to a
+  Member. The None key holds the size of the structure itself.
+  """
+  structs = {}
+  if not elf.has_dwarf_info():
+    return structs
+
+  names = set(names)
+  for CU in elf.get_dwarf_info().iter_CUs():
+    address_size = CU['address_size']
+    for die in CU.get_top_DIE().iter_children():
+      if die.tag != 'DW_TAG_structure_type' or 'DW_AT_byte_size' not in die.attributes:
+        continue
+      name = die.attributes['DW_AT_name'].value.decode('utf8', 'replace') if 'DW_AT_name' in die.attributes else None
+      if name not in names or name in structs:
+        continue
+      members = {None: Member(0, die.attributes['DW_AT_byte_size'].value)}
+      for child in die.iter_children():
+        if child.tag != 'DW_TAG_member' or 'DW_AT_name' not in child.attributes:
+          continue
+        offset = member_offset(child)
+        if offset is not None:
+          size = describe_type(die_type(child), address_size).size
+          members[child.attributes['DW_AT_name'].value.decode('utf8', 'replace')] = Member(offset, size)
+      structs[name] = members
+    if len(structs) == len(names):
+      break
+  return structs
+
+class VariableIndex:
+  """
+  Index of the global variables in an elf file, to find the variable
+  containing a given data memory address using bisect (see
+  indexes.SymbolIndex), and to decode their values from a memory dump.
+  """
+  def __init__(self, symbols, types, little_endian = True):
+    self.symbols = symbols
+    # Start address -> TypeInfo
+    self.types = types
+    self.byteorder = 'little' if little_endian else 'big'
+
+  @classmethod
+  def from_elf(cls, elf, arch, types = True):
+    symbols = indexes.SymbolIndex.from_ranges(object_ranges(elf, arch), demangled = False)
+    return cls(symbols, variable_types(elf, arch) if types else {}, elf.little_endian)
+
+  def __len__(self):
+    return len(self.symbols)
+
+  def containing(self, addr):
+    """
+    Return a (name, offset) tuple for the variable containing addr, or
+    None.
+    """
+    i = self.symbols.find(addr)
+    if i < 0:
+      return None
+    return self.symbols.names[self.symbols.name_ids[i]], addr - self.symbols.starts[i]
+
+  def format_value(self, data, type_info):
+    """ Return a string describing the given bytes as type_info. """
+    if type_info is not None and type_info.size == len(data):
+      value = int.from_bytes(data, self.byteorder)
+      if type_info.kind == 'base':
+        encoding = type_info.encoding
+        if encoding in (DW_ATE_signed, DW_ATE_signed_char):
+          value = int.from_bytes(data, self.byteorder, signed = True)
+        if encoding == DW_ATE_float and len(data) in (4, 8):
+          fmt = ('<' if self.byteorder == 'little' else '>') + ('f' if len(data) == 4 else 'd')
+          return repr(struct.unpack(fmt, data)[0])
+        if encoding == DW_ATE_boolean:
+          return 'true' if value else 'false'
+        if encoding in (DW_ATE_signed_char, DW_ATE_unsigned_char) and 0x20 <= value < 0x7f:
+          return "{} '{}'".format(value, chr(value))
+        if encoding in (DW_ATE_signed, DW_ATE_signed_char, DW_ATE_unsigned, DW_ATE_unsigned_char):
+          return str(value)
+      elif type_info.kind == 'enum':
+        if value in type_info.enumerators:
+          return type_info.enumerators[value]
+        return str(value)
+      elif type_info.kind == 'pointer':
+        result = '0x{:x}'.format(value)
+        target = self.containing(value)
+        if target is not None:
+          name, offset = target
+          result += ' (&{}{})'.format(name, '+{}'.format(offset) if offset else '')
+        return result
+      elif type_info.encoding in (DW_ATE_signed_char, DW_ATE_unsigned_char):
+        # Array of characters, show as a string up to the first NUL
+        # when it looks like text
+        text = bytes(data).split(b'\0', 1)[0]
+        if all(0x20 <= b < 0x7f for b in text):
+          return repr(text.decode('ascii'))
+
+    raw = ' '.join('{:02x}'.format(b) for b in data[:max_raw_bytes])
+    if len(data) > max_raw_bytes:
+      raw += ' ...'
+    return raw
+
+  def decode(self, memory):
+    """
+    Return a list of Variables for all variables (partially) contained
+    in the given memory dump, ordered by address. This is a single pass
+    over the memory segments and the sorted variables.
+    """
+    symbols = self.symbols
+    result = []
+    for start, end in memory.segments():
+      data = memory.gets(start, end - start)
+      # Start at the variable containing start, or the first one after it
+      i = symbols.find(start)
+      if i < 0:
+        i = bisect.bisect_left(symbols.starts, start)
+      while i < len(symbols) and symbols.starts[i] < end:
+        var_start = symbols.starts[i]
+        var_end = symbols.ends[i]
+        lo = max(var_start, start)
+        hi = min(var_end, end)
+        if hi > lo:
+          type_info = self.types.get(var_start)
+          partial = lo != var_start or hi != var_end
+          value = self.format_value(data[lo - start:hi - start], None if partial else type_info)
+          result.append(Variable(addr=var_start, size=var_end - var_start,
+                                 name=symbols.names[symbols.name_ids[i]],
+                                 type=type_info.name if type_info else None,
+                                 value=value, partial=partial))
+        i += 1
+    return result
+
+__all__ = ('VariableIndex', 'Variable', 'Member', 'struct_members')